@@ -1,5 +1,50 @@
-from .image_augmentor import ImageAugmentor
-from .mosaic_creator import MosaicCreator
-from .split_subset import SplitSubset
-from .yolo_dataset import YoloDataset
-from .utility_functions import delete_directory, create_mosaics, save_mosaics, create_yaml_file, read_classes, initialize_dataloaders
\ No newline at end of file
+# Классы и функции пакета загружаются при первом обращении (PEP 562): `import MosaicDataset` не тянет torch,
+# albumentations и OpenCV, они загружаются только модулями, которым нужны (DataLoader'ы, Dataset'ы, аугментации)
+import importlib
+
+_EXPORTS = {
+    'DatasetManifest': 'dataset_manifest',
+    'DuplicateIndex': 'duplicate_index',
+    'EpochPrefetcher': 'epoch_prefetcher',
+    'ImageAugmentor': 'image_augmentor',
+    'ImageRecord': 'image_record',
+    'TileRecord': 'image_record',
+    'LabelStore': 'label_store',
+    'MosaicCreator': 'mosaic_creator',
+    'MosaicPacker': 'mosaic_packer',
+    'SkylinePacker': 'mosaic_packer',
+    'MaxRectsPacker': 'mosaic_packer',
+    'MosaicPlan': 'mosaic_plan',
+    'MosaicWriter': 'mosaic_writer',
+    'PipelineMetrics': 'pipeline_metrics',
+    'ShardWriter': 'shard_writer',
+    'ShardDataset': 'shard_dataset',
+    'ShardRecord': 'shard_dataset',
+    'SourceCache': 'source_cache',
+    'SourceIndex': 'source_index',
+    'SplitSubset': 'split_subset',
+    'VariantPool': 'variant_pool',
+    'YoloDataset': 'yolo_dataset',
+    'MosaicYoloDataset': 'yolo_dataset',
+    'YoloCollate': 'yolo_collate',
+    'to_device': 'yolo_collate',
+    'delete_directory': 'utility_functions',
+    'create_mosaics': 'utility_functions',
+    'save_mosaics': 'utility_functions',
+    'create_yaml_file': 'utility_functions',
+    'read_classes': 'utility_functions',
+    'initialize_dataloaders': 'utility_functions',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    globals()[name] = value  # Следующие обращения не проходят через __getattr__
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
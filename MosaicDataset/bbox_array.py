@@ -0,0 +1,102 @@
+import numpy as np
+
+# Аннотации хранятся массивом (N, 5) float32: [класс, x_center, y_center, width, height]
+# в нормализованных (YOLO) координатах. Все операции над ними векторизованы
+
+# Функция приведения аннотаций (список списков или массив) к массиву (N, 5) float32
+def to_bbox_array(bboxes):
+    return np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+
+# Функция разделения массива аннотаций на метки классов и координаты
+def split_labels(bboxes):
+    return bboxes[:, 0].astype(np.int64), bboxes[:, 1:]
+
+# Функция сборки массива аннотаций из меток классов и координат
+def join_labels(class_labels, coords):
+    bboxes = np.empty((len(class_labels), 5), dtype=np.float32)
+    bboxes[:, 0] = class_labels
+    bboxes[:, 1:] = np.asarray(coords, dtype=np.float32).reshape(-1, 4)
+    return bboxes
+
+# Функция масштабирования нормализованных координат: (image_size) -> (target_size)
+def scale_bboxes(bboxes, image_size, target_size):
+    scale = np.array([image_size[0] / target_size[0], image_size[1] / target_size[1]] * 2, dtype=np.float32)
+    result = bboxes.copy()
+    result[:, 1:] *= scale
+    return result
+
+# Функция смещения центров аннотаций на (x, y) пикселей полотна размером canvas_size
+def offset_bboxes(bboxes, x, y, canvas_size):
+    result = bboxes.copy()
+    result[:, 1] += x / canvas_size
+    result[:, 2] += y / canvas_size
+    return result
+
+# Функция переноса аннотаций картинки image_size, выложенной в точку (x, y), в координаты полотна
+def shift_bboxes(bboxes, image_size, x, y, canvas_size):
+    return offset_bboxes(scale_bboxes(bboxes, image_size, (canvas_size, canvas_size)), x, y, canvas_size)
+
+# Функция перевода аннотаций в абсолютные координаты углов (left, top, right, bottom) в пикселях
+def bbox_corners(bboxes, width, height):
+    bboxes = to_bbox_array(bboxes)
+    size = np.array([width, height], dtype=np.float32)
+    centers = bboxes[:, 1:3] * size
+    half = bboxes[:, 3:5] * size / 2
+    return np.concatenate([centers - half, centers + half], axis=1)
+
+# Функция обрезки аннотаций по границам [0, 1]. Рамки, не имеющие площади после обрезки, удаляются
+def clip_bboxes(bboxes):
+    half = bboxes[:, 3:5] / 2
+    top_left = np.clip(bboxes[:, 1:3] - half, 0.0, 1.0)
+    bottom_right = np.clip(bboxes[:, 1:3] + half, 0.0, 1.0)
+    size = bottom_right - top_left
+    keep = (size > 0).all(axis=1)
+    result = np.empty((int(keep.sum()), 5), dtype=np.float32)
+    result[:, 0] = bboxes[keep, 0]
+    result[:, 1:3] = (top_left[keep] + bottom_right[keep]) / 2
+    result[:, 3:5] = size[keep]
+    return result
+
+# Функция расчета окон нарезки картинки image_size на фрагменты tile_size с перекрытием overlap (доля фрагмента).
+# Возвращает массив (T, 4) int64: [left, top, right, bottom]; последний фрагмент ряда прижат к краю картинки
+def tile_windows(image_size, tile_size, overlap=0.2):
+    def starts(length):
+        if length <= tile_size:
+            return np.zeros(1, dtype=np.int64)
+        stride = max(int(tile_size * (1 - overlap)), 1)
+        return np.unique(np.append(np.arange(0, length - tile_size, stride), length - tile_size))
+
+    width, height = image_size
+    xs, ys = np.meshgrid(starts(width), starts(height))
+    left, top = xs.ravel(), ys.ravel()
+    return np.stack([left, top, np.minimum(left + tile_size, width), np.minimum(top + tile_size, height)], axis=1)
+
+# Функция переноса аннотаций картинки image_size во все окна windows сразу (T x N операций без циклов по рамкам).
+# Рамки обрезаются по окну; остаются рамки, видимая доля площади которых не меньше min_visible.
+# Возвращает список массивов (N_t, 5) в нормализованных координатах окон
+def crop_bboxes(bboxes, image_size, windows, min_visible=0.3):
+    corners = bbox_corners(bboxes, *image_size)[None, :, :]  # (1, N, 4)
+    windows = windows.astype(np.float32)[:, None, :]  # (T, 1, 4)
+    top_left = np.maximum(corners[..., :2], windows[..., :2])
+    bottom_right = np.minimum(corners[..., 2:], windows[..., 2:])
+    visible = np.clip(bottom_right - top_left, 0, None)
+    area = np.prod(corners[..., 2:] - corners[..., :2], axis=-1)
+    keep = np.prod(visible, axis=-1) >= min_visible * np.maximum(area, 1e-6)
+    keep &= (visible > 0).all(axis=-1)
+
+    window_size = windows[..., 2:] - windows[..., :2]
+    centers = ((top_left + bottom_right) / 2 - windows[..., :2]) / window_size
+    sizes = visible / window_size
+    result = np.concatenate([np.broadcast_to(bboxes[None, :, :1], keep.shape + (1,)), centers, sizes], axis=-1)
+    return [result[tile][keep[tile]].astype(np.float32) for tile in range(len(keep))]
+
+# Функция форматирования аннотаций в текст разметки YOLO
+def format_bboxes(bboxes):
+    lines = [f"{int(class_label)} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}"
+             for class_label, x_center, y_center, width, height in to_bbox_array(bboxes).tolist()]
+    return ''.join(line + '\n' for line in lines)
+
+# Функция сохранения аннотаций в файл разметки YOLO
+def save_bboxes(bbox_file_path, bboxes):
+    with open(bbox_file_path, 'w') as file:
+        file.write(format_bboxes(bboxes))
@@ -0,0 +1,13 @@
+import numpy as np
+
+# Новое полотно uint8 HWC, заполненное фоном (нулями)
+def new_canvas(canvas_size):
+    return np.zeros((canvas_size, canvas_size, 3), dtype=np.uint8)
+
+# Копирование картинки tile (uint8 HWC) в canvas с левым верхним углом (x, y); выходящая за полотно часть отбрасывается
+def paste_array(canvas, tile, x, y):
+    height, width = tile.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, canvas.shape[1]), min(y + height, canvas.shape[0])
+    if right > left and bottom > top:
+        canvas[top:bottom, left:right] = tile[top - y:bottom - y, left - x:right - x, :3]
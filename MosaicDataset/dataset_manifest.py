@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+
+# Манифест исходных пар набора: для каждой пары (ключ - относительный путь картинки) хранятся пути, размеры и mtime
+# файлов, хэш содержимого, назначенный набор, количества сущностей по классам, имя и формат сохраненного файла.
+# По манифесту check_and_update обрабатывает только новые и измененные пары
+class DatasetManifest:
+    VERSION = 1
+
+    def __init__(self, path, key_mode='mtime'):
+        if key_mode not in ('mtime', 'hash'):
+            raise ValueError(f"Неизвестный режим сравнения файлов: {key_mode}. Доступны: mtime, hash")
+        self.path = path
+        self.key_mode = key_mode
+        self.split_names = None
+        self.split_ratio = None
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            self.split_names = data.get('split_names')
+            self.split_ratio = data.get('split_ratio')
+            self.entries = data.get('entries', {})
+
+    # Ключ пары - путь картинки относительно корня исходников без расширения
+    @staticmethod
+    def make_key(src_directory, img_path):
+        return os.path.splitext(os.path.relpath(img_path, src_directory))[0].replace(os.sep, '/')
+
+    # Имя сохраненного файла пары: путь ключа с '__' вместо '/' и короткий хэш ключа, чтобы разные ключи
+    # (например, a/b__c и a__b/c) не получали одно имя
+    @staticmethod
+    def output_name(key):
+        return f"{key.replace('/', '__')}_{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+
+    # Размеры и mtime файлов пары
+    @staticmethod
+    def stat_pair(img_path, txt_path):
+        stats = [os.stat(path) for path in (img_path, txt_path)]
+        return [stat.st_size for stat in stats], [stat.st_mtime_ns for stat in stats]
+
+    # Хэш содержимого файлов пары
+    @staticmethod
+    def hash_pair(img_path, txt_path):
+        digest = hashlib.sha1()
+        for path in (img_path, txt_path):
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(2**20), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    # Проверка, что пара не изменилась с момента записи в манифест. В режиме 'hash' при изменении mtime
+    # сравнивается содержимое, и для совпавших пар в манифесте обновляется только mtime
+    def is_unchanged(self, key, img_path, txt_path):
+        entry = self.entries.get(key)
+        if entry is None or entry['img'] != img_path or entry['txt'] != txt_path:
+            return False
+        size, mtime = self.stat_pair(img_path, txt_path)
+        if entry['size'] == size and entry['mtime'] == mtime:
+            return True
+        if self.key_mode == 'hash' and entry['size'] == size and entry.get('hash') == self.hash_pair(img_path, txt_path):
+            entry['mtime'] = mtime
+            return True
+        return False
+
+    # Запись о паре, назначенной в набор split и сохраненной под именем output в формате image_format
+    def add(self, key, img_path, txt_path, split, class_counts, output, image_format):
+        size, mtime = self.stat_pair(img_path, txt_path)
+        self.entries[key] = {
+            'img': img_path, 'txt': txt_path, 'size': size, 'mtime': mtime,
+            'hash': self.hash_pair(img_path, txt_path) if self.key_mode == 'hash' else None,
+            'split': split, 'class_counts': {str(class_id): count for class_id, count in class_counts.items()},
+            'output': output, 'image_format': image_format,
+        }
+
+    # Количества сущностей по классам, уже распределенные по наборам: {класс: [количество в каждом наборе]}
+    def assigned_counts(self):
+        counts = {}
+        for entry in self.entries.values():
+            split_idx = self.split_names.index(entry['split'])
+            for class_id, count in entry['class_counts'].items():
+                counts.setdefault(int(class_id), [0] * len(self.split_names))[split_idx] += count
+        return counts
+
+    # Сохранение манифеста (через временный файл, чтобы прерванная запись не портила манифест)
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'version': self.VERSION, 'split_names': self.split_names, 'split_ratio': self.split_ratio,
+                       'entries': self.entries}, file)
+        os.replace(self.path + '.tmp', self.path)
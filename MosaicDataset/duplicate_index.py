@@ -0,0 +1,184 @@
+from PIL import Image
+import os
+import time
+import concurrent.futures
+import numpy as np
+from .pipeline_metrics import PipelineMetrics
+
+# Число единичных битов в каждом значении байта (для расстояния Хэмминга между 64-битными хэшами)
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+# Функция расчета расстояний Хэмминга между 64-битными хэшами a и b (массивы любой формы с трансляцией)
+def hamming_distance(a, b):
+    xor = np.ascontiguousarray(np.atleast_1d(np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=-1, dtype=np.int64)
+
+# Функция расчета перцептивного хэша картинки (dHash, 64 бита) по уменьшенной копии 9x8 в оттенках серого.
+# JPEG декодируется сразу в уменьшенном масштабе (draft), поэтому хэш почти не зависит от размера кадра
+def perceptual_hash(img_path):
+    with Image.open(img_path) as img:
+        img.draft('L', (64, 64))
+        pixels = np.asarray(img.convert('L').resize((9, 8), Image.BOX), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+# Индекс почти одинаковых картинок (соседние кадры видео) по перцептивным хэшам.
+# Поиск в радиусе radius по Хэммингу выполняется мульти-индексным хэшированием: 64 бита делятся на radius + 1 частей,
+# и у хэшей на расстоянии не больше radius хотя бы одна часть совпадает (принцип Дирихле), поэтому
+# кандидаты берутся из radius + 1 таблиц по точному совпадению части, а проверяется только расстояние до кандидатов.
+# deduplicate() отбрасывает повторы, group() назначает номера групп для SplitSubset(groups=...),
+# чтобы группа почти одинаковых кадров целиком попала в один набор. Статистика последнего вызова - в stats
+class DuplicateIndex:
+    def __init__(self, radius=4, num_threads=None, chunk_size=64, metrics=None):
+        if not 0 <= radius < 32:
+            raise ValueError(f"Радиус поиска должен быть от 0 до 31, получено: {radius}")
+        self.radius = radius
+        self.num_threads = num_threads or min(32, 4 * (os.cpu_count() or 1))
+        self.chunk_size = chunk_size  # Сколько картинок хэширует одна задача пула
+        self.metrics = metrics if metrics is not None else PipelineMetrics()  # Метрики этапов PipelineMetrics
+        # Границы частей хэша: radius + 1 частей почти одинаковой ширины
+        bounds = np.linspace(0, 64, radius + 2).astype(np.int64)
+        self._parts = [(int(low), (1 << int(high - low)) - 1) for low, high in zip(bounds[:-1], bounds[1:])]
+        self._hashes = []  # Хэши картинок в индексе (в порядке добавления)
+        self._tables = [{} for _ in self._parts]  # Значение части хэша -> номера хэшей в индексе
+        self.stats = {}
+
+    # Хэши картинок в индексе
+    @property
+    def hashes(self):
+        return np.array(self._hashes, dtype=np.uint64)
+
+    # Значения частей хэша (или массива хэшей) для каждой таблицы
+    def _split_hash(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        return [(hashes >> np.uint64(shift)) & np.uint64(mask) for shift, mask in self._parts]
+
+    # Перцептивные хэши записей (картинки хэшируются параллельно пачками по chunk_size).
+    # Возвращает (хэши uint64, маска успешно прочитанных картинок)
+    def hash_records(self, records):
+        paths = [record.path for record in records]
+        chunks = [paths[i:i + self.chunk_size] for i in range(0, len(paths), self.chunk_size)]
+        hashes = np.zeros(len(paths), dtype=np.uint64)
+        valid = np.zeros(len(paths), dtype=bool)
+        with self.metrics.stage('hash_records', len(paths)), concurrent.futures.ThreadPoolExecutor(self.num_threads) as executor:
+            start = 0
+            for results in executor.map(_hash_chunk, chunks):
+                for offset, value in enumerate(results):
+                    if value is not None:
+                        hashes[start + offset] = value
+                        valid[start + offset] = True
+                start += len(results)
+        failures = int((~valid).sum())
+        if failures:
+            self.metrics.count('hash_failures', failures)
+        return hashes, valid
+
+    # Добавление хэша в индекс, возвращает его номер
+    def add(self, value):
+        idx = len(self._hashes)
+        self._hashes.append(np.uint64(value))
+        for table, part in zip(self._tables, self._split_hash(value)):
+            table.setdefault(int(part), []).append(idx)
+        return idx
+
+    # Номера хэшей индекса на расстоянии не больше radius (по умолчанию радиус индекса) от value
+    def query(self, value, radius=None):
+        radius = self.radius if radius is None else min(radius, self.radius)
+        candidates = set()
+        for table, part in zip(self._tables, self._split_hash(value)):
+            candidates.update(table.get(int(part), ()))
+        if not candidates:
+            return []
+        candidates = sorted(candidates)
+        distances = hamming_distance(value, np.array([self._hashes[idx] for idx in candidates], dtype=np.uint64))
+        return [idx for idx, distance in zip(candidates, distances.tolist()) if distance <= radius]
+
+    # Отбрасывание почти одинаковых картинок: запись остается, если в радиусе от нее нет уже оставленной записи
+    # (записи просматриваются по порядку, поэтому из серии соседних кадров остаются кадры не ближе radius друг к другу).
+    # Картинки, которые не удалось прочитать, остаются. Возвращает список оставленных записей
+    def deduplicate(self, records):
+        start = time.perf_counter()
+        hashes, valid = self.hash_records(records)
+        kept = []
+        with self.metrics.stage('deduplicate', len(records)):
+            for record, value, is_valid in zip(records, hashes, valid):
+                if is_valid:
+                    if self.query(value):
+                        continue
+                    self.add(value)
+                kept.append(record)
+        self._report(len(records), valid, groups=None, dropped=len(records) - len(kept), start=start)
+        return kept
+
+    # Группировка почти одинаковых картинок: записи, связанные цепочкой пар на расстоянии не больше radius,
+    # получают общий номер группы. Возвращает массив номеров групп (int64) в порядке записей
+    def group(self, records, block_size=1024):
+        start = time.perf_counter()
+        hashes, valid = self.hash_records(records)
+        with self.metrics.stage('group_duplicates', len(records)):
+            # Одинаковые хэши объединяются сразу, пары ищутся среди уникальных хэшей внутри корзин каждой таблицы
+            unique, inverse = np.unique(hashes[valid], return_inverse=True)
+            sources, targets = [], []
+            for parts in self._split_hash(unique):
+                order = np.argsort(parts, kind='stable')
+                bounds = np.flatnonzero(np.concatenate(([True], parts[order][1:] != parts[order][:-1], [True])))
+                for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                    members = order[low:high]
+                    # Расстояния внутри корзины считаются блоками строк, чтобы большие корзины не занимали много памяти
+                    for row in range(0, len(members) - 1, block_size):
+                        rows = members[row:row + block_size]
+                        close = hamming_distance(unique[rows][:, None], unique[members][None, :]) <= self.radius
+                        close &= np.arange(len(members))[None, :] > np.arange(row, row + len(rows))[:, None]
+                        row_idx, column_idx = np.nonzero(close)
+                        sources.append(rows[row_idx])
+                        targets.append(members[column_idx])
+            labels = _connected_components(len(unique), np.concatenate(sources or [np.empty(0, dtype=np.int64)]),
+                                           np.concatenate(targets or [np.empty(0, dtype=np.int64)]))
+
+            groups = np.empty(len(records), dtype=np.int64)
+            _, groups[valid] = np.unique(labels[inverse], return_inverse=True)
+            # Непрочитанные картинки образуют отдельные группы
+            next_group = int(groups[valid].max()) + 1 if valid.any() else 0
+            groups[~valid] = next_group + np.arange(int((~valid).sum()))
+        self._report(len(records), valid, groups=groups, dropped=0, start=start)
+        return groups
+
+    # Сбор, печать и передача в метрики статистики поиска повторов
+    def _report(self, total, valid, groups, dropped, start):
+        self.stats = {'records': total, 'hashed': int(valid.sum()), 'hash_failures': int(total - valid.sum()), 'radius': self.radius,
+                      'dropped': dropped, 'seconds': round(time.perf_counter() - start, 4)}
+        if groups is not None:
+            sizes = np.bincount(groups) if len(groups) else np.zeros(0, dtype=np.int64)
+            self.stats.update(groups=len(sizes), duplicate_groups=int((sizes > 1).sum()),
+                              grouped_records=int(sizes[sizes > 1].sum()), largest_group=int(sizes.max(initial=0)))
+            self.metrics.observe('duplicate_groups', self.stats['duplicate_groups'])
+            print(f"Группы почти одинаковых картинок: {self.stats['duplicate_groups']} групп из {self.stats['grouped_records']} картинок "
+                  f"(всего групп: {self.stats['groups']}, самая большая: {self.stats['largest_group']}) за {self.stats['seconds']:.2f} s")
+        else:
+            self.metrics.count('duplicates_dropped', dropped)
+            print(f"Отброшено почти одинаковых картинок: {dropped} из {total} (осталось {total - dropped}) за {self.stats['seconds']:.2f} s")
+
+
+# Компоненты связности графа из count вершин с ребрами (sources[i], targets[i]): номер компоненты - наименьшая вершина.
+# Метки распространяются по ребрам NumPy с сокращением путей до неподвижной точки
+def _connected_components(count, sources, targets):
+    labels = np.arange(count)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, sources, labels[targets])
+        np.minimum.at(new_labels, targets, labels[sources])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+# Хэширование пачки картинок (None для картинок, которые не удалось прочитать)
+def _hash_chunk(paths):
+    results = []
+    for path in paths:
+        try:
+            results.append(perceptual_hash(path))
+        except Exception as e:
+            print(f"Ошибка при хэшировании изображения {path}: {e}")
+            results.append(None)
+    return results
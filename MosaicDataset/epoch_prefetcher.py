@@ -0,0 +1,112 @@
+import queue as queue_module
+import threading
+import multiprocessing
+import numpy as np
+
+# Фоновая сборка мозаик следующей эпохи для MosaicYoloDataset (двойная буферизация).
+# Пока обучается эпоха N, отдельный процесс собирает и аугментирует полотна эпохи N+1 и передает их через очередь
+# глубиной queue_depth; поток основного процесса складывает их в буфер, пока его объем не превысит max_bytes.
+# Полотна, не попавшие в буфер, собираются обычным образом при обращении, поэтому результат не зависит от буфера.
+# Завершение фонового процесса без признака конца эпохи (OOM, сигнал) считается концом сборки
+class EpochPrefetcher:
+    POLL_INTERVAL = 1.0  # Период проверки, что фоновый процесс еще работает, с
+    JOIN_TIMEOUT = 10.0  # Ожидание завершения фонового процесса при остановке, после него процесс завершается принудительно
+
+    def __init__(self, dataset, queue_depth=8, max_bytes=2 * 2**30, start_method=None):
+        self.dataset = dataset
+        self.queue_depth = queue_depth
+        self.max_bytes = max_bytes
+        self._context = multiprocessing.get_context(start_method)
+        self._epoch = None
+        self._process = None
+        self._thread = None
+        self._stop_event = None
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._ready = threading.Event()
+
+    # Запуск фоновой сборки полотен эпохи epoch (предыдущая незавершенная сборка останавливается)
+    def start(self, epoch):
+        self.stop()
+        self._epoch = epoch
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._ready = threading.Event()
+        self._stop_event = self._context.Event()
+        queue = self._context.Queue(maxsize=self.queue_depth)
+        self._process = self._context.Process(target=_prefetch_epoch, args=(self.dataset, epoch, queue, self._stop_event), daemon=True)
+        self._process.start()
+        self._thread = threading.Thread(target=self._drain, args=(queue, self._process, self._buffer, self._ready), daemon=True)
+        self._thread.start()
+
+    # Перенос готовых полотен из очереди в буфер с учетом ограничения памяти
+    def _drain(self, queue, process, buffer, ready):
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=self.POLL_INTERVAL)
+                except queue_module.Empty:
+                    if process.is_alive():
+                        continue
+                    print(f"Процесс фоновой сборки мозаик завершился без окончания эпохи (код {process.exitcode})")
+                    break
+                if item is None:
+                    break
+                idx, pixels, bboxes = item
+                if self._buffer_bytes + pixels.nbytes > self.max_bytes:
+                    # Буфер заполнен: остальные полотна эпохи будут собраны при обращении
+                    self._stop_event.set()
+                    continue
+                if buffer is self._buffer:
+                    buffer[idx] = (pixels, bboxes)
+                    self._buffer_bytes += pixels.nbytes
+        except (EOFError, OSError) as e:
+            print(f"Фоновая сборка мозаик прервана: {e}")
+        finally:
+            ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    # Готовые полотна эпохи epoch: {индекс полотна: (пиксели uint8 HWC, bbox)}.
+    # wait=False не ждет завершения фоновой сборки: незавершенная сборка останавливается, собранное отдается сразу
+    def take(self, epoch, wait=False):
+        if self._epoch != epoch:
+            return {}
+        if wait:
+            self._ready.wait()
+        buffer = self._buffer
+        self.stop()
+        return buffer
+
+    # Остановка фоновой сборки
+    def stop(self):
+        if self._process is not None:
+            self._stop_event.set()
+            self._buffer = {}  # Поток-обработчик больше не дополняет отданный буфер
+            self._thread.join()
+            self._process.join(self.JOIN_TIMEOUT)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+            self._process = None
+            self._thread = None
+        self._epoch = None
+
+    close = stop
+
+
+# Сборка полотен эпохи в фоновом процессе: полотна передаются по одному в порядке индексов
+def _prefetch_epoch(dataset, epoch, queue, stop_event):
+    try:
+        dataset.set_epoch(epoch)
+        for idx in range(len(dataset)):
+            if stop_event.is_set():
+                break
+            image, bboxes = dataset[idx]
+            queue.put((idx, np.asarray(image), bboxes))
+    except Exception as e:
+        print(f"Ошибка фоновой сборки мозаик эпохи {epoch}: {e}")
+    finally:
+        queue.put(None)
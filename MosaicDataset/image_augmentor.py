@@ -1,73 +1,257 @@
 from PIL import Image
-import albumentations as A
 import numpy as np
+import os
+import random
 import concurrent.futures
+from collections import deque
+from multiprocessing import shared_memory
 from tqdm import tqdm
+from .image_record import ImageRecord
+from .bbox_array import to_bbox_array, split_labels, join_labels, clip_bboxes
+from .utility_functions import bounded_map
+from .pipeline_metrics import PipelineMetrics
+
+# Набор аугментаций по умолчанию. albumentations (и OpenCV) загружается только при его создании,
+# поэтому импорт пакета и сборка мозаик без аугментаций обходятся без них
+def default_augmentations():
+    import albumentations as A
+    return A.Compose([
+            A.RandomCropFromBorders(p=0.33, crop_left=0.05, crop_right=0.05, crop_top=0.05, crop_bottom=0.05),
+            A.Rotate(p=0.33, limit=7, interpolation=0, border_mode=4),
+            A.ShiftScaleRotate(p=0.33, shift_limit_x=0.05, shift_limit_y=0.05, scale_limit=0.1, rotate_limit=0, interpolation=0, border_mode=4),
+            A.HorizontalFlip(p=0.4),
+            A.RGBShift(p=0.33, r_shift_limit=(-20, 20), g_shift_limit=(-20, 20), b_shift_limit=(-20, 20)),
+            A.RandomBrightnessContrast(p=0.33),
+            A.CLAHE(p=0.33, clip_limit=(1, 4), tile_grid_size=(8, 8)),
+            A.GaussNoise(p=0.33, var_limit=(10.0, 50.0), per_channel=True, mean=0.0),
+#            A.ElasticTransform(p=0.25, alpha=1, sigma=20, alpha_affine=20), # Эластичные трансформации для деформации изображения
+#            A.OpticalDistortion(p=0.25, distort_limit=0.02, shift_limit=0.02), # Оптическое искажение
+            A.CoarseDropout(p=0.33, max_holes=8, max_height=8, max_width=8) # Создает случайные пропущенные пиксели
+    ], 
+    bbox_params=A.BboxParams(format='yolo', label_fields=['class_labels'])
+    )
+
+# Зерно аугментаций из целых чисел (seed набора, вид элемента, номер и т.п.; None считается нулем).
+# В отличие от hash() от строк, не зависит от PYTHONHASHSEED, поэтому одинаково во всех процессах и запусках
+def derive_seed(*values):
+    return int(np.random.SeedSequence([0 if value is None else int(value) for value in values]).generate_state(1)[0])
 
 # Класс аугментации пар картинка-аннотации на базе библиотеки albumentations
 class ImageAugmentor:
-    def __init__(self):
-        self.augmentations = A.Compose([
-                A.RandomCropFromBorders(p=0.33, crop_left=0.05, crop_right=0.05, crop_top=0.05, crop_bottom=0.05),
-                A.Rotate(p=0.33, limit=7, interpolation=0, border_mode=4),
-                A.ShiftScaleRotate(p=0.33, shift_limit_x=0.05, shift_limit_y=0.05, scale_limit=0.1, rotate_limit=0, interpolation=0, border_mode=4),
-                A.HorizontalFlip(p=0.4),
-                A.RGBShift(p=0.33, r_shift_limit=(-20, 20), g_shift_limit=(-20, 20), b_shift_limit=(-20, 20)),
-                A.RandomBrightnessContrast(p=0.33),
-                A.CLAHE(p=0.33, clip_limit=(1, 4), tile_grid_size=(8, 8)),
-                A.GaussNoise(p=0.33, var_limit=(10.0, 50.0), per_channel=True, mean=0.0),
-#                A.ElasticTransform(p=0.25, alpha=1, sigma=20, alpha_affine=20), # Эластичные трансформации для деформации изображения
-#                A.OpticalDistortion(p=0.25, distort_limit=0.02, shift_limit=0.02), # Оптическое искажение
-                A.CoarseDropout(p=0.33, max_holes=8, max_height=8, max_width=8) # Создает случайные пропущенные пиксели
-        ], 
-        bbox_params=A.BboxParams(format='yolo', label_fields=['class_labels'])
-        )
+    # backend: 'thread' (пул потоков) или 'process' (пул процессов с передачей пикселей через shared memory).
+    # metrics (PipelineMetrics) собирает время аугментации, число отказов аугментаций и глубину очереди пачек
+    def __init__(self, backend='thread', num_workers=None, chunk_size=16, augmentations=None, metrics=None):
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"Неизвестный backend аугментации: {backend}. Доступны: thread, process")
+        self.backend = backend
+        self.num_workers = num_workers or os.cpu_count()
+        self.chunk_size = chunk_size  # Количество картинок в одной задаче пула процессов
+        self._executor = None
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.augmentations = augmentations if augmentations is not None else default_augmentations()
+
+    # Переинициализация генераторов случайных чисел аугментаций (глобальных и собственного генератора A.Compose)
+    def reseed(self, seed):
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        if hasattr(self.augmentations, 'set_random_seed'):
+            self.augmentations.set_random_seed(seed % 2**32)
+
+    # Пул создается один раз и переиспользуется между вызовами
+    def _get_executor(self):
+        if self._executor is None:
+            if self.backend == 'process':
+                # Каждый процесс получает A.Compose один раз при старте
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.num_workers, initializer=_init_worker, initargs=(self.augmentations,))
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers)
+        return self._executor
+
+    # Остановка пула потоков или процессов
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
         
     # Применение аугментаций к изображению, bbox
     def _apply_augmentations(self, image, bboxes, class_labels):
         try:
             augmented = self.augmentations(image=image, bboxes=bboxes, class_labels=class_labels)
-            return augmented['image'], augmented['bboxes']
+            # Часть рамок может быть отброшена аугментациями, поэтому метки берутся из результата
+            return augmented['image'], augmented['bboxes'], augmented['class_labels']
         except Exception as e:
-            return image, bboxes
+            # Картинка остается без аугментаций, отказ учитывается в метриках
+            self.metrics.count('augmentation_fallbacks')
+            return image, bboxes, class_labels
 
-    # Метод для коррекции BBox-ов после аугментации
+    # Метод для коррекции BBox-ов после аугментации: метка класса возвращается в первый столбец
     def _correct_bboxes(self, class_labels, transformed_bboxes):
-        corrected_bboxes = []
-        for bbox, label in zip(transformed_bboxes, class_labels):
-            # Переставляем метку класса на первое место в списке
-            corrected_bbox = [label] + list(bbox)
-            corrected_bboxes.append(corrected_bbox)
-        return corrected_bboxes
-
-    # Функция для аугментации одного изображения
-    def _augment_single_image(self, img_with_bbox):
-        img, bboxes = img_with_bbox
-        img_array = np.array(img)  # Конвертируем PIL.Image в numpy array
-
-        # Извлечение class_labels из bboxes
-        class_labels = [bbox[0] for bbox in bboxes]
-        bboxes_without_labels = [bbox[1:] for bbox in bboxes]
+        return join_labels(class_labels, transformed_bboxes)
+
+    # Функция аугментации массива пикселей и аннотаций
+    def _augment_array(self, img_array, bboxes):
+        # Извлечение class_labels из bboxes. Рамки обрезаются по границам картинки, иначе albumentations их отвергает
+        class_labels, bboxes_without_labels = split_labels(clip_bboxes(to_bbox_array(bboxes)))
 
         # Применение аугментаций
-        transformed_img, transformed_bboxes = self._apply_augmentations(
+        transformed_img, transformed_bboxes, class_labels = self._apply_augmentations(
             img_array, bboxes_without_labels, class_labels)
-              
-        # Конвертируем обратно в PIL.Image после аугментаций
-        transformed_img = Image.fromarray(transformed_img)
 
         # Коррекции bboxes
-        corrected_bboxes = self._correct_bboxes(class_labels, transformed_bboxes)
-        
-        return (transformed_img, corrected_bboxes)
+        return transformed_img, self._correct_bboxes(class_labels, transformed_bboxes)
+
+    # Функция для аугментации одного изображения (пары картинка-аннотации или записи ImageRecord).
+    # as_array=True возвращает массив uint8 HWC без обратного преобразования в PIL.Image
+    def _augment_single_image(self, img_with_bbox, as_array=False):
+        if isinstance(img_with_bbox, ImageRecord):
+            # Пиксели записи декодируются только на время аугментации
+            img, bboxes = img_with_bbox.load(), img_with_bbox.bboxes
+        else:
+            img, bboxes = img_with_bbox
+        img_array = np.asarray(img)  # Конвертируем PIL.Image в numpy array
+
+        transformed_img, corrected_bboxes = self._augment_array(img_array, bboxes)
+
+        if as_array:
+            return np.ascontiguousarray(transformed_img, dtype=np.uint8), corrected_bboxes
+        # Конвертируем обратно в PIL.Image после аугментаций
+        return (Image.fromarray(transformed_img), corrected_bboxes)
+
+    # Аугментация пачки картинок в пуле процессов. Пиксели передаются через один блок shared memory на пачку:
+    # входная картинка копируется в свой слот, процесс пишет результат в тот же слот
+    def _submit_shared_chunk(self, executor, chunk):
+        slots = []
+        offset = 0
+        for item in chunk:
+            if isinstance(item, ImageRecord):
+                # Запись декодируется в процессе-обработчике, в блок пишется только результат
+                img_array, shape = None, (item.height, item.width, 3)
+            else:
+                img_array = np.asarray(item[0])
+                shape = img_array.shape
+            slots.append((offset, shape, img_array))
+            offset += int(np.prod(shape))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        tasks = []
+        for item, (slot_offset, shape, img_array) in zip(chunk, slots):
+            if img_array is not None:
+                np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot_offset)[...] = img_array
+                tasks.append((slot_offset, shape, None, item[1]))
+            else:
+                tasks.append((slot_offset, shape, item, None))
+        return shm, executor.submit(_augment_shared_chunk, shm.name, tasks)
+
+    # Сборка результатов пачки из shared memory
+    def _collect_shared_chunk(self, shm, future, as_array=False):
+        try:
+            results = []
+            chunk_results, fallbacks = future.result()
+            if fallbacks:
+                self.metrics.count('augmentation_fallbacks', fallbacks)
+            for slot_offset, shape, pickled_array, bboxes in chunk_results:
+                if pickled_array is not None:
+                    img_array = pickled_array
+                else:
+                    img_array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot_offset).copy()
+                results.append((img_array if as_array else Image.fromarray(img_array), bboxes))
+            return results
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # Генератор аугментированных пар в исходном порядке с ограниченным числом задач в работе.
+    # as_array=True выдает картинки массивами uint8 HWC
+    def augment_iter(self, images_with_bboxes, as_array=False):
+        with self.metrics.stage('augment') as stage:
+            for item in self._augment_iter(images_with_bboxes, as_array):
+                stage.add()
+                yield item
+
+    def _augment_iter(self, images_with_bboxes, as_array=False):
+        executor = self._get_executor()
+        if self.backend == 'thread':
+            yield from bounded_map(executor, lambda item: self._augment_single_image(item, as_array), images_with_bboxes, 2 * self.num_workers)
+            return
+
+        pending = deque()
+        chunk = []
+        for item in images_with_bboxes:
+            chunk.append(item)
+            if len(chunk) == self.chunk_size:
+                pending.append(self._submit_shared_chunk(executor, chunk))
+                self.metrics.observe('augment_pending_chunks', len(pending))
+                chunk = []
+                # Ограничиваем объем пикселей в shared memory: не больше двух пачек на процесс
+                while len(pending) > 2 * self.num_workers:
+                    yield from self._collect_shared_chunk(*pending.popleft(), as_array)
+        if chunk:
+            pending.append(self._submit_shared_chunk(executor, chunk))
+        while pending:
+            yield from self._collect_shared_chunk(*pending.popleft(), as_array)
 
     # Основная функция аугментации всех доступных пар картинка-аннотации
     def augment_images(self, images_with_bboxes):
         if not self.augmentations:  # Проверяем, есть ли аугментации
             return images_with_bboxes  # Возвращаем изображения без изменений, если аугментаций нет
 
-        # Использование многопоточности для аугментации изображений
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(tqdm(executor.map(self._augment_single_image, images_with_bboxes), total=len(images_with_bboxes), desc="Аугментация исходных фото", unit=" images"))
+        # Использование пула потоков или процессов для аугментации изображений
+        return list(tqdm(self.augment_iter(images_with_bboxes), total=len(images_with_bboxes), desc="Аугментация исходных фото", unit=" images"))
+
+
+# Аугментатор процесса-обработчика, создается один раз при старте процесса
+_worker_augmentor = None
+
+# Инициализация процесса-обработчика пула аугментации
+def _init_worker(augmentations):
+    global _worker_augmentor
+    _worker_augmentor = ImageAugmentor(backend='thread', num_workers=1, augmentations=augmentations)
+    # Процессы, запущенные через fork, наследуют состояние генераторов случайных чисел - переинициализируем его
+    _worker_augmentor.reseed(int.from_bytes(os.urandom(4), 'little'))
+
+# Подключение к блоку shared memory без регистрации в resource_tracker (блоком владеет родительский процесс)
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
 
-        return results
\ No newline at end of file
+# Аугментация пачки картинок внутри процесса-обработчика
+def _augment_shared_chunk(shm_name, tasks):
+    shm = _attach_shared_memory(shm_name)
+    results = []
+    # Отказы аугментаций в процессе-обработчике возвращаются вместе с результатами пачки
+    fallbacks = _worker_augmentor.metrics.counters.get('augmentation_fallbacks', 0)
+    try:
+        for slot_offset, shape, record, bboxes in tasks:
+            slot = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot_offset)
+            if record is not None:
+                img_array, bboxes = np.asarray(record.load()), record.bboxes
+            else:
+                img_array = slot.copy()  # Копия: результат пишется в тот же слот
+            transformed_img, corrected_bboxes = _worker_augmentor._augment_array(img_array, bboxes)
+            transformed_img = np.ascontiguousarray(transformed_img, dtype=np.uint8)
+            if transformed_img.nbytes <= slot.nbytes:
+                out = np.ndarray(transformed_img.shape, dtype=np.uint8, buffer=shm.buf, offset=slot_offset)
+                out[...] = transformed_img
+                results.append((slot_offset, transformed_img.shape, None, corrected_bboxes))
+                del out
+            else:
+                # Результат больше исходного слота (например, при паддинге) - передаем его обычным pickle
+                results.append((slot_offset, transformed_img.shape, transformed_img, corrected_bboxes))
+            del slot
+    finally:
+        shm.close()
+    return results, _worker_augmentor.metrics.counters.get('augmentation_fallbacks', 0) - fallbacks
\ No newline at end of file
@@ -0,0 +1,135 @@
+from PIL import Image
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+from .label_store import LabelStore
+
+# Поддерживаемые расширения исходных изображений
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+# Режимы декодирования: коэффициент запаса reducing_gap для уменьшенного декодирования.
+# JPEG декодируется libjpeg сразу в масштабе 1/2, 1/4 или 1/8 (draft) не меньше размера записи * gap,
+# остальные форматы сначала уменьшаются целочисленным box-фильтром, затем досчитываются LANCZOS.
+# 'exact' - полное декодирование и LANCZOS (максимальное качество), 'balanced' - как Image.thumbnail,
+# 'fast' - ближайший масштаб не меньше размера записи (максимальная скорость)
+DECODE_MODES = {'exact': None, 'balanced': 2.0, 'fast': 1.0}
+
+# Функция расчета размера картинки, вписанной в квадрат max_size с сохранением пропорций (аналог Image.thumbnail)
+def fit_size(width, height, max_size):
+    if width <= max_size and height <= max_size:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    x, y = max_size, max_size
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+# Компактная запись об исходной картинке: путь, итоговый размер и аннотации без декодированных пикселей.
+# При заданном cache (SourceCache) подготовленные пиксели берутся из постоянного кэша по ключу cache_key
+class ImageRecord:
+    __slots__ = ('path', 'width', 'height', 'bboxes', 'cache', 'cache_key', 'decode_mode')
+
+    def __init__(self, path, width, height, bboxes, cache=None, cache_key=None, decode_mode='balanced'):
+        if decode_mode not in DECODE_MODES:
+            raise ValueError(f"Неизвестный режим декодирования: {decode_mode}. Доступны: {', '.join(DECODE_MODES)}")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.bboxes = bboxes
+        self.cache = cache
+        self.cache_key = cache_key
+        self.decode_mode = decode_mode
+
+    # Создание записи по паре файлов. Из картинки читается только заголовок. Разметка разбирается и проверяется
+    # LabelStore (ошибочные строки отбрасываются); bboxes - заранее загруженные аннотации (например, LabelStore.load)
+    @classmethod
+    def from_files(cls, img_path, txt_path, max_size=None, decode_mode='balanced', bboxes=None):
+        with Image.open(img_path) as img:
+            width, height = img.size
+        if max_size:
+            width, height = fit_size(width, height, max_size)
+        if bboxes is None:
+            bboxes, errors = LabelStore().load_file(txt_path)
+            if errors:
+                print(f"Ошибки в файле аннотаций {txt_path}: " + '; '.join(f"строка {line}: {message}" for line, _, message in errors))
+        return cls(img_path, width, height, bboxes, decode_mode=decode_mode)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    # Декодирование пикселей картинки с подгонкой под размер записи
+    def load(self):
+        if self.cache is not None:
+            pixels = self.cache.get(self.cache_key)
+            if pixels is not None and pixels.shape[:2] == (self.height, self.width):
+                return Image.fromarray(pixels)
+            img = self._decode()
+            self.cache.put(self.cache_key, np.asarray(img), self.bboxes)
+            return img
+        return self._decode()
+
+    def _decode(self):
+        reducing_gap = DECODE_MODES[self.decode_mode]
+        with Image.open(self.path) as img:
+            if reducing_gap is not None and img.size != self.size:
+                # Для JPEG выбирается масштаб DCT не меньше запрошенного размера, для других форматов вызов ничего не делает
+                img.draft('RGB', (int(self.width * reducing_gap), int(self.height * reducing_gap)))
+            img.load()
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+        if img.size != self.size:
+            img = img.resize(self.size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+        return img
+
+    def __repr__(self):
+        return f"ImageRecord({self.path!r}, {self.width}x{self.height}, bboxes={len(self.bboxes)})"
+
+
+# Запись о фрагменте большой картинки: crop - окно (left, top, right, bottom) в пикселях исходной картинки,
+# bboxes - аннотации в координатах фрагмента. Пиксели вырезаются при декодировании без масштабирования.
+# source - запись исходной картинки: целиком картинка декодируется ее _decode (файл или, например, шард ShardRecord)
+class TileRecord(ImageRecord):
+    __slots__ = ('crop', 'source')
+
+    def __init__(self, path, crop, bboxes, cache=None, cache_key=None, source=None):
+        left, top, right, bottom = (int(value) for value in crop)
+        super().__init__(path, right - left, bottom - top, bboxes, cache, cache_key, 'exact')
+        self.crop = (left, top, right, bottom)
+        self.source = source
+
+    def _decode(self):
+        return _decode_full(self.path, self.source).crop(self.crop)
+
+    def __repr__(self):
+        return f"TileRecord({self.path!r}, crop={self.crop}, bboxes={len(self.bboxes)})"
+
+
+# Последние декодированные целиком картинки: соседние фрагменты одной картинки декодируют ее один раз
+_full_images = OrderedDict()
+_full_images_lock = threading.Lock()
+
+def _decode_full(path, source=None, max_images=2):
+    with _full_images_lock:
+        image = _full_images.get(path)
+        if image is not None:
+            _full_images.move_to_end(path)
+            return image
+    if source is not None:
+        image = source._decode()
+    else:
+        with Image.open(path) as img:
+            img.load()
+            image = img if img.mode == 'RGB' else img.convert('RGB')
+    with _full_images_lock:
+        _full_images[path] = image
+        while len(_full_images) > max_images:
+            _full_images.popitem(last=False)
+    return image
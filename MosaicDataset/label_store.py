@@ -0,0 +1,214 @@
+import os
+import time
+import concurrent.futures
+import numpy as np
+
+# Допуск при проверке нормализованных координат (ошибки округления при экспорте разметки)
+COORD_TOLERANCE = 1e-6
+
+# Массовая загрузка файлов разметки YOLO: файлы читаются и разбираются параллельно в один массив (M, 5) float32
+# и смещения (N + 1,) int64, аннотации i-го файла - values[offsets[i]:offsets[i + 1]].
+# Строки с ошибками не попадают в результат и описываются в errors: {'path', 'line', 'kind', 'message'},
+# kind - 'read' (файл не прочитан), 'format' (не 5 чисел в строке), 'class_id' (не целый, отрицательный
+# или не меньше num_classes класс), 'coordinates' (координаты вне [0, 1] или нулевой размер рамки).
+# При заданном cache_path результат сохраняется одним бинарным файлом, и при повторной загрузке
+# разбираются только файлы, размер или mtime которых изменился
+class LabelStore:
+    VERSION = 1
+
+    def __init__(self, cache_path=None, num_classes=None, num_threads=None, chunk_size=256):
+        self.cache_path = cache_path
+        self.num_classes = num_classes
+        self.num_threads = num_threads or min(32, 4 * (os.cpu_count() or 1))
+        self.chunk_size = chunk_size  # Сколько файлов разбирает одна задача пула
+        self.errors = []  # Ошибки последней загрузки
+        self.last_load = {}  # Статистика последней загрузки: время, число файлов, разобранных заново, аннотаций и ошибок
+
+    # Загрузка разметки файлов txt_paths. Возвращает (values, offsets)
+    def load(self, txt_paths):
+        start = time.perf_counter()
+        txt_paths = [os.path.abspath(path) for path in txt_paths]
+        chunks = [txt_paths[i:i + self.chunk_size] for i in range(0, len(txt_paths), self.chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(self.num_threads) as executor:
+            # Размеры и mtime нужны только для проверки актуальности кэша
+            cached = self._load_cache()
+            if self.cache_path:
+                stats = np.array([stat for chunk in executor.map(_stat_files, chunks) for stat in chunk], dtype=np.int64).reshape(-1, 2)
+
+            # Файлы, не изменившиеся с момента сохранения кэша, берутся из него
+            labels = [None] * len(txt_paths)
+            errors = [None] * len(txt_paths)
+            if cached is not None:
+                cached_idx = {path: idx for idx, path in enumerate(cached['paths'].tolist())}
+                old = np.fromiter((cached_idx.get(path, -1) for path in txt_paths), dtype=np.int64, count=len(txt_paths))
+                valid = (old >= 0) & (stats[:, 1] >= 0)
+                valid[valid] = (cached['stats'][old[valid]] == stats[valid]).all(axis=1)
+                offsets = cached['offsets']
+                for idx, old_idx in zip(np.flatnonzero(valid).tolist(), old[valid].tolist()):
+                    labels[idx] = cached['values'][offsets[old_idx]:offsets[old_idx + 1]]
+                    errors[idx] = cached['errors'].get(old_idx, [])
+
+            # Остальные файлы разбираются параллельно пачками по chunk_size
+            pending = [idx for idx, value in enumerate(labels) if value is None]
+            chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+            for chunk, results in zip(chunks, executor.map(lambda chunk: self._load_chunk([txt_paths[idx] for idx in chunk]), chunks)):
+                for idx, (bboxes, _, file_errors) in zip(chunk, results):
+                    labels[idx] = bboxes
+                    errors[idx] = file_errors
+
+        counts = np.fromiter((len(bboxes) for bboxes in labels), dtype=np.int64, count=len(labels))
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        values = np.concatenate(labels).astype(np.float32, copy=False) if labels else np.empty((0, 5), dtype=np.float32)
+
+        self.errors = [{'path': txt_paths[idx], 'line': line, 'kind': kind, 'message': message}
+                       for idx, file_errors in enumerate(errors) for line, kind, message in file_errors]
+        if self.cache_path and (pending or cached is None or len(cached['paths']) != len(txt_paths)):
+            self._save_cache(txt_paths, stats, values, offsets, errors)
+        self.last_load = {'seconds': round(time.perf_counter() - start, 4), 'files': len(txt_paths), 'parsed': len(pending),
+                          'bboxes': len(values), 'errors': len(self.errors)}
+        if self.errors:
+            report = self.error_report()
+            print(f"Ошибки в файлах разметки: {report['errors']} в {report['files_with_errors']} файлах ({report['by_kind']}), "
+                  f"например {self.errors[0]['path']}:{self.errors[0]['line']}: {self.errors[0]['message']}")
+        return values, offsets
+
+    # Разбор и проверка одного файла разметки: (массив (N, 5) float32 без ошибочных строк, [(строка, вид, сообщение)])
+    def load_file(self, txt_path):
+        bboxes, _, errors = self._load_chunk([txt_path])[0]
+        return bboxes, errors
+
+    # Чтение пачки файлов и их разбор одним проходом: [(массив (N, 5) float32, [(строка, вид, сообщение)])] для каждого файла
+    def _load_chunk(self, txt_paths):
+        texts, read_errors = [], {}
+        for idx, txt_path in enumerate(txt_paths):
+            try:
+                with open(txt_path, 'rb') as file:
+                    texts.append(file.read())
+            except OSError as e:
+                texts.append(b'')
+                read_errors[idx] = [(0, 'read', str(e))]
+        values, counts, errors = parse_label_chunk(texts, self.num_classes)
+        file_errors = read_errors
+        for file_idx, line, kind, message in errors:
+            file_errors.setdefault(file_idx, []).append((line, kind, message))
+        return [(bboxes, counts[idx], file_errors.get(idx, [])) for idx, bboxes in enumerate(np.split(values, np.cumsum(counts)[:-1]))]
+
+    # Сводный отчет об ошибках последней загрузки
+    def error_report(self):
+        by_kind = {}
+        for error in self.errors:
+            by_kind[error['kind']] = by_kind.get(error['kind'], 0) + 1
+        return {'files': self.last_load.get('files', 0), 'files_with_errors': len({error['path'] for error in self.errors}),
+                'errors': len(self.errors), 'by_kind': by_kind, 'details': self.errors}
+
+    # Чтение кэша одним файлом. Кэш другой версии или с другим num_classes не используется
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with np.load(self.cache_path) as data:
+                if int(data['version']) != self.VERSION or int(data['num_classes']) != (self.num_classes or -1):
+                    return None
+                errors = {}
+                for file_idx, line, kind, message in zip(data['error_files'].tolist(), data['error_lines'].tolist(),
+                                                         data['error_kinds'].tolist(), data['error_messages'].tolist()):
+                    errors.setdefault(file_idx, []).append((line, kind, message))
+                return {'paths': data['paths'], 'stats': data['stats'], 'values': data['values'], 'offsets': data['offsets'], 'errors': errors}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Кэш разметки {self.cache_path} не прочитан, файлы будут разобраны заново: {e}")
+            return None
+
+    # Сохранение кэша через временный файл, чтобы прерванная запись не портила кэш
+    def _save_cache(self, txt_paths, stats, values, offsets, errors):
+        flat = [(idx, line, kind, message) for idx, file_errors in enumerate(errors) for line, kind, message in file_errors]
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        with open(self.cache_path + '.tmp', 'wb') as file:
+            np.savez(file, version=self.VERSION, num_classes=self.num_classes or -1, paths=np.array(txt_paths, dtype=str),
+                     stats=stats, values=values, offsets=offsets,
+                     error_files=np.array([e[0] for e in flat], dtype=np.int64), error_lines=np.array([e[1] for e in flat], dtype=np.int64),
+                     error_kinds=np.array([e[2] for e in flat], dtype=str), error_messages=np.array([e[3] for e in flat], dtype=str))
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+
+# Размеры и mtime файлов ((-1, -1), если файл недоступен: такой файл всегда разбирается заново)
+def _stat_files(paths):
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            stats.append((-1, -1))
+    return stats
+
+# Байтовые коды пробельных символов (как у bytes.split())
+_WHITESPACE = np.array([9, 10, 11, 12, 13, 32], dtype=np.uint8)
+
+# Функция разбора текстов нескольких файлов разметки YOLO (bytes) одним проходом NumPy с проверкой классов и координат.
+# Возвращает (массив (M, 5) float32 без ошибочных строк, число аннотаций каждого файла, [(файл, строка, вид, сообщение)])
+def parse_label_chunk(texts, num_classes=None):
+    # Файлы склеиваются построчно; номер первой строки каждого файла нужен для отчета об ошибках
+    file_lines = np.fromiter((text.count(b'\n') + 1 for text in texts), dtype=np.int64, count=len(texts))
+    first_line = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(file_lines, out=first_line[1:])
+    data = b'\n'.join(texts) + b'\n'
+
+    # Начала токенов и номера их строк; в корректной строке ровно 5 токенов, пустые строки пропускаются
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    newline = buffer == 10
+    space = np.isin(buffer, _WHITESPACE)
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    token_line = np.cumsum(newline)[starts]
+    tokens_per_line = np.bincount(token_line, minlength=int(first_line[-1]))
+    tokens = data.split()
+    try:
+        values = np.array(tokens, dtype=np.float32)
+        bad_tokens = None
+    except ValueError:
+        # Есть нечисловые значения: они разбираются по одному, строки с ними отбрасываются
+        values = np.zeros(len(tokens), dtype=np.float32)
+        bad_tokens = {}
+        for idx, token in enumerate(tokens):
+            try:
+                values[idx] = float(token)
+            except ValueError as e:
+                bad_tokens.setdefault(int(token_line[idx]), str(e))
+
+    line_errors = [(int(line), 'format', f"ожидается 5 значений, получено {count}")
+                   for line, count in zip(*np.unique(token_line[tokens_per_line[token_line] != 5], return_counts=True))]
+    good_line = tokens_per_line == 5
+    if bad_tokens:
+        line_errors += [(line, 'format', message) for line, message in bad_tokens.items() if good_line[line]]
+        good_line[list(bad_tokens)] = False
+    token_ok = good_line[token_line]
+    values = values[token_ok].reshape(-1, 5)
+    row_line = token_line[token_ok][::5]
+
+    # Проверка классов и координат сразу для всех строк
+    class_ids = values[:, 0]
+    bad_class = ~np.isfinite(class_ids) | (class_ids < 0) | (class_ids != np.round(class_ids))
+    if num_classes is not None:
+        bad_class |= class_ids >= num_classes
+    coords = values[:, 1:]
+    bad_coords = ~np.isfinite(coords).all(axis=1) | (coords < -COORD_TOLERANCE).any(axis=1) | (coords > 1 + COORD_TOLERANCE).any(axis=1)
+    bad_coords |= (values[:, 3:5] <= 0).any(axis=1)
+    bad_coords &= ~bad_class
+    line_errors += [(int(row_line[row]), 'class_id', f"недопустимый класс {class_ids[row]:g}") for row in np.flatnonzero(bad_class)]
+    line_errors += [(int(row_line[row]), 'coordinates', f"координаты вне [0, 1] или нулевой размер: {coords[row].tolist()}")
+                    for row in np.flatnonzero(bad_coords)]
+
+    keep = ~(bad_class | bad_coords)
+    if not keep.all():
+        values, row_line = values[keep], row_line[keep]
+    counts = np.bincount(np.searchsorted(first_line, row_line, side='right') - 1, minlength=len(texts))
+    errors = []
+    for line, kind, message in sorted(line_errors):
+        file_idx = int(np.searchsorted(first_line, line, side='right')) - 1
+        errors.append((file_idx, line - int(first_line[file_idx]) + 1, kind, message))
+    return values, counts, errors
+
+# Функция разбора и проверки текста одного файла разметки: (массив (N, 5) float32, [(строка, вид, сообщение)])
+def parse_labels(text, num_classes=None):
+    values, _, errors = parse_label_chunk([text.encode() if isinstance(text, str) else text], num_classes)
+    return values, [error[1:] for error in errors]
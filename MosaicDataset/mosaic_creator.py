@@ -1,282 +1,374 @@
-from PIL import Image, ImageDraw
+from PIL import Image
 import os
+import random
+import hashlib
+import itertools
 import numpy as np
 from tqdm import tqdm
 import concurrent.futures
+from collections import deque
+from .image_record import ImageRecord, TileRecord, fit_size
+from .bbox_array import shift_bboxes, tile_windows, crop_bboxes
+from .mosaic_writer import draw_bboxes
+from .mosaic_packer import get_packer, shard_indices
+from .mosaic_plan import MosaicPlan
+from .image_augmentor import derive_seed
+from .source_index import SourceIndex
+from .label_store import LabelStore
+from .canvas_array import new_canvas, paste_array
+from .utility_functions import bounded_map
+from .pipeline_metrics import PipelineMetrics
 
 # Класс построения набора аннотированных мозаик    
 class MosaicCreator:
-    def __init__(self, canvas_size=640, min_image_size=40, large_image_threshold=512, process_large_images=False):
+    def __init__(self, canvas_size=640, min_image_size=40, large_image_threshold=512, process_large_images=False, packer='skyline', packing_window=None, cache=None, decode_mode='balanced', metrics=None,
+                 tile_large_images=False, tile_size=None, tile_overlap=0.2, min_visible=0.3, label_cache=None, num_classes=None):
         self.canvas_size = canvas_size
         self.min_image_size = min_image_size
         self.large_image_threshold = large_image_threshold
         self.process_large_images = process_large_images
-
-    # Функция для отрисовки bbox на исходном изображении
+        self.packer = get_packer(packer, canvas_size)  # Упаковщик картинок по полотнам: 'skyline', 'maxrects' или экземпляр MosaicPacker
+        self.packing_window = packing_window  # Сколько картинок упаковщик видит одновременно (None - все)
+        self.fill_ratios = []  # Доля заполнения каждого полотна последней сборки мозаик
+        self.cache = cache  # Постоянный кэш подготовленных исходников SourceCache (None - без кэша)
+        self.decode_mode = decode_mode  # Режим уменьшенного декодирования: 'exact', 'balanced' или 'fast' (см. DECODE_MODES)
+        self.metrics = metrics if metrics is not None else PipelineMetrics()  # Метрики этапов PipelineMetrics
+        # Нарезка больших картинок на перекрывающиеся фрагменты tile_size (по умолчанию canvas_size) вместо уменьшения.
+        # Рамки фрагмента, видимые меньше чем на min_visible площади, отбрасываются
+        self.tile_large_images = tile_large_images
+        self.tile_size = min(tile_size or canvas_size, canvas_size)
+        self.tile_overlap = tile_overlap
+        self.min_visible = min_visible
+        # Массовая загрузка разметки с проверкой классов и координат; label_cache - бинарный кэш разобранной разметки
+        self.label_store = LabelStore(label_cache, num_classes=num_classes)
+
+    # Функция для отрисовки bbox на исходном изображении (изображение изменяется на месте)
     def draw_source_bboxes(self, image, bboxes):
-        draw = ImageDraw.Draw(image)
-        for bbox in bboxes:
-            class_labels, x_center, y_center, width, height = bbox
-            # Преобразование нормализованных координат обратно в абсолютные значения в пикселях
-            absolute_x_center = x_center * image.size[0]
-            absolute_y_center = y_center * image.size[1]
-            absolute_width = width * image.size[0]
-            absolute_height = height * image.size[1]
-
-            # Вычисление координат углов прямоугольника
-            left = absolute_x_center - absolute_width // 2
-            top = absolute_y_center - absolute_height // 2
-            right = absolute_x_center + absolute_width // 2
-            bottom = absolute_y_center + absolute_height // 2
-
-            draw.rectangle([left, top, right, bottom], outline="red", width=2)
-        return image
+        return draw_bboxes(image, bboxes)
     
-    # Функция для нахождения пар изображение-метка        
-    def find_image_label_pairs(self, src_directory):
-        images = {}
-        labels = {}
-
-        # Получаем список всех файлов в директории и поддиректориях
-        all_files = []
-        for root, _, files in os.walk(src_directory):
-            for file in files:
-                all_files.append((root, file))
-
-        # Проходим по всем файлам, используя прогресс-бар
-        for root, file in tqdm(all_files, desc="Поиск пар изображений и меток", unit=" files"):
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')):
-                base_name = os.path.splitext(file)[0]
-                images[base_name] = os.path.join(root, file)
-            elif file.lower().endswith('.txt'):
-                base_name = os.path.splitext(file)[0]
-                labels[base_name] = os.path.join(root, file)
-
-        # Сопоставляем изображения и метки
-        pairs = []
-        for base_name, img_path in images.items():
-            txt_path = labels.get(base_name)
-            if txt_path:
-                pairs.append((img_path, txt_path))
-
+    # Функция для нахождения пар изображение-метка: параллельный обход каталогов, сопоставление по относительному пути.
+    # index_path - файл индекса каталогов для быстрого повторного обхода (перечитываются только измененные каталоги)
+    def find_image_label_pairs(self, src_directory, index_path=None, num_threads=None):
+        source_index = SourceIndex(index_path, num_threads=num_threads)
+        with self.metrics.stage('find_image_label_pairs') as stage:
+            pairs = source_index.scan(src_directory)
+            stage.add(len(pairs))
+        scan = source_index.last_scan
+        self.metrics.observe('rescanned_directories', scan['rescanned_directories'])
+        print(f"Найдено пар изображение-метка: {scan['pairs']} за {scan['seconds']:.2f} s "
+              f"(каталогов: {scan['directories']}, перечитано: {scan['rescanned_directories']})")
         return pairs
     
-    # Функция загрузки всех аннотаций, которые есть на выбранной картинке
+    # Функция загрузки всех аннотаций, которые есть на выбранной картинке (ошибочные строки отбрасываются)
     def _load_bboxes(self, bbox_file_path):
-        bboxes = []
-        try:
-            with open(bbox_file_path, 'r') as file:
-                for line in file:
-                    class_labels, x_center, y_center, width, height = map(float, line.strip().split())
-                    bboxes.append([int(class_labels), x_center, y_center, width, height])
-        except Exception as e:
-            print(f"Ошибка при чтении файла аннотаций {bbox_file_path}: {e}")
-        return bboxes              
-
-    # Функция загрузки пар картинка-аннотации
-    def _process_image(self, img_path, txt_path):
+        bboxes, errors = self.label_store.load_file(bbox_file_path)
+        if errors:
+            print(f"Ошибки в файле аннотаций {bbox_file_path}: " + '; '.join(f"строка {line}: {message}" for line, _, message in errors))
+            self.metrics.count('label_errors', len(errors))
+        return bboxes
+
+    # Функция построения записи пары картинка-аннотации. Пиксели не декодируются, читается только заголовок.
+    # bboxes - заранее загруженные аннотации (None - файл разметки читается здесь)
+    def _process_image(self, img_path, txt_path, bboxes=None):
         try:
-            # Загружаем картинки и их аннотации
-            img = Image.open(img_path)
-            original_width, original_height = img.size
-            bboxes = self._load_bboxes(txt_path)
+            cache_key = None
+            if self.cache is not None:
+                # При попадании в кэш не читаются ни заголовок картинки, ни файл разметки
+                cache_key = self.cache.make_key(img_path, txt_path, self.canvas_size, self.large_image_threshold, self.process_large_images,
+                                                 self.tile_large_images, self.decode_mode)
+                meta = self.cache.get_meta(cache_key)
+                if meta is not None:
+                    (width, height), bboxes = meta
+                    return ImageRecord(img_path, width, height, bboxes, self.cache, cache_key, self.decode_mode)
+
+            with Image.open(img_path) as img:
+                original_width, original_height = img.size
+            if bboxes is None:
+                bboxes = self._load_bboxes(txt_path)
 
             # Проверяем, нужно ли обрабатывать большие изображения отдельно
-            if self.process_large_images and (original_width >= self.large_image_threshold or original_height >= self.large_image_threshold):
-                # Возвращаем изображение и его аннотации без изменений
-                return img, bboxes
+            if (self.process_large_images or self.tile_large_images) and self._is_large(original_width, original_height):
+                # Большие изображения сохраняют исходный размер (при нарезке фрагменты вырезаются перед сборкой мозаик)
+                return ImageRecord(img_path, original_width, original_height, bboxes, self.cache, cache_key, self.decode_mode)
             else:
-                # Погдонка больших изображений под размер полотна
-                if original_width > self.canvas_size or original_height > self.canvas_size:
-                    img.thumbnail((self.canvas_size, self.canvas_size), Image.Resampling.LANCZOS)
-                return img, bboxes
+                # Подгонка больших изображений под размер полотна выполняется при декодировании
+                width, height = fit_size(original_width, original_height, self.canvas_size)
+                return ImageRecord(img_path, width, height, bboxes, self.cache, cache_key, self.decode_mode)
         except Exception as e:
             print(f"Ошибка при открытии изображения {img_path}: {e}")
-            return None, []
+            self.metrics.count('decode_failures')
+            return None
 
-    # Функция загрузки и обработки пар изображений и аннотаций
+    # Функция сохранения индекса постоянного кэша исходников (журналы процессов сливаются, лишнее вытесняется)
+    def flush_cache(self):
+        if self.cache is not None:
+            self.cache.flush()
+
+    # Функция построения записей для всех пар изображений и аннотаций
     def process_image_label_pairs(self, image_label_pairs):
         if not hasattr(self, 'image_bbox_pairs') or not self.image_bbox_pairs:
             # Инициализируем списки для хранения данных, если они еще не созданы или пусты
             self.image_bbox_pairs = []
             self.large_images = []
 
+            # Вся разметка загружается одним массивом (из кэша разметки, если он задан)
+            with self.metrics.stage('load_labels', len(image_label_pairs)):
+                values, offsets = self.label_store.load([label_path for _, label_path in image_label_pairs])
+            self.metrics.count('label_errors', len(self.label_store.errors))
+
             # Обработка пар изображений и аннотаций
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(self._process_image, img_path, label_path): idx for idx, (img_path, label_path) in enumerate(image_label_pairs)}
+            with self.metrics.stage('process_image_label_pairs', len(image_label_pairs)), concurrent.futures.ThreadPoolExecutor() as executor:
+                futures = {executor.submit(self._process_image, img_path, label_path, values[offsets[idx]:offsets[idx + 1]]): idx
+                           for idx, (img_path, label_path) in enumerate(image_label_pairs)}
                 for future in tqdm(futures, total=len(image_label_pairs), desc="Предобработка изображений", unit=" images", leave=True):
-                    img, bboxes = future.result()
-                    if img is not None and bboxes:
-                        if self.process_large_images and (img.width >= self.large_image_threshold or img.height >= self.large_image_threshold):
-                            self.large_images.append((img, bboxes)) # Сохраняем большие изображения отдельно
+                    record = future.result()
+                    if record is not None and not len(record.bboxes):
+                        self.metrics.count('empty_labels')
+                    elif record is not None:
+                        if (self.process_large_images or self.tile_large_images) and self._is_large(record.width, record.height):
+                            self.large_images.append(record) # Сохраняем большие изображения отдельно
                         else:
-                            self.image_bbox_pairs.append((img, bboxes))  # Сохраняем пару изображение-аннотация
+                            self.image_bbox_pairs.append(record)  # Сохраняем запись изображение-аннотация
         return self.image_bbox_pairs, self.large_images        
     
-    # Функция проверки возможности размещения изображения на полотно
-    def _can_place_image(self, x, y, img, occupied_areas, canvas):
-        # Проверяем, что изображение не выходит за границы холста
-        if x + img.width > self.canvas_size or y + img.height > self.canvas_size:
-            return False
-
-        # Проверяем перекрытие с уже размещенными изображениями
-        for area in occupied_areas:
-            if not (x + img.width <= area['left'] or x >= area['right'] or
-                    y + img.height <= area['top'] or y >= area['bottom']):
-                return False
-
-        return True
-    
-    # Функция дозаполнения полотна мозаики случайными изображениями
-    def _fill_extra_images(self, x, y, all_images, all_bboxes, occupied_areas, canvas, next_row_y, pbar, min_x, min_y, max_x, max_y, mosaic_bboxes):
-        max_attempts_per_image = 10  # Максимальное количество попыток разместить одно изображение
-        max_total_attempts = 50  # Максимальное общее количество попыток для всего полотна
-        total_attempts = 0  # Общий счетчик попыток
-
-        while all_images and total_attempts < max_total_attempts:
-            attempts = 0  # Счетчик попыток размещения одного изображения
-
-            # Пытаемся разместить случайное изображение в текущей позиции
-            placed = False
-            tried_indices = set()
-            cnt_img = np.round(np.sqrt(len(all_images)))
-
-            while len(tried_indices) < cnt_img and not placed and attempts < max_attempts_per_image:
-                img_index = random.randint(0, len(all_images) - 1)
-
-                if img_index in tried_indices:
-                    continue  # Пропускаем уже рассмотренные изображения
-
-                tried_indices.add(img_index)
-                extra_img, extra_bboxes = all_images[img_index], all_bboxes[img_index]
-
-                # Проверяем, помещается ли изображение в оставшееся пространство на полотне
-                if self._can_place_image(x, y, extra_img, occupied_areas, canvas):
-                    canvas.paste(extra_img, (x, y))
-                    min_x, min_y = min(min_x, x), min(min_y, y)
-                    max_x, max_y = max(max_x, x + extra_img.width), max(max_y, y + extra_img.height)
-                    occupied_areas.append({'left': x, 'top': y, 'right': x + extra_img.width, 'bottom': y + extra_img.height})
-
-                    # Корректируем координаты bbox с учетом смещения изображения
-                    self.shift_bbox(extra_img, extra_bboxes, x, y, mosaic_bboxes)
-
-                    x += extra_img.width
-                    next_row_y = max(next_row_y, y + extra_img.height)
-                    placed = True  # Отмечаем, что изображение было успешно размещено
-                    pbar.update(1)
-
-                    del all_images[img_index]  # Удаляем из списка, чтобы не размещать повторно
-                    del all_bboxes[img_index]
-                else:
-                    attempts += 1  # Увеличиваем счетчик попыток
-            
-            total_attempts += 1  # Увеличиваем общий счетчик попыток
-
-            # Если не удалось разместить ни одно изображение, переходим на новую строку или завершаем заполнение
-            if not placed:
-                if y + next_row_y >= self.canvas_size or total_attempts >= max_total_attempts:  # Если нет места для новой строки или превышено максимальное количество попыток, завершаем заполнение
-                    break
-                else:  # Переходим на новую строку
-                    x = 0
-                    y = next_row_y
-                    next_row_y = y
-
-        return min_x, min_y, max_x, max_y
-
-
-    # Функция центровки мозаики на полотне
-    def _center_mosaic(self, canvas, min_x, min_y, max_x, max_y):
-        mosaic_width = max_x - min_x
-        mosaic_height = max_y - min_y
-        # Рассчитываем смещения для центровки
-        offset_x = (self.canvas_size - mosaic_width) // 2
-        offset_y = (self.canvas_size - mosaic_height) // 2
-        final_canvas = Image.new('RGB', (self.canvas_size, self.canvas_size), (0, 0, 0))
-        final_canvas.paste(canvas, (offset_x, offset_y))
-        return final_canvas, offset_x, offset_y
+    # Функция расчета смещений для центровки раскладки на полотне
+    def _center_offsets(self, placements):
+        min_x = min(x for _, x, _, _, _ in placements)
+        min_y = min(y for _, _, y, _, _ in placements)
+        max_x = max(x + width for _, x, _, width, _ in placements)
+        max_y = max(y + height for _, _, y, _, height in placements)
+        offset_x = (self.canvas_size - (max_x - min_x)) // 2 - min_x
+        offset_y = (self.canvas_size - (max_y - min_y)) // 2 - min_y
+        return offset_x, offset_y
     
     # Функция коррекции координат bbox при перемещении изображения по полотну
-    def shift_bbox(self, image, bboxes, x, y, mosaic_bboxes):
-        for bbox in bboxes:
-            class_labels, x_center, y_center, width, height = bbox
-            # Преобразование нормализованных координат bbox в абсолютные значения в пикселях на исходной картинке
-            absolute_x_center = x_center * image.width
-            absolute_y_center = y_center * image.height
-            absolute_width = width * image.width
-            absolute_height = height * image.height
-            # Преобразование в абсолютные координаты полотна
-            absolute_x_center += x
-            absolute_y_center += y
-            # Преобразование bbox в относительные координаты полотна
-            corrected_x_center = absolute_x_center / self.canvas_size
-            corrected_y_center = absolute_y_center / self.canvas_size
-            corrected_width = absolute_width / self.canvas_size
-            corrected_height = absolute_height / self.canvas_size
-            # Запись аннотации полотна
-            corrected_bbox = [class_labels, corrected_x_center, corrected_y_center, corrected_width, corrected_height]
-            mosaic_bboxes.append(corrected_bbox)    
+    def shift_bbox(self, image, bboxes, x, y):
+        size = image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0])
+        return shift_bboxes(bboxes, size, x, y, self.canvas_size)
+
+    # Функция декодирования пикселей записей и их аугментации, если она включена. Результаты выдаются по мере готовности.
+    # as_array=True выдает пиксели массивами uint8 HWC (без обратного преобразования в PIL.Image)
+    def _render_tiles(self, records, executor, augmentor=None, as_array=False):
+        if augmentor:
+            return augmentor.augment_iter(records, as_array=as_array)
+        return bounded_map(executor, lambda record: _load_record(record, as_array), records, 4 * (os.cpu_count() or 1))
+
+    # Функция раскладки записей по полотнам без декодирования пикселей. При заданном seed порядок поступления
+    # записей в упаковщик перемешивается (влияет на раскладку при ограниченном окне упаковщика).
+    # window - сколько записей упаковщик видит одновременно (по умолчанию packing_window)
+    def plan_mosaics(self, records, seed=None, window=None):
+        order = None
+        if seed is not None:
+            order = list(range(len(records)))
+            random.Random(seed).shuffle(order)
+        return self.packer.pack([record.size for record in records], order=order, window=window or self.packing_window)
+
+    def _is_large(self, width, height):
+        return width >= self.large_image_threshold or height >= self.large_image_threshold
+
+    # Функция разделения записей на картинки для мозаик и большие картинки, сохраняемые отдельно.
+    # При tile_large_images большие картинки нарезаются на фрагменты, которые идут в мозаики
+    def split_large_images(self, records):
+        image_bbox_pairs = []
+        large_images = []
+        for record in records:
+            if isinstance(record, TileRecord) or not self._is_large(record.width, record.height):
+                image_bbox_pairs.append(record)
+            else:
+                large_images.append(record)
+        if self.tile_large_images and large_images:
+            image_bbox_pairs.extend(self.tile_images(large_images))
+            large_images = []
+        return image_bbox_pairs, large_images
+
+    # Функция нарезки записей больших картинок на перекрывающиеся фрагменты (окна и рамки считаются параллельно)
+    def tile_images(self, records):
+        with self.metrics.stage('tile_large_images', len(records)), concurrent.futures.ThreadPoolExecutor() as executor:
+            tiles = [tile for record_tiles in executor.map(self._tile_record, records) for tile in record_tiles]
+        self.metrics.count('tiles', len(tiles))
+        return tiles
+
+    # Фрагменты одной записи; фрагменты без рамок пропускаются
+    def _tile_record(self, record):
+        windows = tile_windows(record.size, self.tile_size, self.tile_overlap)
+        tiles = []
+        for window, bboxes in zip(windows.tolist(), crop_bboxes(record.bboxes, record.size, windows, self.min_visible)):
+            if len(bboxes):
+                cache_key = None
+                if record.cache is not None and record.cache_key is not None:
+                    cache_key = hashlib.sha1(f"{record.cache_key}|{window}".encode()).hexdigest()
+                tiles.append(TileRecord(record.path, window, bboxes, record.cache, cache_key, record))
+        return tiles
+
+    # Функция выкладки готовых картинок на полотно по раскладке.
+    # При as_array=True полотно - новый массив uint8 HWC, картинки-массивы копируются в него один раз, и массив отдается
+    # вызывающему (torch.from_numpy без копирования). Иначе картинки выкладываются на PIL.Image
+    def _compose_canvas(self, placements, tiles, as_array=False):
+        canvas = new_canvas(self.canvas_size) if as_array else Image.new('RGB', (self.canvas_size, self.canvas_size), (0, 0, 0))
+        mosaic_bboxes = []
+
+        # Картинки выкладываются сразу с учетом центровки мозаики на полотне
+        offset_x, offset_y = self._center_offsets(placements)
+        for (_, x, y, _, _), (tile, tile_bboxes) in zip(placements, tiles):
+            if as_array:
+                paste_array(canvas, np.asarray(tile), x + offset_x, y + offset_y)
+            else:
+                canvas.paste(tile if isinstance(tile, Image.Image) else Image.fromarray(tile), (x + offset_x, y + offset_y))
+            # Корректируем координаты bbox с учетом смещения изображения
+            mosaic_bboxes.append(self.shift_bbox(tile, tile_bboxes, x + offset_x, y + offset_y))
+        return canvas, np.concatenate(mosaic_bboxes)
+
+    # Функция сборки одного полотна по раскладке в текущем потоке: декодирование, аугментация и выкладка картинок
+    def compose_mosaic(self, records, placements, augmentor=None, as_array=False):
+        placed_records = [records[placement[0]] for placement in placements]
+        if augmentor:
+            tiles = (augmentor._augment_single_image(record, as_array=as_array) for record in placed_records)
+        else:
+            tiles = (_load_record(record, as_array) for record in placed_records)
+        return self._compose_canvas(placements, tiles, as_array=as_array)
     
-    # Основная функция сборки мозаик и аннотаций
-    def create_mosaic(self, image_bbox_pairs, large_images, augmentor=None):
-        mosaics = []
+    # Потоковая сборка мозаик: пары (полотно, bbox) выдаются по мере готовности каждого полотна, затем большие картинки.
+    # Одновременно в памяти находятся только полотна и картинки в работе, а не весь набор.
+    # lookahead ограничивает окно упаковщика (по умолчанию packing_window); fill_ratios заполняется по ходу выдачи.
+    # as_array=True выдает полотна массивами uint8 HWC (без преобразования в PIL.Image)
+    # При обучении в нескольких процессах (rank из world_size) каждый процесс строит ту же раскладку (seed общий) и собирает
+    # только свою долю полотен и больших картинок (см. shard_indices)
+    def iter_mosaics(self, image_bbox_pairs, large_images=(), augmentor=None, lookahead=None, as_array=False, seed=None, rank=0, world_size=1):
+        # Раскладка строится упаковщиком только по размерам записей
+        layouts = self.plan_mosaics(image_bbox_pairs, seed=seed, window=lookahead)
+        total = len(image_bbox_pairs)
+        if world_size > 1:
+            layouts = list(layouts)
+            layouts = [layouts[idx] for idx in shard_indices(len(layouts), rank, world_size)]
+            large_images = [large_images[idx] for idx in shard_indices(len(large_images), rank, world_size)]
+            total = sum(len(placements) for placements, _ in layouts)
+        yield from self._iter_layouts(image_bbox_pairs, layouts, large_images, augmentor, as_array, total)
+
+    # Функция потоковой сборки полотен по готовой раскладке (итератор (placements, fill_ratio)), затем больших картинок
+    def _iter_layouts(self, image_bbox_pairs, layouts, large_images, augmentor, as_array, total):
+        self.fill_ratios = []
+
+        # Пиксели декодируются (и аугментируются) только для картинок ближайших полотен
+        with self.metrics.stage('create_mosaic') as stage, concurrent.futures.ThreadPoolExecutor() as executor:
+            planned = deque()
+
+            # Поток записей всех полотен подряд, чтобы пул декодирования не простаивал на границах полотен
+            def tile_records():
+                for placements, fill_ratio in layouts:
+                    planned.append((placements, fill_ratio))
+                    for placement in placements:
+                        yield image_bbox_pairs[placement[0]]
+
+            tiles = iter(self._render_tiles(tile_records(), executor, augmentor, as_array=as_array))
+            with tqdm(total=total, desc="Распределение картинок по мозаикам", unit=" images", leave=True) as pbar:
+                for first_tile in tiles:
+                    placements, fill_ratio = planned.popleft()
+                    canvas_tiles = itertools.chain([first_tile], itertools.islice(tiles, len(placements) - 1))
+                    mosaic = self._compose_canvas(placements, canvas_tiles, as_array=as_array)
+                    self.fill_ratios.append(fill_ratio)
+                    self.metrics.observe('fill_ratio', fill_ratio)
+                    self.metrics.observe('planned_canvases', len(planned))  # Полотна, картинки которых уже в работе
+                    stage.add(len(placements))
+                    pbar.update(len(placements))
+                    pbar.set_postfix(fill=f"{np.mean(self.fill_ratios):.2f}")
+                    yield mosaic
+
+            # Обработка больших изображений с аугментацией
+            for large_image in self._render_tiles(large_images, executor, augmentor if self.process_large_images else None, as_array=as_array):
+                stage.add()
+                yield large_image
+
+        self.flush_cache()
+
+    # Функция построения плана мозаик (MosaicPlan) без декодирования пикселей: раскладка полотен, положение картинок
+    # и итоговые аннотации. План можно сохранить (MosaicPlan.save), сравнить с другим и отрисовать позже (render_plan).
+    # Параметры seed, lookahead, rank и world_size - как у iter_mosaics
+    def build_plan(self, image_bbox_pairs, large_images=(), seed=None, lookahead=None, rank=0, world_size=1):
+        with self.metrics.stage('build_plan', len(image_bbox_pairs)):
+            layouts = list(self.plan_mosaics(image_bbox_pairs, seed=seed, window=lookahead))
+            canvas_ids = shard_indices(len(layouts), rank, world_size)
+            plan = MosaicPlan.from_layouts(image_bbox_pairs, [layouts[idx] for idx in canvas_ids], self.canvas_size,
+                                           canvas_ids=canvas_ids, large_ids=shard_indices(len(large_images), rank, world_size), seed=seed)
+        self.metrics.count('planned_canvases', len(plan))
+        return plan
+
+    # Функция отрисовки плана мозаик: выдает то же, что iter_mosaics с параметрами плана (полотна, затем большие картинки).
+    # image_bbox_pairs и large_images - записи, по которым строился план (проверяется по путям).
+    # num_workers=0 собирает полотна в текущем процессе потоковым пулом (как iter_mosaics); num_workers > 0 раздает
+    # полотна пачками по chunk_size пулу процессов, порядок выдачи сохраняется. Аугментации в процессах
+    # воспроизводимы между запусками: генераторы переинициализируются зерном derive_seed из seed плана и номера
+    # полотна (большой картинки) в наборе
+    def render_plan(self, plan, image_bbox_pairs, large_images=(), augmentor=None, as_array=False, num_workers=0, chunk_size=8):
+        if plan.canvas_size != self.canvas_size:
+            raise ValueError(f"План построен для полотна {plan.canvas_size}, а MosaicCreator - для {self.canvas_size}")
+        if len(plan.sources) != len(image_bbox_pairs) or any(str(source) != record.path for source, record in zip(plan.sources, image_bbox_pairs)):
+            raise ValueError("План мозаик построен по другому списку записей")
+        if len(plan.large_ids) and plan.large_ids.max() >= len(large_images):
+            raise ValueError(f"План мозаик ссылается на большие картинки, которых нет среди переданных ({len(large_images)})")
+        large_images = [large_images[idx] for idx in plan.large_ids.tolist()]
+        if not num_workers:
+            yield from self._iter_layouts(image_bbox_pairs, plan.layouts(), large_images, augmentor, as_array, len(plan.placements))
+            return
+
+        self.fill_ratios = []
+        layouts = plan.layouts()
+        # Задачи пула: пачки (номер полотна, раскладка) и пачки больших картинок (номер, None)
+        tasks = [[(int(canvas_id), placements) for canvas_id, (placements, _) in zip(plan.canvas_ids[i:i + chunk_size], layouts[i:i + chunk_size])]
+                 for i in range(0, len(layouts), chunk_size)]
+        tasks += [[(idx, None) for idx in range(i, min(i + chunk_size, len(large_images)))] for i in range(0, len(large_images), chunk_size)]
+        initargs = (self, image_bbox_pairs, large_images, plan.large_ids.tolist(), augmentor, plan.seed)
+        with self.metrics.stage('render_plan') as stage, \
+                concurrent.futures.ProcessPoolExecutor(num_workers, initializer=_init_render_worker, initargs=initargs) as executor:
+            canvas_idx = 0
+            with tqdm(total=len(plan.placements), desc="Отрисовка плана мозаик", unit=" images", leave=True) as pbar:
+                for results in bounded_map(executor, _render_chunk, tasks, 2 * num_workers):
+                    for image, bboxes in results:
+                        if canvas_idx < len(layouts):
+                            placed = len(layouts[canvas_idx][0])
+                            self.fill_ratios.append(layouts[canvas_idx][1])
+                            self.metrics.observe('fill_ratio', layouts[canvas_idx][1])
+                            stage.add(placed)
+                            pbar.update(placed)
+                            canvas_idx += 1
+                        else:
+                            stage.add()
+                        yield (image if as_array else Image.fromarray(image)), bboxes
+        self.flush_cache()
 
-        # Обработка больших изображений с аугментацией
-        if augmentor and self.process_large_images:
-            large_images = augmentor.augment_images(large_images)
-            
-        # Применяем аугментацию, если она включена
+    # Основная функция сборки мозаик и аннотаций (все полотна собираются в список, см. iter_mosaics)
+    def create_mosaic(self, image_bbox_pairs, large_images, augmentor=None):
+        all_images = list(self.iter_mosaics(image_bbox_pairs, large_images, augmentor=augmentor))
+        # Первыми выдаются полотна мозаик, их число равно числу долей заполнения
+        return all_images[:len(self.fill_ratios)], all_images[len(self.fill_ratios):]
+
+
+# Декодирование записи в PIL.Image или массив uint8 HWC вместе с ее аннотациями
+def _load_record(record, as_array=False):
+    image = record.load()
+    return (np.asarray(image) if as_array else image), record.bboxes
+
+
+# Состояние процесса пула отрисовки плана (задается один раз при запуске процесса, см. render_plan)
+_render_state = {}
+
+def _init_render_worker(mosaic_creator, image_bbox_pairs, large_images, large_ids, augmentor, seed):
+    _render_state.update(mosaic_creator=mosaic_creator, image_bbox_pairs=image_bbox_pairs, large_images=large_images, large_ids=large_ids,
+                         augmentor=augmentor, seed=seed)
+
+# Отрисовка пачки полотен (или больших картинок, если раскладка None) в процессе пула. Пиксели возвращаются массивами uint8 HWC
+def _render_chunk(tasks):
+    mosaic_creator, augmentor = _render_state['mosaic_creator'], _render_state['augmentor']
+    results = []
+    for idx, placements in tasks:
+        if placements is None:
+            record = _render_state['large_images'][idx]
+            if augmentor and mosaic_creator.process_large_images:
+                augmentor.reseed(derive_seed(_render_state['seed'], 1, _render_state['large_ids'][idx]))
+                results.append(augmentor._augment_single_image(record, as_array=True))
+            else:
+                results.append(_load_record(record, as_array=True))
+            continue
         if augmentor:
-            image_bbox_pairs = augmentor.augment_images(image_bbox_pairs)                    
-
-        # Сортировка пар изображение-аннотация по размеру изображения
-        image_bbox_pairs.sort(key=lambda pair: pair[0].width * pair[0].height, reverse=True)
-        
-        # Разделение пар на отдельные списки изображений и аннотаций
-        all_images, all_bboxes = zip(*image_bbox_pairs)
-        # Преобразование кортежей обратно в списки
-        all_images = list(all_images)
-        all_bboxes = list(all_bboxes)        
-        
-        with tqdm(total=len(all_images), desc="Распределение картинок по мозаикам", unit=" images", leave=True) as pbar:
-            while all_images:
-                canvas = Image.new('RGB', (self.canvas_size, self.canvas_size), (0, 0, 0))
-                mosaic_bboxes = []
-                x, y = 0, 0
-                next_row_y = 0
-                occupied_areas = []
-                min_x, min_y, max_x, max_y = self.canvas_size, self.canvas_size, 0, 0                          
-
-                # Размещение первого элемента на полотно
-                largest_img, largest_bboxes = all_images.pop(0), all_bboxes.pop(0)
-                canvas.paste(largest_img, (x, y))
-                min_x, min_y = min(min_x, x), min(min_y, y)
-                max_x, max_y = max(max_x, x + largest_img.width), max(max_y, y + largest_img.height)               
-                occupied_areas.append({'left': x, 'top': y, 'right': x + largest_img.width, 'bottom': y + largest_img.height})
-                
-                # Корректируем координаты bbox с учетом смещения изображения
-                self.shift_bbox(largest_img, largest_bboxes, x, y, mosaic_bboxes)
-
-                x += largest_img.width
-                next_row_y = max(next_row_y, y + largest_img.height)
-                pbar.update(1)
-                del largest_img
-                del largest_bboxes
-
-                # Дозаполнение полотна
-                min_x, min_y, max_x, max_y = self._fill_extra_images(x, y, all_images, all_bboxes, occupied_areas, canvas, next_row_y, pbar, min_x, min_y, max_x, max_y, mosaic_bboxes)
-
-                # Центрируем мозаику
-                centered_mosaic, offset_x, offset_y = self._center_mosaic(canvas, min_x, min_y, max_x, max_y)
-
-                # Корректируем все BBox на полотне после центровки мозаики
-                adjusted_mosaic_bboxes = []
-                for bbox in mosaic_bboxes:
-                    class_labels, x_center, y_center, width, height = bbox
-                    corrected_x_center = x_center + offset_x / self.canvas_size
-                    corrected_y_center = y_center + offset_y / self.canvas_size
-                    corrected_bbox = [class_labels, corrected_x_center, corrected_y_center, width, height]
-                    adjusted_mosaic_bboxes.append(corrected_bbox)
-
-                mosaics.append((centered_mosaic, adjusted_mosaic_bboxes))
-
-        return mosaics, large_images
\ No newline at end of file
+            augmentor.reseed(derive_seed(_render_state['seed'], 0, idx))
+        results.append(mosaic_creator.compose_mosaic(_render_state['image_bbox_pairs'], placements, augmentor=augmentor, as_array=True))
+    return results
@@ -0,0 +1,225 @@
+from bisect import bisect_left, bisect_right, insort
+import numpy as np
+
+# Индекс картинок-кандидатов, сгруппированных по корзинам высоты.
+# Внутри корзины записи (ширина, высота, индекс) отсортированы по ширине, поиск выполняется бинарно
+class SizeBuckets:
+    def __init__(self, sizes=(), bucket_size=32):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        for idx, (width, height) in enumerate(sizes):
+            self.buckets.setdefault(height // bucket_size, []).append((width, height, idx))
+        for bucket in self.buckets.values():
+            bucket.sort()
+        self.keys = sorted(self.buckets)
+        self.count = len(sizes)
+
+    # Добавление картинки в индекс
+    def add(self, idx, width, height):
+        key = height // self.bucket_size
+        if key not in self.buckets:
+            self.buckets[key] = []
+            insort(self.keys, key)
+        insort(self.buckets[key], (width, height, idx))
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    # Поиск картинки наибольшей площади, которая помещается в область max_width x max_height
+    def find(self, max_width, max_height):
+        best = None
+        best_area = 0
+        key_pos = bisect_right(self.keys, max_height // self.bucket_size) - 1
+        while key_pos >= 0:
+            key = self.keys[key_pos]
+            # Верхняя оценка площади в корзине: если она не лучше найденной, ниже искать бессмысленно
+            if min((key + 1) * self.bucket_size - 1, max_height) * max_width <= best_area:
+                break
+            bucket = self.buckets[key]
+            pos = bisect_right(bucket, (max_width, float('inf'), float('inf'))) - 1
+            # Только в верхней корзине встречаются картинки выше доступной области
+            while pos >= 0 and bucket[pos][1] > max_height:
+                pos -= 1
+            if pos >= 0:
+                width, height, _ = bucket[pos]
+                if width * height > best_area:
+                    best, best_area = (key, pos), width * height
+            key_pos -= 1
+        return best
+
+    # Извлечение найденной картинки из индекса
+    def take(self, found):
+        key, pos = found
+        bucket = self.buckets[key]
+        width, height, idx = bucket.pop(pos)
+        if not bucket:
+            del self.buckets[key]
+            self.keys.pop(bisect_left(self.keys, key))
+        self.count -= 1
+        return idx, width, height
+
+    # Извлечение самой большой из оставшихся картинок
+    def take_largest(self):
+        best = max(((key, pos) for key, bucket in self.buckets.items() for pos in range(len(bucket))),
+                   key=lambda found: self.buckets[found[0]][found[1]][0] * self.buckets[found[0]][found[1]][1])
+        return self.take(best)
+
+
+# Базовый класс упаковщика картинок по полотнам мозаик
+class MosaicPacker:
+    def __init__(self, canvas_size=640, bucket_size=32):
+        self.canvas_size = canvas_size
+        self.bucket_size = bucket_size
+
+    # Раскладка одного полотна. Возвращает список размещений (индекс, x, y, ширина, высота)
+    def pack_canvas(self, buckets):
+        raise NotImplementedError
+
+    # Раскладка всех картинок по полотнам. Для каждого полотна выдает размещения и долю заполнения.
+    # order задает порядок поступления картинок, window - сколько картинок упаковщик видит одновременно
+    # (None - все сразу, тогда порядок не важен). При ограниченном окне раскладка зависит от порядка
+    def pack(self, sizes, order=None, window=None):
+        canvas_area = self.canvas_size * self.canvas_size
+        if window is None:
+            buckets = SizeBuckets(sizes, self.bucket_size)
+            pending = iter(())
+        else:
+            buckets = SizeBuckets((), self.bucket_size)
+            pending = iter(range(len(sizes)) if order is None else order)
+
+        while True:
+            # Пополнение окна кандидатов
+            while window is not None and len(buckets) < window:
+                idx = next(pending, None)
+                if idx is None:
+                    break
+                buckets.add(idx, *sizes[idx])
+            if not len(buckets):
+                break
+            placements = self.pack_canvas(buckets)
+            if not placements:
+                # Картинка больше полотна размещается на отдельном полотне (лишнее обрезается)
+                idx, width, height = buckets.take_largest()
+                placements = [(idx, 0, 0, width, height)]
+            fill_ratio = min(sum(width * height for _, _, _, width, height in placements) / canvas_area, 1.0)
+            yield placements, fill_ratio
+
+
+# Упаковщик по алгоритму skyline (bottom-left): картинки ложатся на самый низкий участок "линии горизонта"
+class SkylinePacker(MosaicPacker):
+    def pack_canvas(self, buckets):
+        placements = []
+        skyline = [[0, 0, self.canvas_size]]  # Участки линии горизонта: [x, y, ширина]
+        while buckets:
+            # Самый низкий (при равенстве - самый левый) участок
+            seg_pos = min(range(len(skyline)), key=lambda i: (skyline[i][1], skyline[i][0]))
+            x, y, seg_width = skyline[seg_pos]
+            if y >= self.canvas_size:
+                break
+
+            found = buckets.find(seg_width, self.canvas_size - y)
+            if found is not None:
+                idx, width, height = buckets.take(found)
+                placements.append((idx, x, y, width, height))
+                new_segments = [[x, y + height, width]]
+                if seg_width > width:
+                    new_segments.append([x + width, y, seg_width - width])
+                skyline[seg_pos:seg_pos + 1] = new_segments
+            else:
+                # Ни одна картинка не помещается: поднимаем участок до уровня ближайшего соседа
+                neighbours = [skyline[i][1] for i in (seg_pos - 1, seg_pos + 1) if 0 <= i < len(skyline)]
+                skyline[seg_pos][1] = min(neighbours) if neighbours else self.canvas_size
+            self._merge_skyline(skyline)
+        return placements
+
+    # Слияние соседних участков одинаковой высоты
+    @staticmethod
+    def _merge_skyline(skyline):
+        i = 0
+        while i < len(skyline) - 1:
+            if skyline[i][1] == skyline[i + 1][1]:
+                skyline[i][2] += skyline[i + 1][2]
+                del skyline[i + 1]
+            else:
+                i += 1
+
+
+# Упаковщик по алгоритму MaxRects: хранит все максимальные свободные прямоугольники полотна
+class MaxRectsPacker(MosaicPacker):
+    def pack_canvas(self, buckets):
+        placements = []
+        free_rects = [(0, 0, self.canvas_size, self.canvas_size)]  # Свободные области: (x, y, ширина, высота)
+        while buckets and free_rects:
+            # Выбираем пару свободная область - картинка с наибольшей площадью картинки,
+            # при равенстве - область, ближайшую к левому верхнему углу
+            best = None
+            for rect in sorted(free_rects, key=lambda rect: (rect[1], rect[0])):
+                found = buckets.find(rect[2], rect[3])
+                if found is None:
+                    continue
+                width, height, _ = buckets.buckets[found[0]][found[1]]
+                if best is None or width * height > best[0]:
+                    best = (width * height, rect, found)
+            if best is None:
+                break
+
+            _, (x, y, _, _), found = best
+            idx, width, height = buckets.take(found)
+            placements.append((idx, x, y, width, height))
+            free_rects = self._split_free_rects(free_rects, x, y, width, height)
+        return placements
+
+    # Разбиение свободных областей, пересекающихся с размещенной картинкой, и удаление вложенных областей
+    @staticmethod
+    def _split_free_rects(free_rects, x, y, width, height):
+        result = []
+        for fx, fy, fw, fh in free_rects:
+            if x >= fx + fw or x + width <= fx or y >= fy + fh or y + height <= fy:
+                result.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                result.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:
+                result.append((x + width, fy, fx + fw - x - width, fh))
+            if y > fy:
+                result.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:
+                result.append((fx, y + height, fw, fy + fh - y - height))
+
+        pruned = []
+        for i, (ax, ay, aw, ah) in enumerate(result):
+            contained = any(
+                j != i and bx <= ax and by <= ay and ax + aw <= bx + bw and ay + ah <= by + bh and
+                ((bx, by, bw, bh) != (ax, ay, aw, ah) or j < i)
+                for j, (bx, by, bw, bh) in enumerate(result))
+            if not contained:
+                pruned.append((ax, ay, aw, ah))
+        return pruned
+
+
+# Доступные упаковщики по именам
+PACKERS = {
+    'skyline': SkylinePacker,
+    'maxrects': MaxRectsPacker,
+}
+
+# Функция получения упаковщика по имени или готовому экземпляру
+def get_packer(packer, canvas_size):
+    if isinstance(packer, MosaicPacker):
+        return packer
+    try:
+        return PACKERS[packer](canvas_size=canvas_size)
+    except KeyError:
+        raise ValueError(f"Неизвестный упаковщик мозаик: {packer}. Доступны: {', '.join(PACKERS)}")
+
+# Номера элементов (из count) для процесса rank из world_size: элементы раздаются по кругу, и всем процессам достается
+# поровну ceil(count / world_size) элементов (недостающие повторяются с начала, как в DistributedSampler),
+# поэтому ни один процесс не ждет остальных на последних полотнах эпохи
+def shard_indices(count, rank=0, world_size=1):
+    if not 0 <= rank < world_size:
+        raise ValueError(f"Номер процесса {rank} вне диапазона [0, {world_size})")
+    if count == 0:
+        return np.empty(0, dtype=np.int64)
+    per_rank = -(-count // world_size)
+    return (rank + world_size * np.arange(per_rank)) % count
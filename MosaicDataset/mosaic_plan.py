@@ -0,0 +1,105 @@
+import os
+import numpy as np
+from .bbox_array import to_bbox_array
+
+# План мозаик эпохи, построенный только по размерам и аннотациям записей (без пикселей).
+# Хранится компактными массивами NumPy:
+#   canvas_ids (C,) - номера полотен в раскладке эпохи (при распределенном обучении - доля процесса),
+#   placements (P, 5) int64 - [номер записи, x, y, ширина, высота] с учетом центровки, canvas_offsets (C + 1,) - границы полотен,
+#   bboxes (B, 5) float32 - итоговые аннотации полотен без аугментации, bbox_offsets (C + 1,) - границы полотен,
+#   fill_ratios (C,) - доли заполнения, large_ids - номера больших картинок, выдаваемых после полотен,
+#   sources - пути записей (для проверки, что план отрисовывается по тем же записям, и для сравнения планов).
+# План сохраняется в .npz (save/load), сравнивается с другим планом (diff) и отрисовывается MosaicCreator.render_plan
+# без повторной упаковки
+class MosaicPlan:
+    VERSION = 1
+
+    def __init__(self, canvas_size, canvas_ids, canvas_offsets, placements, bbox_offsets, bboxes, fill_ratios, sources,
+                 large_ids=(), seed=None):
+        self.canvas_size = canvas_size
+        self.canvas_ids = np.asarray(canvas_ids, dtype=np.int64)
+        self.canvas_offsets = np.asarray(canvas_offsets, dtype=np.int64)
+        self.placements = np.asarray(placements, dtype=np.int64).reshape(-1, 5)
+        self.bbox_offsets = np.asarray(bbox_offsets, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+        self.fill_ratios = np.asarray(fill_ratios, dtype=np.float32)
+        self.sources = np.asarray(sources, dtype=str)
+        self.large_ids = np.asarray(large_ids, dtype=np.int64)
+        self.seed = seed
+
+    # Построение плана по раскладке упаковщика: layouts - список (placements, fill_ratio) в координатах упаковщика.
+    # Центровка и пересчет аннотаций выполняются сразу для всех полотен
+    @classmethod
+    def from_layouts(cls, records, layouts, canvas_size, canvas_ids=None, large_ids=(), seed=None):
+        lengths = np.array([len(placements) for placements, _ in layouts], dtype=np.int64)
+        canvas_offsets = np.zeros(len(layouts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=canvas_offsets[1:])
+        placements = np.array([placement for placements, _ in layouts for placement in placements], dtype=np.int64).reshape(-1, 5)
+
+        # Смещения центровки каждого полотна (как MosaicCreator._center_offsets)
+        if len(layouts):
+            starts = canvas_offsets[:-1]
+            left = np.minimum.reduceat(placements[:, 1], starts)
+            top = np.minimum.reduceat(placements[:, 2], starts)
+            right = np.maximum.reduceat(placements[:, 1] + placements[:, 3], starts)
+            bottom = np.maximum.reduceat(placements[:, 2] + placements[:, 4], starts)
+            offsets = np.stack([(canvas_size - (right - left)) // 2 - left, (canvas_size - (bottom - top)) // 2 - top], axis=1)
+            placements[:, 1:3] += np.repeat(offsets, lengths, axis=0)
+
+        # Аннотации всех картинок переводятся в координаты полотен одним проходом (как shift_bboxes)
+        source_bboxes = [to_bbox_array(records[idx].bboxes) for idx in placements[:, 0].tolist()]
+        counts = np.array([len(bboxes) for bboxes in source_bboxes], dtype=np.int64)
+        bboxes = np.concatenate(source_bboxes) if source_bboxes else np.empty((0, 5), dtype=np.float32)
+        per_box = np.repeat(placements[:, 1:], counts, axis=0).astype(np.float32) / canvas_size
+        bboxes[:, 1:] *= per_box[:, [2, 3, 2, 3]]
+        bboxes[:, 1:3] += per_box[:, :2]
+        bbox_offsets = np.concatenate(([0], np.cumsum(counts)))[canvas_offsets]
+
+        if canvas_ids is None:
+            canvas_ids = np.arange(len(layouts))
+        return cls(canvas_size, canvas_ids, canvas_offsets, placements, bbox_offsets, bboxes,
+                   [fill_ratio for _, fill_ratio in layouts], [record.path for record in records], large_ids, seed)
+
+    def __len__(self):
+        return len(self.canvas_ids)
+
+    # Описание полотна idx плана: номер в раскладке, записи, их положение, итоговые аннотации и заполнение
+    def canvas(self, idx):
+        placements = self.placements[self.canvas_offsets[idx]:self.canvas_offsets[idx + 1]]
+        return {'canvas_id': int(self.canvas_ids[idx]), 'sources': placements[:, 0].tolist(), 'placements': placements,
+                'bboxes': self.bboxes[self.bbox_offsets[idx]:self.bbox_offsets[idx + 1]], 'fill_ratio': float(self.fill_ratios[idx])}
+
+    # Раскладка полотен в формате упаковщика: список (placements, fill_ratio), placements - кортежи (номер, x, y, ширина, высота)
+    def layouts(self):
+        return [([tuple(placement) for placement in self.placements[start:end].tolist()], float(fill_ratio))
+                for start, end, fill_ratio in zip(self.canvas_offsets[:-1], self.canvas_offsets[1:], self.fill_ratios)]
+
+    # Сравнение с другим планом по номерам полотен: полотна, которые есть только в одном из планов, и полотна
+    # с отличающимся набором картинок или их положением (картинки сравниваются по путям)
+    def diff(self, other):
+        def canvases(plan):
+            return {int(canvas_id): [(plan.sources[row[0]], *row[1:]) for row in plan.canvas(idx)['placements'].tolist()]
+                    for idx, canvas_id in enumerate(plan.canvas_ids)}
+
+        own, others = canvases(self), canvases(other)
+        return {'added': sorted(others.keys() - own.keys()), 'removed': sorted(own.keys() - others.keys()),
+                'changed': sorted(canvas_id for canvas_id in own.keys() & others.keys() if own[canvas_id] != others[canvas_id])}
+
+    # Сохранение плана одним файлом .npz (через временный файл)
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, version=self.VERSION, canvas_size=self.canvas_size, seed=-1 if self.seed is None else self.seed,
+                     canvas_ids=self.canvas_ids, canvas_offsets=self.canvas_offsets, placements=self.placements,
+                     bbox_offsets=self.bbox_offsets, bboxes=self.bboxes, fill_ratios=self.fill_ratios,
+                     sources=self.sources, large_ids=self.large_ids)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != cls.VERSION:
+                raise ValueError(f"Неподдерживаемая версия плана мозаик {int(data['version'])} в {path}")
+            seed = int(data['seed'])
+            return cls(int(data['canvas_size']), data['canvas_ids'], data['canvas_offsets'], data['placements'], data['bbox_offsets'],
+                       data['bboxes'], data['fill_ratios'], data['sources'], data['large_ids'], None if seed < 0 else seed)
@@ -0,0 +1,134 @@
+from PIL import Image, ImageDraw
+import os
+import queue
+import threading
+import numpy as np
+from .image_record import ImageRecord
+from .bbox_array import bbox_corners, format_bboxes
+from .pipeline_metrics import PipelineMetrics
+
+# Параметры сохранения по умолчанию для поддерживаемых форматов
+IMAGE_FORMATS = {
+    'jpg': {'format': 'JPEG'},
+    'png': {'format': 'PNG', 'compress_level': 1},
+    'webp': {'format': 'WEBP', 'method': 4},
+}
+
+# Функция отрисовки bbox на изображении (изображение изменяется на месте)
+def draw_bboxes(image, bboxes):
+    draw = ImageDraw.Draw(image)
+    # Преобразование нормализованных координат в абсолютные координаты углов прямоугольников
+    for left, top, right, bottom in bbox_corners(bboxes, image.size[0], image.size[1]).tolist():
+        draw.rectangle([left, top, right, bottom], outline="red", width=2)
+    return image
+
+
+# Конвейерная запись картинок, аннотаций и превью: основной поток ставит задачи в ограниченную очередь,
+# потоки-обработчики кодируют картинки, аннотации пишутся пачками
+class MosaicWriter:
+    # image_format: 'jpg', 'png' или 'webp'; quality и subsampling применяются к jpg/webp;
+    # preview: доля картинок, для которых сохраняется превью с рамками (0 - без превью, 1 - для всех);
+    # metrics (PipelineMetrics) получает глубину очереди при каждой записи и число ошибок записи
+    def __init__(self, images_directory, labels_directory, preview_directory=None, num_threads=None, queue_size=None,
+                 image_format='jpg', quality=75, subsampling=None, preview=1.0, label_batch_size=64, metrics=None):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Неподдерживаемый формат изображений: {image_format}. Доступны: {', '.join(IMAGE_FORMATS)}")
+        self.images_directory = images_directory
+        self.labels_directory = labels_directory
+        self.preview_directory = preview_directory if preview else None
+        self.image_format = image_format
+        self.preview = preview
+        self.label_batch_size = label_batch_size
+        self.num_threads = num_threads or min(8, os.cpu_count() or 1)
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+
+        self.save_options = dict(IMAGE_FORMATS[image_format])
+        if image_format in ('jpg', 'webp'):
+            self.save_options['quality'] = quality
+        if image_format == 'jpg' and subsampling is not None:
+            self.save_options['subsampling'] = subsampling
+
+        for directory in (images_directory, labels_directory, self.preview_directory):
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+        self.count = 0
+        self._labels = []
+        self._errors = []
+        self._queue = queue.Queue(maxsize=queue_size or 4 * self.num_threads)
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Поток-обработчик очереди задач
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception as e:
+                self.metrics.count('write_errors')
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    # Нужно ли сохранять превью для картинки с номером idx (равномерная детерминированная выборка)
+    def _with_preview(self, idx):
+        return self.preview_directory is not None and int((idx + 1) * self.preview) > int(idx * self.preview)
+
+    # Кодирование и сохранение картинки и ее превью
+    def _save_image(self, name, image, bboxes, with_preview):
+        if isinstance(image, ImageRecord):
+            image = image.load()
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image.save(os.path.join(self.images_directory, f'{name}.{self.image_format}'), **self.save_options)
+        if with_preview:
+            # Рамки рисуются на копии, сохраненная картинка не изменяется
+            preview = draw_bboxes(image.copy(), bboxes)
+            preview.save(os.path.join(self.preview_directory, f'{name}.{self.image_format}'), **self.save_options)
+
+    # Запись пачки файлов аннотаций
+    @staticmethod
+    def _save_labels(labels):
+        for path, text in labels:
+            with open(path, 'w') as file:
+                file.write(text)
+
+    # Передача пачки накопленных аннотаций потокам-обработчикам
+    def _flush_labels(self):
+        if self._labels:
+            labels, self._labels = self._labels, []
+            self._queue.put(lambda: self._save_labels(labels))
+
+    # Постановка в очередь картинки (PIL.Image, массив uint8 HWC или ImageRecord) и ее аннотаций. Блокируется при заполненной очереди
+    def write(self, image, bboxes, name=None):
+        idx = self.count
+        self.count += 1
+        name = name or f'image_{idx}'
+        with_preview = self._with_preview(idx)
+        self.metrics.observe('writer_queue_depth', self._queue.qsize())
+        self._queue.put(lambda: self._save_image(name, image, bboxes, with_preview))
+        self._labels.append((os.path.join(self.labels_directory, f'{name}.txt'), format_bboxes(bboxes)))
+        if len(self._labels) >= self.label_batch_size:
+            self._flush_labels()
+
+    # Завершение записи: ожидание всех задач и остановка потоков. Первая ошибка записи пробрасывается
+    def close(self):
+        if self._threads:
+            self._flush_labels()
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        if self._errors:
+            raise self._errors[0]
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+
+# Сбор метрик этапов конвейера: время и скорость этапов, счетчики событий (отказы аугментации, ошибки декодирования)
+# и наблюдаемые величины (заполнение полотен, глубина очередей).
+# output определяет, куда уходят события завершения этапов и итоговый отчет flush():
+# None - только в памяти (report()), 'log' - печать, путь к .json - файл с отчетом, функция - вызов с событием,
+# либо список из нескольких таких вариантов
+class PipelineMetrics:
+    def __init__(self, output=None):
+        if output is None:
+            output = []
+        elif isinstance(output, str) or callable(output):
+            output = [output]
+        self.outputs = list(output)
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.values = {}
+
+    # В дочерние процессы метрики передаются без выводов: собранное там в родительский процесс не возвращается
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['outputs'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # Замер этапа: with metrics.stage('name') as stage: ... stage.add(n)
+    def stage(self, name, items=0):
+        return StageTimer(self, name, items)
+
+    # Увеличение счетчика события
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Учет наблюдаемой величины: хранятся число наблюдений, сумма, минимум, максимум и последнее значение
+    def observe(self, name, value):
+        with self._lock:
+            stats = self.values.get(name)
+            if stats is None:
+                self.values[name] = {'count': 1, 'sum': value, 'min': value, 'max': value, 'last': value}
+            else:
+                stats['count'] += 1
+                stats['sum'] += value
+                stats['min'] = min(stats['min'], value)
+                stats['max'] = max(stats['max'], value)
+                stats['last'] = value
+
+    # Учет завершенного этапа (повторные запуски этапа суммируются)
+    def _finish_stage(self, name, seconds, items):
+        with self._lock:
+            stats = self.stages.setdefault(name, {'runs': 0, 'seconds': 0.0, 'items': 0})
+            stats['runs'] += 1
+            stats['seconds'] += seconds
+            stats['items'] += items
+        self._emit({'event': 'stage', 'stage': name, 'seconds': round(seconds, 4), 'items': items,
+                    'items_per_sec': round(items / seconds, 2) if seconds else None})
+
+    # Итоговый отчет по всем этапам, счетчикам и величинам
+    def report(self):
+        with self._lock:
+            stages = {name: {**stats, 'items_per_sec': round(stats['items'] / stats['seconds'], 2) if stats['seconds'] else None}
+                      for name, stats in self.stages.items()}
+            values = {name: {**stats, 'mean': stats['sum'] / stats['count']} for name, stats in self.values.items()}
+            return {'stages': stages, 'counters': dict(self.counters), 'values': values}
+
+    # Передача отчета во все выводы
+    def flush(self):
+        self._emit({'event': 'report', **self.report()})
+
+    def _emit(self, event):
+        for output in self.outputs:
+            try:
+                if callable(output):
+                    output(event)
+                elif output == 'log':
+                    print(_format_event(event))
+                else:
+                    # JSON-файл всегда содержит актуальный отчет
+                    with open(output + '.tmp', 'w', encoding='utf-8') as file:
+                        json.dump(self.report(), file, indent=2)
+                    os.replace(output + '.tmp', output)
+            except Exception as e:
+                print(f"Ошибка вывода метрик в {output}: {e}")
+
+
+# Контекст замера одного этапа
+class StageTimer:
+    def __init__(self, metrics, name, items=0):
+        self.metrics = metrics
+        self.name = name
+        self.items = items
+
+    # Учет обработанных элементов этапа
+    def add(self, items=1):
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics._finish_stage(self.name, time.perf_counter() - self.start, self.items)
+
+
+# Строка лога для события метрик
+def _format_event(event):
+    if event['event'] == 'stage':
+        return f"[metrics] {event['stage']}: {event['items']} items за {event['seconds']:.3f} s ({event['items_per_sec'] or 0:.1f} items/sec)"
+    lines = ['[metrics] Отчет:']
+    lines += [f"  {name}: {stats['items']} items за {stats['seconds']:.3f} s ({stats['items_per_sec'] or 0:.1f} items/sec)"
+              for name, stats in event['stages'].items()]
+    lines += [f"  {name}: {value}" for name, value in event['counters'].items()]
+    lines += [f"  {name}: mean {stats['mean']:.3f}, min {stats['min']:.3f}, max {stats['max']:.3f}"
+              for name, stats in event['values'].items()]
+    return '\n'.join(lines)
@@ -0,0 +1,103 @@
+from PIL import Image
+import io
+import os
+import json
+import numpy as np
+from torch.utils.data import Dataset
+from .image_record import ImageRecord
+from .shard_writer import SHARD_VERSION, ShardWriter, shards_exist  # Запись шардов вынесена в shard_writer (без torch), импорт отсюда сохранен
+
+# Dataset поверх шардированного набора: произвольный доступ через memmap шардов и последовательное чтение
+# крупными блоками (iter_samples). Элементы - пары (PIL.Image, bbox) как у YoloDataset
+class ShardDataset(Dataset):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        with np.load(os.path.join(directory, 'index.npz')) as index:
+            self.index = {name: index[name] for name in index.files}
+        self._memmaps = {}
+
+    # Проверка, что в папке сохранен шардированный набор
+    @staticmethod
+    def exists(directory):
+        return shards_exist(directory)
+
+    # В дочерние процессы DataLoader отображения файлов не передаются, они открываются заново
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memmaps'] = {}
+        return state
+
+    def __len__(self):
+        return self.meta['count']
+
+    def bboxes(self, idx):
+        label_offsets = self.index['label_offsets']
+        return self.index['labels'][label_offsets[idx]:label_offsets[idx + 1]]
+
+    # Преобразование байтов шарда в массив пикселей uint8 HWC
+    def _decode(self, data, idx):
+        shape = (int(self.index['height'][idx]), int(self.index['width'][idx]), 3)
+        if self.meta['image_format'] == 'raw':
+            return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+        with Image.open(io.BytesIO(data)) as img:
+            return np.asarray(img.convert('RGB'))
+
+    # Пиксели картинки idx (для raw - представление memmap без копирования)
+    def get(self, idx):
+        shard = int(self.index['shard'][idx])
+        memmap = self._memmaps.get(shard)
+        if memmap is None:
+            memmap = self._memmaps[shard] = np.memmap(os.path.join(self.directory, f'pixels_{shard:05d}.bin'), dtype=np.uint8, mode='r')
+        offset = int(self.index['offset'][idx])
+        return self._decode(memmap[offset:offset + int(self.index['nbytes'][idx])], idx)
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise IndexError(idx)
+        return Image.fromarray(self.get(idx)), self.bboxes(idx)
+
+    # Последовательное чтение набора: каждый шард читается блоками не меньше read_bytes
+    def iter_samples(self, read_bytes=64 * 2**20):
+        shards, offsets, nbytes = self.index['shard'], self.index['offset'], self.index['nbytes']
+        idx = 0
+        while idx < len(self):
+            shard = shards[idx]
+            with open(os.path.join(self.directory, f'pixels_{shard:05d}.bin'), 'rb') as file:
+                while idx < len(self) and shards[idx] == shard:
+                    # Блок из подряд идущих картинок шарда суммарным размером не меньше read_bytes
+                    end = idx + 1
+                    while end < len(self) and shards[end] == shard and offsets[end] + nbytes[end] - offsets[idx] <= read_bytes:
+                        end += 1
+                    file.seek(offsets[idx])
+                    block = file.read(int(offsets[end - 1] + nbytes[end - 1] - offsets[idx]))
+                    for item in range(idx, end):
+                        start = int(offsets[item] - offsets[idx])
+                        yield Image.fromarray(self._decode(block[start:start + int(nbytes[item])], item)), self.bboxes(item)
+                    idx = end
+
+    # Записи ShardRecord поверх шардов: пиксели читаются из шарда при load(), например для сборки мозаик
+    def records(self):
+        return [ShardRecord(self, idx) for idx in range(len(self))]
+
+
+# Запись о картинке шардированного набора: пиксели читаются из шарда (ShardDataset.get), а не из файла.
+# path ('папка#номер') - только идентификатор картинки для планов, манифестов и отчетов
+class ShardRecord(ImageRecord):
+    __slots__ = ('dataset', 'index')
+
+    def __init__(self, dataset, index):
+        super().__init__(f'{dataset.directory}#{index}', int(dataset.index['width'][index]), int(dataset.index['height'][index]),
+                         dataset.bboxes(index))
+        self.dataset = dataset
+        self.index = index
+
+    def load(self):
+        return self._decode()
+
+    def _decode(self):
+        return Image.fromarray(self.dataset.get(self.index))
+
+    def __repr__(self):
+        return f"ShardRecord({self.path!r}, {self.width}x{self.height}, bboxes={len(self.bboxes)})"
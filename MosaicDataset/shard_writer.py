@@ -0,0 +1,115 @@
+from PIL import Image
+import io
+import os
+import json
+import concurrent.futures
+from collections import deque
+import numpy as np
+from .image_record import ImageRecord
+from .mosaic_writer import IMAGE_FORMATS
+
+# Формат шардированного набора: картинки подряд пишутся в крупные файлы pixels_NNNNN.bin
+# (сырые пиксели uint8 HWC при image_format='raw' или закодированные jpg/png/webp), индекс смещений
+# и все аннотации одним массивом хранятся в index.npz, параметры набора - в meta.json
+SHARD_VERSION = 1
+
+# Проверка, что в папке сохранен шардированный набор
+def shards_exist(directory):
+    return os.path.exists(os.path.join(directory, 'index.npz')) and os.path.exists(os.path.join(directory, 'meta.json'))
+
+# Запись набора картинок и аннотаций в шарды. Кодирование выполняется в num_threads потоков,
+# в шард данные пишутся в порядке поступления; индекс сохраняется в close()
+class ShardWriter:
+    def __init__(self, directory, image_format='jpg', quality=75, shard_bytes=1 << 30, num_threads=None):
+        if image_format != 'raw' and image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Неподдерживаемый формат шардов: {image_format}. Доступны: raw, {', '.join(IMAGE_FORMATS)}")
+        self.directory = directory
+        self.image_format = image_format
+        self.shard_bytes = shard_bytes
+        self.num_threads = num_threads or min(8, os.cpu_count() or 1)
+        self.save_options = dict(IMAGE_FORMATS.get(image_format, {}))
+        if image_format in ('jpg', 'webp'):
+            self.save_options['quality'] = quality
+        os.makedirs(directory, exist_ok=True)
+
+        self.count = 0
+        self._shard_idx = -1
+        self._shard_file = None
+        self._index = {'shard': [], 'offset': [], 'nbytes': [], 'height': [], 'width': []}
+        self._labels = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.num_threads)
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Кодирование картинки (PIL.Image, массив uint8 HWC или ImageRecord) в байты шарда
+    def _encode(self, image):
+        if isinstance(image, ImageRecord):
+            image = image.load()
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if self.image_format == 'raw':
+            data = np.asarray(image).tobytes()
+        else:
+            buffer = io.BytesIO()
+            image.save(buffer, **self.save_options)
+            data = buffer.getvalue()
+        return data, image.height, image.width
+
+    # Запись закодированной картинки в текущий шард (новый шард открывается при превышении shard_bytes)
+    def _write_encoded(self, future):
+        data, height, width = future.result()
+        if self._shard_file is None or (self._shard_file.tell() and self._shard_file.tell() + len(data) > self.shard_bytes):
+            if self._shard_file is not None:
+                self._shard_file.close()
+            self._shard_idx += 1
+            self._shard_file = open(os.path.join(self.directory, f'pixels_{self._shard_idx:05d}.bin'), 'wb')
+        self._index['shard'].append(self._shard_idx)
+        self._index['offset'].append(self._shard_file.tell())
+        self._index['nbytes'].append(len(data))
+        self._index['height'].append(height)
+        self._index['width'].append(width)
+        self._shard_file.write(data)
+
+    # Постановка картинки и ее аннотаций в очередь записи. Блокируется, если в работе слишком много картинок
+    def write(self, image, bboxes):
+        self._pending.append(self._executor.submit(self._encode, image))
+        self._labels.append(np.asarray(bboxes, dtype=np.float32).reshape(-1, 5))
+        self.count += 1
+        while len(self._pending) > 4 * self.num_threads:
+            self._write_encoded(self._pending.popleft())
+
+    # Завершение записи: дописываются оставшиеся картинки, сохраняются индекс и параметры набора
+    def close(self):
+        if self._executor is None:
+            return
+        try:
+            while self._pending:
+                self._write_encoded(self._pending.popleft())
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            if self._shard_file is not None:
+                self._shard_file.close()
+
+        lengths = [len(labels) for labels in self._labels]
+        index_path = os.path.join(self.directory, 'index.npz')
+        with open(index_path + '.tmp', 'wb') as file:
+            np.savez(file,
+                     shard=np.asarray(self._index['shard'], dtype=np.int32),
+                     offset=np.asarray(self._index['offset'], dtype=np.int64),
+                     nbytes=np.asarray(self._index['nbytes'], dtype=np.int64),
+                     height=np.asarray(self._index['height'], dtype=np.int32),
+                     width=np.asarray(self._index['width'], dtype=np.int32),
+                     label_offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                     labels=np.concatenate(self._labels) if self._labels else np.empty((0, 5), dtype=np.float32))
+        os.replace(index_path + '.tmp', index_path)
+        with open(os.path.join(self.directory, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump({'version': SHARD_VERSION, 'image_format': self.image_format, 'count': self.count,
+                       'shards': self._shard_idx + 1}, file)
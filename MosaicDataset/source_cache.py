@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: слияние индекса выполняется без межпроцессной блокировки
+    fcntl = None
+
+# Постоянный кэш подготовленных (уменьшенных под полотно) исходных картинок и их аннотаций.
+# Пиксели дописываются в бинарные шарды (один открытый шард на процесс), записи индекса - в журнал процесса.
+# flush() сливает журналы в общий index.json и освобождает место по принципу LRU, если задан max_bytes:
+# шарды, заметная часть которых вытеснена, переписываются, поэтому на диске остается не больше ~4/3 max_bytes
+# плюс по одному открытому шарду на процесс.
+# Ключ записи зависит от содержимого (или mtime+размера) файлов картинки и разметки и параметров подготовки.
+# Потокобезопасен: запись пикселей, смена шарда, журнал и обновление отображений шардов выполняются под блокировкой
+class SourceCache:
+    INDEX_VERSION = 2
+    COMPACT_RATIO = 0.25  # Доля вытесненных байт, при которой шард переписывается
+
+    def __init__(self, directory, max_bytes=None, key_mode='mtime', shard_bytes=256 * 2**20):
+        if key_mode not in ('mtime', 'hash'):
+            raise ValueError(f"Неизвестный режим ключа кэша: {key_mode}. Доступны: mtime, hash")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.key_mode = key_mode
+        self.shard_bytes = shard_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._reset_state()
+
+    def _reset_state(self):
+        self._lock = threading.RLock()  # Новая блокировка и в процессе, созданном через fork
+        self._entries = None  # Индекс загружается при первом обращении (в том числе в дочерних процессах)
+        self._pid = None
+        self._shard_file = None
+        self._shard_name = None
+        self._journal_file = None
+        self._memmaps = {}
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+
+    # В дочерние процессы передаются только параметры кэша, в каждом процессе используется один экземпляр
+    def __reduce__(self):
+        return (_open_cache, (self.directory, self.max_bytes, self.key_mode, self.shard_bytes))
+
+    # Функция построения ключа записи по файлам пары и параметрам подготовки
+    def make_key(self, img_path, txt_path, *params):
+        digest = hashlib.sha1(repr(params).encode())
+        for path in (img_path, txt_path):
+            if self.key_mode == 'hash':
+                with open(path, 'rb') as file:
+                    for block in iter(lambda: file.read(2**20), b''):
+                        digest.update(block)
+            else:
+                stat = os.stat(path)
+                digest.update(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}".encode())
+        return digest.hexdigest()
+
+    # Загрузка индекса: общий index.json и непрочитанные части журналов всех процессов.
+    # Возвращает записи (без записей с удаленными шардами) и прочитанные длины журналов: строки журналов,
+    # уже слитые в индекс, повторно не читаются, поэтому вытесненные записи не возвращаются
+    def _load_index(self):
+        entries, consumed = {}, {}
+        index_path = os.path.join(self.directory, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as file:
+                index = json.load(file)
+            if index.get('version') == self.INDEX_VERSION:
+                entries.update(index['entries'])
+                consumed.update(index['journals'])
+            else:
+                entries.update(index)  # Индекс прежнего формата: только записи
+        journals = {}
+        for journal in sorted(f for f in os.listdir(self.directory) if f.startswith('journal_')):
+            with open(os.path.join(self.directory, journal), 'rb') as file:
+                file.seek(consumed.get(journal, 0))
+                data = file.read()
+            complete = data[:data.rfind(b'\n') + 1]  # Недописанная последняя строка будет прочитана позже
+            for line in complete.splitlines():
+                try:
+                    key, entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[key] = entry
+            journals[journal] = consumed.get(journal, 0) + len(complete)
+        existing = set(os.listdir(self.directory))
+        return {key: entry for key, entry in entries.items() if entry['shard'] in existing}, journals
+
+    @property
+    def entries(self):
+        if self._pid is not None and self._pid != os.getpid():
+            self._reset_state()  # Процесс создан через fork: открытые файлы и блокировка родителя не используются
+        with self._lock:
+            if self._entries is None:
+                self._pid = os.getpid()
+                with _directory_lock(self.directory):  # Журналы не удаляются слиянием во время чтения
+                    self._entries, _ = self._load_index()
+            return self._entries
+
+    # Получение аннотаций и размера записи без чтения пикселей
+    def get_meta(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return tuple(entry['shape'][1::-1]), np.asarray(entry['bboxes'], dtype=np.float32).reshape(-1, 5)
+
+    # Получение пикселей записи (uint8 HWC, только для чтения) или None при промахе
+    def get(self, key):
+        entries = self.entries
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            shard_path = os.path.join(self.directory, entry['shard'])
+            nbytes = int(np.prod(entry['shape']))
+            memmap = self._memmaps.get(entry['shard'])
+            if memmap is None or entry['offset'] + nbytes > memmap.size:
+                try:
+                    memmap = self._memmaps[entry['shard']] = np.memmap(shard_path, dtype=np.uint8, mode='r')
+                except FileNotFoundError:  # Шард переписан при слиянии индекса другим процессом
+                    del entries[key]
+                    self.misses += 1
+                    return None
+            entry['atime'] = time.time()
+            self.hits += 1
+            return memmap[entry['offset']:entry['offset'] + nbytes].reshape(entry['shape'])
+
+    # Открытие нового шарда и журнала текущего процесса
+    def _open_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        self._shard_name = f"shard_{os.getpid()}_{time.time_ns()}.bin"
+        self._shard_file = open(os.path.join(self.directory, self._shard_name), 'ab')
+
+    # Дозапись пикселей в открытый шард процесса (со сменой шарда по shard_bytes): возвращает шард и смещение
+    def _append(self, pixels):
+        if self._shard_file is None or self._shard_file.tell() + pixels.nbytes > self.shard_bytes:
+            self._open_shard()
+        offset = self._shard_file.tell()
+        self._shard_file.write(pixels.data)
+        self._shard_file.flush()
+        return self._shard_name, offset
+
+    # Сохранение пикселей и аннотаций записи
+    # Смещение, запись пикселей, смена шарда и строка журнала выполняются под одной блокировкой
+    def put(self, key, pixels, bboxes):
+        entries = self.entries
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        bboxes = np.asarray(bboxes, dtype=np.float32).tolist()
+        with self._lock:
+            if self._journal_file is None:
+                self._journal_file = open(os.path.join(self.directory, f"journal_{os.getpid()}.jsonl"), 'a', encoding='utf-8')
+            shard, offset = self._append(pixels)
+            entry = {'shard': shard, 'offset': offset, 'shape': list(pixels.shape), 'bboxes': bboxes, 'atime': time.time()}
+            entries[key] = entry
+            self._journal_file.write(json.dumps([key, entry]) + '\n')
+            self._journal_file.flush()
+            self.puts += 1
+
+    # Слияние журналов в общий индекс и вытеснение давно не используемых записей сверх max_bytes.
+    # Процессы, разделяющие директорию (ранги DDP), выполняют слияние по очереди
+    def flush(self):
+        own_entries = self.entries
+        with self._lock, _directory_lock(self.directory):
+            # Список шардов снимается до чтения журналов: все строки журналов для шардов, кроме последнего шарда
+            # каждого процесса, к этому моменту уже записаны
+            shards = sorted(f for f in os.listdir(self.directory) if f.startswith('shard_'))
+            entries, journals = self._load_index()
+            for key, entry in own_entries.items():
+                if key in entries:
+                    entries[key]['atime'] = max(entries[key]['atime'], entry['atime'])
+
+            if self.max_bytes is not None:
+                total = sum(int(np.prod(entry['shape'])) for entry in entries.values())
+                for key in sorted(entries, key=lambda key: entries[key]['atime']):
+                    if total <= self.max_bytes:
+                        break
+                    total -= int(np.prod(entries[key]['shape']))
+                    del entries[key]
+                    self.evictions += 1
+
+            # Шарды, в которые пишут работающие процессы, не переписываются и не удаляются
+            active = {}
+            for shard in shards:
+                pid = int(shard.split('_')[1])
+                if _process_alive(pid, own=False):
+                    active[pid] = shard
+            active = set(active.values()) | {self._shard_name}
+            self._compact(entries, [shard for shard in shards if shard not in active])
+
+            # Журналы завершившихся процессов и собственный журнал уже учтены в индексе
+            removed = [journal for journal in journals if not _process_alive(int(journal[len('journal_'):-len('.jsonl')]))
+                       or journal == f"journal_{os.getpid()}.jsonl"]
+            index_path = os.path.join(self.directory, 'index.json')
+            tmp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'version': self.INDEX_VERSION, 'entries': entries,
+                           'journals': {journal: size for journal, size in journals.items() if journal not in removed}}, file)
+            os.replace(tmp_path, index_path)
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            for journal in removed:
+                os.remove(os.path.join(self.directory, journal))
+
+            # Шарды без живых записей удаляются
+            live_shards = {entry['shard'] for entry in entries.values()}
+            for shard in shards:
+                if shard not in live_shards and shard not in active:
+                    self._memmaps.pop(shard, None)
+                    os.remove(os.path.join(self.directory, shard))
+            self._entries = entries
+
+    # Перенос живых записей из шардов, где вытеснено больше COMPACT_RATIO байт, в открытый шард процесса.
+    # Старые шарды остаются без записей и удаляются после сохранения индекса
+    def _compact(self, entries, shards):
+        by_shard = {}
+        for entry in entries.values():
+            by_shard.setdefault(entry['shard'], []).append(entry)
+        for shard in shards:
+            shard_entries = by_shard.get(shard)
+            if not shard_entries:
+                continue
+            shard_path = os.path.join(self.directory, shard)
+            size = os.path.getsize(shard_path)
+            live = sum(int(np.prod(entry['shape'])) for entry in shard_entries)
+            if size - live <= size * self.COMPACT_RATIO:
+                continue
+            with open(shard_path, 'rb') as file:
+                for entry in sorted(shard_entries, key=lambda entry: entry['offset']):
+                    file.seek(entry['offset'])
+                    pixels = np.frombuffer(file.read(int(np.prod(entry['shape']))), dtype=np.uint8)
+                    entry['shard'], entry['offset'] = self._append(pixels)
+
+    # Статистика использования кэша
+    def stats(self):
+        entries = self.entries
+        return {
+            'entries': len(entries),
+            'bytes': sum(int(np.prod(entry['shape'])) for entry in entries.values()),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            'puts': self.puts,
+            'evictions': self.evictions,
+        }
+
+    # Полная очистка кэша
+    def clear(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._memmaps = {}
+        for name in os.listdir(self.directory):
+            if name.startswith(('shard_', 'journal_', 'index.json')):
+                os.remove(os.path.join(self.directory, name))
+        self._reset_state()
+
+
+# Экземпляры кэша, восстановленные в текущем процессе
+_instances = {}
+
+# Получение единственного в процессе экземпляра кэша для директории
+def _open_cache(directory, max_bytes, key_mode, shard_bytes):
+    key = (os.path.abspath(directory), os.getpid())
+    if key not in _instances:
+        _instances[key] = SourceCache(directory, max_bytes=max_bytes, key_mode=key_mode, shard_bytes=shard_bytes)
+    return _instances[key]
+
+# Межпроцессная блокировка директории кэша на время слияния индекса
+@contextlib.contextmanager
+def _directory_lock(directory):
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, 'flush.lock'), 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+# Проверка, что процесс с данным pid еще работает (own=False - текущий процесс считается завершенным)
+def _process_alive(pid, own=True):
+    if pid == os.getpid():
+        return own
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
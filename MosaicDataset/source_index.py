@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import concurrent.futures
+from .image_record import IMAGE_EXTENSIONS
+
+# Параллельный обход дерева исходников через os.scandir с сопоставлением картинок и разметки по относительному пути.
+# Разметка ищется в папке, где самый глубокий компонент пути images заменен на labels (как в Ultralytics:
+# images/train/x.jpg -> labels/train/x.txt, a/images/x.jpg -> a/labels/x.txt), иначе рядом с картинкой (a/b/x.jpg -> a/b/x.txt).
+# При заданном index_path списки файлов каталогов сохраняются на диск, и при повторном обходе
+# перечитываются только каталоги, mtime которых изменился (mtime каталога меняется при добавлении,
+# удалении и переименовании его файлов)
+class SourceIndex:
+    VERSION = 1
+
+    def __init__(self, index_path=None, num_threads=None):
+        self.index_path = index_path
+        self.num_threads = num_threads or min(32, 4 * (os.cpu_count() or 1))
+        self.last_scan = {}  # Статистика последнего обхода: время, число каталогов, перечитанных каталогов и пар
+
+    # Загрузка индекса каталогов для корня root
+    def _load(self, root):
+        if self.index_path and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                if data.get('version') == self.VERSION and data.get('root') == root:
+                    return data['dirs']
+            except (OSError, ValueError) as e:
+                print(f"Индекс исходников {self.index_path} не прочитан, выполняется полный обход: {e}")
+        return {}
+
+    def _save(self, root, dirs):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'version': self.VERSION, 'root': root, 'dirs': dirs}, file)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    # Чтение одного каталога: из индекса, если mtime не изменился, иначе через os.scandir
+    @staticmethod
+    def _scan_dir(root, rel_dir, cached):
+        path = os.path.join(root, rel_dir) if rel_dir else root
+        mtime = os.stat(path).st_mtime_ns
+        if cached is not None and cached['mtime'] == mtime:
+            return rel_dir, cached, False
+        entry = {'mtime': mtime, 'images': [], 'labels': [], 'subdirs': []}
+        with os.scandir(path) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    entry['subdirs'].append(item.name)
+                elif item.name.lower().endswith(IMAGE_EXTENSIONS):
+                    entry['images'].append(item.name)
+                elif item.name.lower().endswith('.txt'):
+                    entry['labels'].append(item.name)
+        return rel_dir, entry, True
+
+    # Обход дерева src_directory: каталоги читаются параллельно по мере обнаружения. Возвращает пары (картинка, разметка)
+    def scan(self, src_directory):
+        start = time.perf_counter()
+        root = os.path.abspath(src_directory)
+        cached_dirs = self._load(root)
+        dirs = {}
+        rescanned = 0
+
+        with concurrent.futures.ThreadPoolExecutor(self.num_threads) as executor:
+            pending = {executor.submit(self._scan_dir, root, '', cached_dirs.get(''))}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        rel_dir, entry, scanned = future.result()
+                    except OSError as e:
+                        print(f"Ошибка чтения каталога: {e}")
+                        continue
+                    dirs[rel_dir] = entry
+                    rescanned += scanned
+                    for name in entry['subdirs']:
+                        sub_dir = os.path.join(rel_dir, name) if rel_dir else name
+                        pending.add(executor.submit(self._scan_dir, root, sub_dir, cached_dirs.get(sub_dir)))
+
+        pairs = self._match(root, dirs)
+        if self.index_path:
+            self._save(root, dirs)
+        self.last_scan = {'seconds': round(time.perf_counter() - start, 4), 'directories': len(dirs),
+                          'rescanned_directories': rescanned, 'pairs': len(pairs)}
+        return pairs
+
+    # Сопоставление картинок и разметки по относительному пути (без расширения)
+    @staticmethod
+    def _match(root, dirs):
+        labels = {}
+        for rel_dir, entry in dirs.items():
+            for name in entry['labels']:
+                labels[os.path.join(rel_dir, os.path.splitext(name)[0])] = os.path.join(root, rel_dir, name)
+
+        pairs = []
+        for rel_dir in sorted(dirs):
+            label_dirs = [label_dir for label_dir in (_labels_dir(rel_dir), rel_dir) if label_dir is not None]
+            for name in sorted(dirs[rel_dir]['images']):
+                stem = os.path.splitext(name)[0]
+                for label_dir in label_dirs:
+                    txt_path = labels.get(os.path.join(label_dir, stem))
+                    if txt_path:
+                        pairs.append((os.path.join(root, rel_dir, name), txt_path))
+                        break
+        return pairs
+
+# Папка разметки для папки картинок rel_dir: самый глубокий компонент images заменяется на labels (None, если его нет)
+def _labels_dir(rel_dir):
+    parts = rel_dir.split(os.sep) if rel_dir else []
+    if 'images' not in parts:
+        return None
+    idx = len(parts) - 1 - parts[::-1].index('images')
+    return os.path.join(*parts[:idx], 'labels', *parts[idx + 1:])
@@ -1,136 +1,279 @@
 import os
-import random
+import concurrent.futures
 from tqdm import tqdm
-from torch.utils.data import Dataset, DataLoader
+import numpy as np
+from .image_record import ImageRecord, IMAGE_EXTENSIONS
+from .mosaic_writer import MosaicWriter
+from .shard_writer import ShardWriter, shards_exist
+from .pipeline_metrics import PipelineMetrics
+from .dataset_manifest import DatasetManifest
+from .label_store import LabelStore
 
-# Класс разделения исходных данных на три набора обучения модели (train/val/test)
+# Класс разделения исходных данных на наборы обучения модели (train/val/test или любое число наборов).
+# Работает с записями ImageRecord, пиксели декодируются только при сохранении наборов.
+# Количества сущностей хранятся разреженной матрицей картинка x класс (CSR), оценки поднаборов считаются NumPy.
+# groups - номера групп записей (например, DuplicateIndex.group()): записи одной группы попадают в один набор
 class SplitSubset:
-    def __init__(self, image_bbox_pairs, split_ratio, tolerance=0.05):
+    def __init__(self, image_bbox_pairs, split_ratio, tolerance=0.05, seed=None, metrics=None, groups=None):
         self.image_bbox_pairs = image_bbox_pairs
         self.split_ratio = split_ratio
         self.tolerance = tolerance  # Допустимое отклонение
+        self.seed = seed  # Зерно перемешивания для воспроизводимого разделения (None - случайное)
+        self.metrics = metrics if metrics is not None else PipelineMetrics()  # Метрики этапов PipelineMetrics
+        self.unit_ids, self.members = self._build_units(groups)
+        self.classes, self.indptr, self.indices, self.counts = self._build_count_matrix()
         self.class_entities = self._count_class_entities()
+        self.class_deviation = {}  # Отклонение доли класса в каждом наборе от целевой после split()
+
+    # Единицы распределения: без групп - отдельные записи, иначе группы записей.
+    # Возвращает номер единицы каждой записи и номера записей каждой единицы (None без групп)
+    def _build_units(self, groups):
+        if groups is None:
+            return np.arange(len(self.image_bbox_pairs)), None
+        groups = np.asarray(groups)
+        if len(groups) != len(self.image_bbox_pairs):
+            raise ValueError(f"Число номеров групп ({len(groups)}) не совпадает с числом записей ({len(self.image_bbox_pairs)})")
+        _, unit_ids = np.unique(groups, return_inverse=True)
+        order = np.argsort(unit_ids, kind='stable')
+        return unit_ids, np.split(order, np.cumsum(np.bincount(unit_ids))[:-1])
+
+    # Построение разреженной матрицы единица распределения (картинка или группа) x класс: для единицы j
+    # столбцы indices[indptr[j]:indptr[j+1]] содержат количества counts сущностей соответствующих классов
+    def _build_count_matrix(self):
+        lengths = np.array([len(record.bboxes) for record in self.image_bbox_pairs], dtype=np.int64)
+        class_ids = np.concatenate([record.bboxes[:, 0] for record in self.image_bbox_pairs] or [np.empty(0, dtype=np.float32)]).astype(np.int64)
+        classes, columns = np.unique(class_ids, return_inverse=True)
+        rows = np.repeat(self.unit_ids, lengths)
+        keys, counts = np.unique(rows * max(len(classes), 1) + columns, return_counts=True)
+        row_lengths = np.bincount(keys // max(len(classes), 1), minlength=self.num_units)
+        indptr = np.concatenate([[0], np.cumsum(row_lengths)])
+        return classes, indptr, keys % max(len(classes), 1), counts
+
+    # Число единиц распределения
+    @property
+    def num_units(self):
+        return len(self.image_bbox_pairs) if self.members is None else len(self.members)
 
     # Считаем общее количество сущностей каждого класса
     def _count_class_entities(self):
-        class_entities = {}
-        for _, bboxes in self.image_bbox_pairs:
-            for bbox in bboxes:
-                class_id = bbox[0]
-                class_entities[class_id] = class_entities.get(class_id, 0) + 1
-        return class_entities
-
-    # Распределение сущностей по наборам согласно split_ratio
-    def _distribute_entities(self):
-        distributed_entities = {i: {} for i in range(len(self.split_ratio))}
-        for class_id, total in self.class_entities.items():
-            for i, ratio in enumerate(self.split_ratio):
-                entities_count = int(total * ratio)
-                tolerance_count = int(self.tolerance * total)
-                distributed_entities[i][class_id] = max(entities_count - tolerance_count, 0)
-        return distributed_entities
+        totals = np.bincount(self.indices, weights=self.counts, minlength=len(self.classes)).astype(np.int64)
+        return dict(zip(self.classes.tolist(), totals.tolist()))
+
+    # Распределение сущностей по наборам согласно split_ratio: массив (наборы, классы).
+    # assigned - уже распределенные сущности (наборы, классы): цель считается от общего количества, а их доля вычитается
+    def _distribute_entities(self, assigned=None):
+        totals = np.array(list(self.class_entities.values()), dtype=np.int64)
+        if assigned is not None:
+            totals = totals + assigned.sum(axis=0)
+        ratios = np.asarray(self.split_ratio, dtype=np.float64)[:, None]
+        entities_count = np.floor(totals * ratios).astype(np.int64)
+        tolerance_count = np.floor(self.tolerance * totals).astype(np.int64)
+        distributed = np.maximum(entities_count - tolerance_count, 0)
+        return distributed if assigned is None else distributed - assigned
     
-    # Выбор поднабора, куда лучше положить взятую картинку
-    def _select_subset(self, class_counts, distributed_entities, remaining_entities):
-        best_subset = -1
-        min_difference = float('inf')
-        for i, subset_entities in distributed_entities.items():
-            difference = 0
-            for class_id, count in class_counts.items():
-                difference += abs((subset_entities[class_id] - count) - remaining_entities[class_id])
-            if difference < min_difference:
-                min_difference = difference
-                best_subset = i
-        return best_subset 
-
-    # Основная функция стратифицированного распределения сущностей по поднаборам
-    def split(self):
+    # Выбор поднабора, куда лучше положить взятую картинку.
+    # Оценка набора i: sum_c |need[i, c] - count_c - remaining[c]| = sum_c |diff[i, c] - count_c|.
+    # base[i] = sum_c |diff[i, c]| хранится заранее, поэтому пересчитываются только классы картинки
+    def _select_subset(self, columns, class_counts, diff, base):
+        diff_columns = diff[:, columns]
+        scores = base + (np.abs(diff_columns - class_counts) - np.abs(diff_columns)).sum(axis=1)
+        return int(np.argmin(scores)), diff_columns
+
+    # Основная функция стратифицированного распределения сущностей по поднаборам.
+    # assigned_counts ({класс: [количество в каждом наборе]}) - сущности, распределенные ранее (см. check_and_update):
+    # новые картинки досыпаются в наборы так, чтобы общие доли классов оставались близки к split_ratio
+    def split(self, assigned_counts=None):
         subsets = [[] for _ in self.split_ratio]
-        remaining_entities = self.class_entities.copy()
-        distributed_entities = self._distribute_entities()
-        random.shuffle(self.image_bbox_pairs)
-
-        for img, bboxes in tqdm(self.image_bbox_pairs, desc="Splitting data", unit=" pair"):
-            class_counts = {class_id: 0 for class_id in self.class_entities}
-            for bbox in bboxes:
-                class_id = bbox[0]
-                class_counts[class_id] += 1
-            best_subset = self._select_subset(class_counts, distributed_entities, remaining_entities)
-            if best_subset != -1:
-                subsets[best_subset].append((img, bboxes))
-                for class_id, count in class_counts.items():
-                    remaining_entities[class_id] -= count
-                    distributed_entities[best_subset][class_id] -= count
-            else:
-                min_size = min(len(subset) for subset in subsets)
-                for subset in subsets:
-                    if len(subset) == min_size:
-                        subset.append((img, bboxes))
-                        break
+        if self.seed is None:
+            order = np.random.permutation(self.num_units)
+        else:
+            order = np.random.default_rng(self.seed).permutation(self.num_units)
+
+        # diff = distributed_entities - remaining_entities для каждого набора и класса
+        remaining_entities = np.array(list(self.class_entities.values()), dtype=np.int64)
+        assigned = None
+        if assigned_counts is not None:
+            assigned = np.array([assigned_counts.get(class_id, [0] * len(self.split_ratio)) for class_id in self.classes.tolist()],
+                                dtype=np.int64).reshape(-1, len(self.split_ratio)).T
+        diff = self._distribute_entities(assigned) - remaining_entities
+        base = np.abs(diff).sum(axis=1)
+        assignment = np.empty(self.num_units, dtype=np.int64)
+
+        with self.metrics.stage('split', len(order)):
+            self._assign(order, subsets, assignment, diff, base)
 
+        self.class_deviation = self._class_deviation(assignment, assigned)
+        if self.class_deviation:
+            worst = max(self.class_deviation, key=lambda class_id: max(map(abs, self.class_deviation[class_id])))
+            self.metrics.observe('split_max_class_deviation', max(map(abs, self.class_deviation[worst])))
+            print(f"Максимальное отклонение доли класса от целевой: класс {worst}, "
+                  f"{', '.join(f'{deviation:+.2%}' for deviation in self.class_deviation[worst])}")
         return subsets
+
+    # Жадное распределение картинок (или групп) в порядке order: каждая уходит в набор с наименьшей оценкой
+    def _assign(self, order, subsets, assignment, diff, base):
+        for idx in tqdm(order, desc="Splitting data", unit=" pair"):
+            columns = self.indices[self.indptr[idx]:self.indptr[idx + 1]]
+            class_counts = self.counts[self.indptr[idx]:self.indptr[idx + 1]]
+            best_subset, diff_columns = self._select_subset(columns, class_counts, diff, base)
+            assignment[idx] = best_subset
+            if self.members is None:
+                subsets[best_subset].append(self.image_bbox_pairs[idx])
+            else:
+                subsets[best_subset].extend(self.image_bbox_pairs[member] for member in self.members[idx])
+
+            # Сущности картинки уходят из remaining у всех наборов и из distributed у выбранного
+            new_columns = diff_columns + class_counts
+            new_columns[best_subset] = diff_columns[best_subset]
+            base += (np.abs(new_columns) - np.abs(diff_columns)).sum(axis=1)
+            diff[:, columns] = new_columns
+
+    # Отклонение доли сущностей каждого класса в каждом наборе от нормированного split_ratio (с учетом распределенных ранее)
+    def _class_deviation(self, assignment, assigned=None):
+        rows = np.repeat(np.arange(self.num_units), np.diff(self.indptr))
+        subset_counts = np.zeros((len(self.split_ratio), len(self.classes)), dtype=np.int64)
+        np.add.at(subset_counts, (assignment[rows], self.indices), self.counts)
+        if assigned is not None:
+            subset_counts += assigned
+        totals = np.maximum(subset_counts.sum(axis=0), 1)
+        ratios = np.asarray(self.split_ratio, dtype=np.float64)
+        deviation = subset_counts / totals - (ratios / ratios.sum())[:, None]
+        return {class_id: deviation[:, column].tolist() for column, class_id in enumerate(self.classes.tolist())}
     
-    # Функция для сохранения разделенных наборов данных в соответствующие папки
-    def save_splits(self, directory):
+    # Функция для сохранения разделенных наборов данных в соответствующие папки.
+    # Картинки декодируются и кодируются конвейером MosaicWriter в num_threads потоков.
+    # names - имена папок наборов; по умолчанию train/valid/test для трех наборов, иначе split_0, split_1, ...
+    # container='shards' сохраняет каждый набор в шарды ShardWriter (папка набора/shards) вместо отдельных файлов
+    def save_splits(self, directory, num_threads=None, image_format='jpg', quality=75, names=None, container='files', shard_bytes=1 << 30):
+        if container not in ('files', 'shards'):
+            raise ValueError(f"Неизвестный формат набора: {container}. Доступны: files, shards")
         # Разделяем данные с помощью метода split
-        train_set, valid_set, test_set = self.split()
+        subsets = self.split()
+        if names is None:
+            names = ('train', 'valid', 'test') if len(subsets) == 3 else [f'split_{idx}' for idx in range(len(subsets))]
+        if len(names) != len(subsets):
+            raise ValueError(f"Число имен наборов ({len(names)}) не совпадает с числом долей split_ratio ({len(subsets)})")
 
         # Словарь для хранения соответствий между наборами данных и их папками
-        split_sets = {"train": train_set, "valid": valid_set, "test": test_set}
+        split_sets = dict(zip(names, subsets))
         for subset_name, subset in split_sets.items():
-            # Создаем папки для изображений и аннотаций
-            subset_img_dir = os.path.join(directory, subset_name, 'images')
-            subset_labels_dir = os.path.join(directory, subset_name, 'labels')
-            os.makedirs(subset_img_dir, exist_ok=True)
-            os.makedirs(subset_labels_dir, exist_ok=True)
+            if container == 'shards':
+                writer = ShardWriter(os.path.join(directory, subset_name, 'shards'), image_format=image_format, quality=quality,
+                                     shard_bytes=shard_bytes, num_threads=num_threads)
+            else:
+                # Папки для изображений и аннотаций создаются конвейером
+                subset_img_dir = os.path.join(directory, subset_name, 'images')
+                subset_labels_dir = os.path.join(directory, subset_name, 'labels')
+                writer = MosaicWriter(subset_img_dir, subset_labels_dir, num_threads=num_threads, image_format=image_format, quality=quality,
+                                      preview=0, metrics=self.metrics)
 
             # Сохранение изображений и аннотаций
-            for idx, (image, bboxes) in enumerate(subset):
-                image_path = os.path.join(subset_img_dir, f'image_{idx}.jpg')
-                image.save(image_path) # Сохраняем изображение
-
-                bbox_path = os.path.join(subset_labels_dir, f'image_{idx}.txt')
-                with open(bbox_path, 'w') as file:
-                    for bbox in bboxes:
-                        file.write(' '.join(map(str, bbox)) + '\n') # Сохраняем аннотации
+            with self.metrics.stage('save_splits', len(subset)), writer:
+                for record in subset:
+                    writer.write(record, record.bboxes)
                         
-    # Функция для загрузки данных из папок в наборы train, val и test
+    # Функция для загрузки данных из папок в наборы train, val и test.
+    # Картинки и аннотации сопоставляются по имени файла; шардированный набор (папка shards) читается через ShardDataset
     def load_sets_from_folders(self, folders):
         loaded_sets = {}
         for subset_name, folder in folders.items():
+            shards_dir = os.path.join(folder, 'shards')
+            if shards_exist(shards_dir):
+                from .shard_dataset import ShardDataset  # torch загружается только при чтении шардированного набора
+                loaded_sets[subset_name] = ShardDataset(shards_dir).records()
+                continue
+
             images_dir = os.path.join(folder, 'images')
             labels_dir = os.path.join(folder, 'labels')
 
-            image_paths = [os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff'))]
-            label_paths = [os.path.join(labels_dir, f) for f in os.listdir(labels_dir) if f.endswith('.txt')]
-
-            image_label_pairs = []
-            for img_path, lbl_path in zip(image_paths, label_paths):
-                img = Image.open(img_path)
-                bboxes = mosaic_creator._load_bboxes(lbl_path)  # Использование метода _load_bboxes из MosaicCreator
-                image_label_pairs.append((img, bboxes))
+            label_paths = {os.path.splitext(f)[0]: os.path.join(labels_dir, f) for f in os.listdir(labels_dir) if f.endswith('.txt')}
+            pairs = [(os.path.join(images_dir, file), label_paths[os.path.splitext(file)[0]]) for file in sorted(os.listdir(images_dir))
+                     if file.lower().endswith(IMAGE_EXTENSIONS) and os.path.splitext(file)[0] in label_paths]
+            # Разметка набора загружается и проверяется LabelStore одним вызовом
+            values, offsets = LabelStore().load([txt_path for _, txt_path in pairs])
+            # Из картинки читается только заголовок, пиксели декодируются по требованию
+            image_label_pairs = [ImageRecord.from_files(img_path, txt_path, bboxes=values[offsets[idx]:offsets[idx + 1]])
+                                 for idx, (img_path, txt_path) in enumerate(pairs)]
 
             loaded_sets[subset_name] = image_label_pairs
 
-        return loaded_sets['train'], loaded_sets['valid'], loaded_sets['test']                      
+        return tuple(loaded_sets[subset_name] for subset_name in folders)                      
+
+    # Функция инкрементального обновления сохраненных наборов по манифесту dst_directory/manifest.json.
+    # Неизмененные пары остаются в своих наборах, удаленные из исходников убираются из наборов, новые и измененные
+    # пары подготавливаются mosaic_creator и распределяются с учетом уже распределенных сущностей.
+    # Первый вызов без манифеста строит наборы целиком. Возвращает количество пар по видам изменений
+    def check_and_update(self, src_directory, dst_directory, mosaic_creator, names=None, key_mode='mtime', num_threads=None,
+                         image_format='jpg', quality=75):
+        manifest = DatasetManifest(os.path.join(dst_directory, 'manifest.json'), key_mode=key_mode)
+        if names is None:
+            names = manifest.split_names or (('train', 'valid', 'test') if len(self.split_ratio) == 3 else
+                                             [f'split_{idx}' for idx in range(len(self.split_ratio))])
+        if manifest.split_names is not None and (list(manifest.split_names) != list(names) or list(manifest.split_ratio) != list(self.split_ratio)):
+            raise ValueError(f"Наборы манифеста {manifest.split_names} {manifest.split_ratio} не совпадают с {list(names)} {list(self.split_ratio)}")
+        manifest.split_names, manifest.split_ratio = list(names), list(self.split_ratio)
+
+        with self.metrics.stage('check_and_update') as stage:
+            pairs = {DatasetManifest.make_key(src_directory, img_path): (img_path, txt_path)
+                     for img_path, txt_path in mosaic_creator.find_image_label_pairs(src_directory)}
+            stage.add(len(pairs))
+            changes = {'unchanged': 0, 'added': 0, 'changed': 0, 'removed': 0, 'skipped': 0}
+
+            # Удаленные и измененные пары убираются из наборов вместе с сохраненными файлами
+            pending = []
+            for key in list(manifest.entries):
+                if key not in pairs or not manifest.is_unchanged(key, *pairs[key]):
+                    self._remove_output(dst_directory, manifest.entries.pop(key), image_format)
+                    changes['removed' if key not in pairs else 'changed'] += 1
+            for key, (img_path, txt_path) in pairs.items():
+                if key in manifest.entries:
+                    changes['unchanged'] += 1
+                else:
+                    pending.append((key, img_path, txt_path))
+            changes['added'] = len(pending) - changes['changed']
+
+            # Подготовка и распределение только новых пар
+            records, keys = [], []
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                for (key, img_path, txt_path), record in zip(pending, executor.map(lambda pair: mosaic_creator._process_image(*pair[1:]), pending)):
+                    if record is None or not len(record.bboxes):
+                        changes['skipped'] += 1
+                        continue
+                    records.append(record)
+                    keys.append(key)
+            splitter = SplitSubset(records, self.split_ratio, tolerance=self.tolerance, seed=self.seed, metrics=self.metrics)
+            subsets = splitter.split(assigned_counts=manifest.assigned_counts()) if records else [[] for _ in names]
+
+            # Сохранение новых пар в папки наборов под именами, которые не меняются между обновлениями
+            key_by_record = {id(record): key for record, key in zip(records, keys)}
+            for subset_name, subset in zip(names, subsets):
+                with MosaicWriter(os.path.join(dst_directory, subset_name, 'images'), os.path.join(dst_directory, subset_name, 'labels'),
+                                  num_threads=num_threads, image_format=image_format, quality=quality, preview=0, metrics=self.metrics) as writer:
+                    for record in subset:
+                        key = key_by_record[id(record)]
+                        output = DatasetManifest.output_name(key)
+                        writer.write(record, record.bboxes, name=output)
+                        manifest.add(key, *pairs[key], subset_name, self.count_annotations_by_class([record]), output, image_format)
 
-    # Функция для проверки и обновления наборов данных
-    def check_and_update(self, src_directory, dst_directory):
-        total_dst_pairs = 0
-        for subset in ['train', 'valid', 'test']:
-            subset_dir = os.path.join(dst_directory, subset)
-            dst_pairs = self.find_image_label_pairs(subset_dir)
-            total_dst_pairs += len(dst_pairs)
+        manifest.save()
+        for change, count in changes.items():
+            self.metrics.count(f'manifest_{change}', count)
+        print(f"Обновление наборов: {changes}")
+        return changes
 
-        return total_src_pairs == total_dst_pairs    
+    # Удаление сохраненных файлов пары из папки ее набора. Картинка удаляется в том формате, в котором была сохранена
+    # (image_format - для записей манифеста без формата)
+    @staticmethod
+    def _remove_output(dst_directory, entry, image_format):
+        written_format = entry.get('image_format') or image_format
+        for path in (os.path.join(dst_directory, entry['split'], 'images', f"{entry['output']}.{written_format}"),
+                     os.path.join(dst_directory, entry['split'], 'labels', f"{entry['output']}.txt")):
+            if os.path.exists(path):
+                os.remove(path)
     
     # Функция для подсчета количества аннотаций по каждому классу в представленном поднаборе данных
     def count_annotations_by_class(self, dataset):
-        class_counts = {}
-        for _, bboxes in dataset:
-            for bbox in bboxes:
-                class_id = int(bbox[0])
-                class_counts[class_id] = class_counts.get(class_id, 0) + 1
-        # Сортировка словаря по ключам
-        sorted_class_counts = dict(sorted(class_counts.items()))
-        return sorted_class_counts  
\ No newline at end of file
+        class_ids = np.concatenate([record.bboxes[:, 0] for record in dataset] or [np.empty(0, dtype=np.float32)]).astype(np.int64)
+        # np.unique возвращает классы в порядке возрастания
+        classes, counts = np.unique(class_ids, return_counts=True)
+        return dict(zip(classes.tolist(), counts.tolist()))  
\ No newline at end of file
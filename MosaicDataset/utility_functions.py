@@ -3,6 +3,11 @@ import os
 import shutil
 from tqdm import tqdm
 import concurrent.futures
+from collections import deque
+from .mosaic_writer import MosaicWriter
+from .shard_writer import ShardWriter
+from .pipeline_metrics import PipelineMetrics
+from .epoch_prefetcher import EpochPrefetcher
 
 # Вспомогательная функция для удаления директории
 def delete_directory(path: str):
@@ -13,45 +18,63 @@ def delete_directory(path: str):
         except OSError as e:
             print(f'[ERROR] Error deleting a directory: `{path}`: {e.strerror}')
 
-# Создание мозаик для каждого набора train/val/test
-def create_mosaics(image_bbox_pairs, augmentor=None):
-    processed_pairs = []
-    large_images = []
-    for img, bboxes in image_bbox_pairs:
-        if img.size[0] < mosaic_creator.large_image_threshold and img.size[1] < mosaic_creator.large_image_threshold:
-            processed_pairs.append((img, bboxes))
-        else:
-            large_images.append((img, bboxes))
+# Аналог executor.map с ограниченным числом задач в работе: входной итератор читается по мере готовности результатов
+def bounded_map(executor, fn, iterable, window):
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# Создание мозаик для каждого набора train/val/test из записей ImageRecord.
+# stream=True возвращает генератор пар (полотно, bbox): полотна собираются по мере потребления (например, save_mosaics).
+# rank и world_size - номер процесса и число процессов распределенного обучения: процесс собирает только свою долю полотен.
+# Раскладка зависит от seed + epoch (seed=None - раскладка по умолчанию, одинаковая во всех эпохах) и совпадает во всех процессах
+def create_mosaics(records, mosaic_creator, augmentor=None, stream=False, rank=0, world_size=1, epoch=0, seed=None):
+    processed_pairs, large_images = mosaic_creator.split_large_images(records)
+    all_images = mosaic_creator.iter_mosaics(processed_pairs, large_images, augmentor=augmentor, seed=None if seed is None else seed + epoch,
+                                             rank=rank, world_size=world_size)
+    if stream:
+        return all_images
+    return list(all_images)
 
-    mosaics, large_images = mosaic_creator.create_mosaic(processed_pairs, large_images, augmentor=augmentor)
-    all_images = mosaics + large_images
-    return all_images
+# Сохранение итоговых обучающих наборов мозаик и аннотаций.
+# all_images - список или генератор пар (картинка, bbox), например create_mosaics(..., stream=True).
+# Кодирование выполняется конвейером MosaicWriter в num_threads потоков; превью с рамками сохраняются
+# для доли preview картинок (bbox_directory=None или preview=0 - без превью).
+# container='shards' сохраняет набор в шарды ShardWriter (папка yolo_directory/shards) вместо отдельных файлов.
+# metrics (PipelineMetrics) получает время этапа save_mosaics и глубину очереди записи
+def save_mosaics(all_images, yolo_directory, bbox_directory, num_threads=None, image_format='jpg', quality=75, subsampling=None, preview=1.0,
+                 container='files', shard_bytes=1 << 30, metrics=None):
+    if container not in ('files', 'shards'):
+        raise ValueError(f"Неизвестный формат набора: {container}. Доступны: files, shards")
+    total = len(all_images) if hasattr(all_images, '__len__') else None
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if container == 'shards':
+        shards_directory = os.path.join(yolo_directory, 'shards')
+        delete_directory(shards_directory)
+        with metrics.stage('save_mosaics') as stage, ShardWriter(shards_directory, image_format=image_format, quality=quality,
+                                                                 shard_bytes=shard_bytes, num_threads=num_threads) as writer:
+            for image, bboxes in tqdm(all_images, total=total, desc="Cохранение мозаик и больших картинок в шарды", unit=" unit"):
+                writer.write(image, bboxes)
+                stage.add()
+        return writer.count
 
-# Сохранение итоговых обучающих наборов мозаик и аннотаций
-def save_mosaics(all_images, yolo_directory, bbox_directory):
     images_directory = os.path.join(yolo_directory, 'images')
     labels_directory = os.path.join(yolo_directory, 'labels')
     delete_directory(images_directory)
-    os.makedirs(images_directory, exist_ok=True)
     delete_directory(labels_directory)
-    os.makedirs(labels_directory, exist_ok=True)
-    delete_directory(bbox_directory)
-    os.makedirs(bbox_directory, exist_ok=True)
-    for idx, (image, bboxes) in tqdm(enumerate(all_images), total=len(all_images), desc="Cохранение мозаик и больших картинок", unit=" unit"):
-        # Сохранение мозаики
-        mosaic_image_path = os.path.join(images_directory, f'image_{idx}.jpg')
-        image.save(mosaic_image_path)
-
-        # Сохранение аннотации
-        annotation_path = os.path.join(labels_directory, f'image_{idx}.txt')
-        with open(annotation_path, 'w') as file:
-            for bbox in bboxes:
-                file.write(' '.join(map(str, bbox)) + '\n')
-
-        # Сохранение визуализации аннотированных изображений с рамками
-        annotated_img = mosaic_creator.draw_source_bboxes(image, bboxes)
-        annotated_img_path = os.path.join(bbox_directory, f'image_{idx}.jpg')
-        annotated_img.save(annotated_img_path)
+    if bbox_directory:
+        delete_directory(bbox_directory)
+    with metrics.stage('save_mosaics') as stage, MosaicWriter(images_directory, labels_directory, bbox_directory, num_threads=num_threads,
+                                                              image_format=image_format, quality=quality, subsampling=subsampling,
+                                                              preview=preview, metrics=metrics) as writer:
+        for image, bboxes in tqdm(all_images, total=total, desc="Cохранение мозаик и больших картинок", unit=" unit"):
+            writer.write(image, bboxes)
+            stage.add()
+    return writer.count
 
 # Функция для создания yaml файла конфигурации для YOLO датасета
 def create_yaml_file(dst_dir: str, class_lst):
@@ -78,38 +101,110 @@ def read_classes(file_name: str):
         classes = [line.strip() for line in file if line.strip()]
     return classes  
 
-# Глобальные переменные для фиксации проверочных и тестовых наборов dataloaders
+# Состояние DataLoader'ов между вызовами initialize_dataloaders: проверочные наборы фиксируются при первом вызове
 global_valid_loader = None
 global_test_loader = None
+global_train_dataset = None
+global_prefetcher = None
+global_epoch = 0
    
-# Функция для первичного и последующего создания DataLoader'ов
-def initialize_dataloaders(first_epoch, batch_size=4):
-    global global_valid_loader, global_test_loader, valid_dataset, test_dataset
+# Функция для первичного и последующего создания DataLoader'ов.
+# Обучающие мозаики собираются на лету процессами DataLoader (num_workers), в начале эпохи строится только раскладка.
+# prefetch=True включает двойную буферизацию: пока обучается текущая эпоха, фоновый процесс собирает полотна следующей
+# (очередь prefetch_queue_depth, буфер не больше prefetch_max_bytes); следующий вызов не ждет окончания сборки.
+# collate='tensor' выдает батчи (картинки uint8 NCHW, цели (total_boxes, 6)) через YoloCollate, полотна при этом
+# собираются массивами NumPy; pin_memory=True выделяет батчи в закрепленной памяти для переноса to_device(..., non_blocking=True).
+# collate='pairs' (по умолчанию) выдает списки пар (картинка, bbox).
+# При распределенном обучении (rank и world_size, по умолчанию берутся из инициализированного torch.distributed)
+# каждый процесс собирает только свою долю обучающих полотен. Проверочные мозаики при заданном shared_directory
+# собирает один процесс (rank 0) в шарды shared_directory/valid и shared_directory/test, остальные ждут и читают их с диска.
+# Пул вариантов VariantPool в процессах DataLoader (num_workers > 0) и фоновой сборке (prefetch) должен хранить варианты
+# на диске (directory): процессы пересоздаются каждую эпоху, и пул в памяти не переживал бы эпоху
+def initialize_dataloaders(first_epoch, train_set, valid_set, test_set, mosaic_creator, augmentor=None, batch_size=4, num_workers=0,
+                           prefetch=False, prefetch_queue_depth=8, prefetch_max_bytes=2 * 2**30, collate='pairs', pin_memory=False,
+                           rank=None, world_size=None, shared_directory=None):
+    global global_valid_loader, global_test_loader, global_train_dataset, global_prefetcher, global_epoch
+    # torch загружается только при создании DataLoader'ов: сборка и сохранение мозаик обходятся без него
+    import torch.distributed as dist
+    from torch.utils.data import DataLoader
+    from .yolo_dataset import MosaicYoloDataset
+    from .yolo_collate import YoloCollate
+    from .variant_pool import VariantPool
+    if isinstance(augmentor, VariantPool) and augmentor.store is None and (num_workers > 0 or prefetch):
+        raise ValueError("Пул вариантов в памяти теряет варианты вместе с процессами DataLoader: "
+                         "задайте VariantPool(..., directory=...) или num_workers=0 и prefetch=False")
+    distributed = dist.is_available() and dist.is_initialized()
+    if rank is None:
+        rank = dist.get_rank() if distributed else 0
+    if world_size is None:
+        world_size = dist.get_world_size() if distributed else 1
+    if collate not in ('pairs', 'tensor'):
+        raise ValueError(f"Неизвестный способ сборки батча: {collate}. Доступны: pairs, tensor")
+    as_array = collate == 'tensor'
+    collate_fn = YoloCollate(pin_memory=pin_memory) if as_array else _collate_pairs
+    # В процессах-обработчиках батч закрепляет DataLoader, в основном процессе - сам YoloCollate
+    loader_kwargs = {'collate_fn': collate_fn, 'pin_memory': as_array and pin_memory and num_workers > 0}
 
     # При первом вызове создаем все DataLoader'ы
     if first_epoch or not global_valid_loader or not global_test_loader:
-        # Создаем мозаики для каждого набора данных
-        valid_mosaics = create_mosaics(valid_set, augmentor=None)
-        test_mosaics = create_mosaics(test_set, augmentor=None)
-
-        # Инициализация YoloDataset с мозаиками
-        valid_dataset = YoloDataset(valid_mosaics)
-        test_dataset = YoloDataset(test_mosaics)
-
-        # Создание DataLoader'ов для valid и test
-        global_valid_loader = DataLoader(valid_dataset, batch_size=batch_size)
-        global_test_loader = DataLoader(test_dataset, batch_size=batch_size)
+        if shared_directory is not None and world_size > 1:
+            # Проверочные мозаики собираются один раз и читаются всеми процессами из шардов (каждый проверяет свою долю)
+            global_valid_loader, global_test_loader = [
+                _shared_loader(records, os.path.join(shared_directory, name), mosaic_creator, rank, world_size, distributed, batch_size, loader_kwargs)
+                for name, records in (('valid', valid_set), ('test', test_set))]
+        else:
+            # Мозаики проверочных наборов собираются при обращении по раскладке, зафиксированной при создании
+            global_valid_loader, global_test_loader = [
+                DataLoader(MosaicYoloDataset(records, mosaic_creator, as_array=as_array, rank=rank, world_size=world_size), batch_size=batch_size, **loader_kwargs)
+                for records in (valid_set, test_set)]
 
-    # Создаем train_loader в любом случае
-    train_mosaics = create_mosaics(train_set, augmentor=augmentor)
-    train_dataset = YoloDataset(train_mosaics)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
+    # Создаем train_loader в любом случае: набор создается один раз, далее только меняется эпоха
+    if first_epoch or global_train_dataset is None:
+        if global_prefetcher is not None:
+            global_prefetcher.close()
+            global_prefetcher = None
+        global_epoch = 0
+        global_train_dataset = MosaicYoloDataset(train_set, mosaic_creator, augmentor=augmentor, as_array=as_array, rank=rank, world_size=world_size)
+        if prefetch:
+            global_prefetcher = EpochPrefetcher(global_train_dataset, queue_depth=prefetch_queue_depth, max_bytes=prefetch_max_bytes)
+    else:
+        global_epoch += 1
+        global_train_dataset.set_epoch(global_epoch)
+        if global_prefetcher is not None:
+            # Полотна, собранные заранее, берутся из буфера, остальные будут собраны при обращении
+            global_train_dataset.prefetched = global_prefetcher.take(global_epoch)
+    if global_prefetcher is not None:
+        global_prefetcher.start(global_epoch + 1)
+    train_dataset = global_train_dataset
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, **loader_kwargs)
 
     return {
         "Обучение": train_loader, 
         "Валидация": global_valid_loader, 
         "Тестирование": global_test_loader,
         "train_dataset": train_dataset,
-        "valid_dataset": valid_dataset,
-        "test_dataset": test_dataset
-    }
\ No newline at end of file
+        "valid_dataset": global_valid_loader.dataset,
+        "test_dataset": global_test_loader.dataset
+    }
+
+# DataLoader проверочного набора, мозаики которого собирает процесс rank 0 в шарды directory/shards (без сжатия,
+# чтение через memmap). Остальные процессы ждут окончания сборки (torch.distributed.barrier) и читают свою долю шардов.
+# Без инициализированного torch.distributed дождаться сборки нельзя, и каждый процесс собирает свою долю сам
+def _shared_loader(records, directory, mosaic_creator, rank, world_size, distributed, batch_size, loader_kwargs):
+    import torch.distributed as dist
+    from torch.utils.data import DataLoader, DistributedSampler
+    from .yolo_dataset import MosaicYoloDataset
+    from .shard_dataset import ShardDataset
+    if not distributed:
+        print("torch.distributed не инициализирован: проверочные мозаики собираются каждым процессом для своей доли")
+        return DataLoader(MosaicYoloDataset(records, mosaic_creator, rank=rank, world_size=world_size), batch_size=batch_size, **loader_kwargs)
+    if rank == 0:
+        save_mosaics(MosaicYoloDataset(records, mosaic_creator, as_array=True), directory, None, image_format='raw', container='shards')
+    dist.barrier()
+    dataset = ShardDataset(os.path.join(directory, 'shards'))
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=False)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **loader_kwargs)
+
+# Сборка батча из пар (PIL.Image, bbox) разного размера без преобразования в тензоры
+def _collate_pairs(batch):
+    return batch
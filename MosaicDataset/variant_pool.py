@@ -0,0 +1,189 @@
+from PIL import Image
+import os
+import random
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from .image_record import ImageRecord
+from .source_cache import SourceCache
+
+# Пул заранее аугментированных вариантов исходников поверх ImageAugmentor. Для каждой записи хранится до variants
+# вариантов (пиксели и преобразованные bbox); при обращении выбирается случайный вариант, и только с вероятностью
+# refresh (или если варианта еще нет) он генерируется заново. Хранилище ограничено max_bytes с вытеснением LRU:
+# в памяти процесса (directory=None) или в memmap-шардах SourceCache в directory (общее для процессов). На диске
+# давно не использованные варианты вытесняются, как только записанный объем превышает max_bytes на 1/8.
+# Ключ варианта зависит от mtime и размера файла исходника и от его аннотаций, поэтому после изменения исходника
+# или разметки старые варианты не используются.
+# Пул передается вместо аугментатора: MosaicCreator(..., augmentor=pool), MosaicYoloDataset(..., augmentor=pool)
+# Пул в памяти принадлежит одному процессу: в процессы DataLoader (num_workers > 0) он попадает пустым, и созданные там
+# варианты пропадают вместе с процессом, поэтому для MosaicYoloDataset в DataLoader нужен directory
+class VariantPool:
+    def __init__(self, augmentor, variants=4, refresh=0.25, max_bytes=2 * 2**30, directory=None, seed=None):
+        self.augmentor = augmentor
+        self.variants = variants
+        self.refresh = refresh
+        self.max_bytes = max_bytes
+        # Шарды не больше 1/8 бюджета: при слиянии индекса частично вытесненные шарды переписываются, пустые удаляются
+        self.store = SourceCache(directory, max_bytes=max_bytes, shard_bytes=max(max_bytes // 8, 1)) if directory else None
+        self.metrics = augmentor.metrics
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Хранилище в памяти: (ключ записи, номер варианта) -> (пиксели, bbox)
+        self._bytes = 0
+        self._store_bytes = None  # Объем хранилища на диске с учетом записанного этим процессом (считается при первой записи)
+        self._stamps = {}  # Путь исходника -> mtime и размер файла (читаются один раз за запуск)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    # В дочерние процессы передается пустой пул в памяти (хранилище в directory остается общим)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_store_bytes'] = None
+        state['_entries'] = OrderedDict()
+        state['_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # Переинициализация выбора вариантов и аугментаций (воспроизводимость полотен MosaicYoloDataset)
+    def reseed(self, seed):
+        self._rng.seed(seed)
+        self.augmentor.reseed(seed)
+
+    # Ключ варианта: путь, mtime и размер файла исходника, размер записи, окно фрагмента, аннотации и номер варианта
+    def _key(self, record, slot):
+        stamp = self._stamps.get(record.path)
+        if stamp is None:
+            try:
+                stat = os.stat(record.path)
+                stamp = f"{stat.st_mtime_ns}|{stat.st_size}"
+            except OSError:
+                stamp = ''  # Исходник не файл (например, ShardRecord): ключ зависит только от записи
+            self._stamps[record.path] = stamp
+        labels = hashlib.sha1(np.ascontiguousarray(record.bboxes, dtype=np.float32).tobytes()).hexdigest()[:16]
+        return f"{record.path}|{stamp}|{record.width}x{record.height}|{getattr(record, 'crop', '')}|{labels}|{slot}"
+
+    def _get(self, key):
+        with self._lock:
+            if self.store is not None:
+                meta = self.store.get_meta(key)
+                pixels = self.store.get(key) if meta is not None else None
+                return None if pixels is None else (pixels, meta[1])
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, pixels, bboxes):
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        with self._lock:
+            if self.store is not None:
+                self.store.put(key, pixels, bboxes)
+                if self._store_bytes is None:
+                    self._store_bytes = self.store.stats()['bytes']
+                else:
+                    self._store_bytes += pixels.nbytes
+                # Вытеснение с запасом 1/8, чтобы слияние индекса не выполнялось при каждой записи
+                if self._store_bytes > self.max_bytes + self.max_bytes // 8:
+                    self.store.flush()
+                    self._store_bytes = self.store.stats()['bytes']
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0].nbytes
+            self._entries[key] = (pixels, bboxes)
+            self._bytes += pixels.nbytes
+            # Вытеснение давно не использованных вариантов
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    # Выбор варианта для записи: (ключ, сохраненный вариант или None, если его нужно сгенерировать)
+    def _choose(self, record):
+        key = self._key(record, self._rng.randrange(self.variants))
+        entry = self._get(key)
+        if entry is not None and self._rng.random() >= self.refresh:
+            self.hits += 1
+            self.metrics.count('variant_hits')
+            return key, entry
+        self.misses += 1
+        self.metrics.count('variant_misses')
+        if entry is not None:
+            self.refreshes += 1
+        return key, None
+
+    @staticmethod
+    def _output(pixels, bboxes, as_array):
+        return (pixels if as_array else Image.fromarray(np.asarray(pixels))), bboxes
+
+    # Аугментация одной записи через пул (пары без записи ImageRecord аугментируются без пула)
+    def _augment_single_image(self, img_with_bbox, as_array=False):
+        if not isinstance(img_with_bbox, ImageRecord):
+            return self.augmentor._augment_single_image(img_with_bbox, as_array=as_array)
+        key, entry = self._choose(img_with_bbox)
+        if entry is None:
+            entry = self.augmentor._augment_single_image(img_with_bbox, as_array=True)
+            self._put(key, *entry)
+        return self._output(*entry, as_array)
+
+    # Генератор аугментированных пар в исходном порядке: варианты выбираются последовательно,
+    # недостающие генерируются аугментатором пачками (в его пуле потоков или процессов)
+    def augment_iter(self, images_with_bboxes, as_array=False):
+        batch = []
+        for item in images_with_bboxes:
+            batch.append(item)
+            if len(batch) >= 4 * self.augmentor.num_workers:
+                yield from self._augment_batch(batch, as_array)
+                batch = []
+        if batch:
+            yield from self._augment_batch(batch, as_array)
+
+    def _augment_batch(self, batch, as_array):
+        chosen = [self._choose(item) if isinstance(item, ImageRecord) else (None, None) for item in batch]
+        missing = [item for item, (_, entry) in zip(batch, chosen) if entry is None]
+        generated = self.augmentor.augment_iter(missing, as_array=True)
+        for item, (key, entry) in zip(batch, chosen):
+            if entry is None:
+                entry = next(generated)
+                if key is not None:
+                    self._put(key, *entry)
+            yield self._output(*entry, as_array)
+
+    def augment_images(self, images_with_bboxes):
+        return list(self.augment_iter(images_with_bboxes))
+
+    # Сохранение индекса хранилища на диске и вытеснение сверх max_bytes (вызывается MosaicYoloDataset.set_epoch)
+    def flush(self):
+        if self.store is not None:
+            with self._lock:
+                self.store.flush()
+                self._store_bytes = self.store.stats()['bytes']
+
+    def close(self):
+        self.flush()
+        self.augmentor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Статистика пула
+    def stats(self):
+        requests = self.hits + self.misses
+        stats = {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes,
+                 'hit_rate': self.hits / requests if requests else 0.0}
+        if self.store is not None:
+            store_stats = self.store.stats()
+            stats.update(entries=store_stats['entries'], bytes=store_stats['bytes'], evictions=store_stats['evictions'])
+        else:
+            stats.update(entries=len(self._entries), bytes=self._bytes, evictions=self.evictions)
+        return stats
@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from .bbox_array import to_bbox_array
+
+# Сборка батча YOLO в тензоры: картинки - uint8 (N, 3, H, W), аннотации - float32 (total_boxes, 6)
+# со строками [номер картинки в батче, класс, x_center, y_center, width, height].
+# Картинки (PIL.Image или массивы uint8 HWC, например MosaicYoloDataset(as_array=True)) копируются сразу на свое место
+# в заранее выделенном тензоре, аннотации - в общий тензор целей, без промежуточных списков и torch.stack.
+# Картинки меньшего размера (большие картинки вне мозаик) дополняются нулями справа и снизу, их рамки пересчитываются.
+# channels_last=True оставляет пиксели в памяти в порядке HWC (тензор формы NCHW с channels_last strides): копирование
+# без перестановки каналов. pin_memory=True выделяет батч в закрепленной памяти, если сборка идет в основном процессе
+# и доступна CUDA (в процессах-обработчиках закрепление выполняет DataLoader(pin_memory=True))
+class YoloCollate:
+    def __init__(self, pin_memory=False, channels_last=False):
+        self.pin_memory = pin_memory
+        self.channels_last = channels_last
+
+    def __call__(self, batch):
+        arrays = [np.asarray(image) for image, _ in batch]
+        bboxes = [to_bbox_array(boxes) for _, boxes in batch]
+        height = max(array.shape[0] for array in arrays)
+        width = max(array.shape[1] for array in arrays)
+        total = sum(len(boxes) for boxes in bboxes)
+        pin = self.pin_memory and get_worker_info() is None and torch.cuda.is_available()
+
+        # Картинки разного размера дополняются нулями, одинаковые заполняют тензор целиком
+        allocate = torch.empty if all(array.shape[:2] == (height, width) for array in arrays) else torch.zeros
+        if self.channels_last:
+            images = allocate((len(batch), height, width, 3), dtype=torch.uint8, pin_memory=pin).permute(0, 3, 1, 2)
+        else:
+            images = allocate((len(batch), 3, height, width), dtype=torch.uint8, pin_memory=pin)
+        targets = torch.empty((total, 6), dtype=torch.float32, pin_memory=pin)
+        # Запись идет через NumPy-представления тензоров (источники могут быть только для чтения, например memmap)
+        images_view, targets_view = images.numpy(), targets.numpy()
+        row = 0
+        for idx, (array, boxes) in enumerate(zip(arrays, bboxes)):
+            if array.ndim == 2:
+                array = array[:, :, None]
+            image_height, image_width = array.shape[:2]
+            images_view[idx, :, :image_height, :image_width] = array[:, :, :3].transpose(2, 0, 1)
+            targets_view[row:row + len(boxes), 0] = idx
+            targets_view[row:row + len(boxes), 1:] = boxes
+            if (image_height, image_width) != (height, width):
+                # Нормализованные координаты переводятся в размер дополненного полотна
+                targets_view[row:row + len(boxes), 2:] *= np.array([image_width / width, image_height / height] * 2, dtype=np.float32)
+            row += len(boxes)
+        return images, targets
+
+
+# Перенос батча (images, targets) на устройство. Для закрепленной памяти копирование асинхронное (non_blocking)
+def to_device(batch, device, non_blocking=True):
+    images, targets = batch
+    return images.to(device, non_blocking=non_blocking), targets.to(device, non_blocking=non_blocking)
@@ -1,6 +1,12 @@
+from PIL import Image
+import numpy as np
 from torch.utils.data import Dataset
+from .image_record import ImageRecord
+from .mosaic_packer import shard_indices
+from .mosaic_plan import MosaicPlan
+from .image_augmentor import derive_seed
 
-# Класс Dataset для работы с DataLoader        
+# Класс Dataset для работы с DataLoader
 class YoloDataset(Dataset):
     def __init__(self, image_bbox_pairs):
         self.image_bbox_pairs = image_bbox_pairs
@@ -9,5 +15,88 @@ class YoloDataset(Dataset):
         return len(self.image_bbox_pairs)
 
     def __getitem__(self, idx):
-        image, bboxes = self.image_bbox_pairs[idx]
-        return image, bboxes
\ No newline at end of file
+        item = self.image_bbox_pairs[idx]
+        # Записи ImageRecord декодируются только при обращении
+        if isinstance(item, ImageRecord):
+            return item.load(), item.bboxes
+        image, bboxes = item
+        return image, bboxes
+
+
+# Вариант YoloDataset, собирающий мозаики на лету в __getitem__ (в процессах-обработчиках DataLoader).
+# В начале эпохи строится только раскладка полотен по размерам записей, пиксели декодируются,
+# аугментируются и выкладываются при обращении к полотну, поэтому каждое полотно собирается ровно один раз.
+# Большие картинки (см. MosaicCreator.split_large_images) выдаются после полотен отдельными элементами.
+# as_array=True выдает картинки массивами uint8 HWC (torch.from_numpy без копирования) вместо PIL.Image.
+# При распределенном обучении (rank из world_size) все процессы строят одну раскладку эпохи, а набор содержит
+# только долю полотен и больших картинок процесса (поровну у всех процессов, см. shard_indices)
+class MosaicYoloDataset(YoloDataset):
+    def __init__(self, records, mosaic_creator, augmentor=None, seed=0, as_array=False, rank=0, world_size=1):
+        image_bbox_pairs, large_images = mosaic_creator.split_large_images(records)
+        super().__init__(image_bbox_pairs)
+        self.mosaic_creator = mosaic_creator
+        self.augmentor = augmentor
+        self.seed = seed
+        self.as_array = as_array
+        self.rank = rank
+        self.world_size = world_size
+        self.large_ids = shard_indices(len(large_images), rank, world_size)  # Номера больших картинок процесса во всем наборе
+        self.large_images = [large_images[idx] for idx in self.large_ids]
+        self.set_epoch(0)
+
+    # Хук смены эпохи: новая раскладка (при ограниченном packing_window) и новые случайные аугментации.
+    # Вызывается в основном процессе до итерации по DataLoader (с persistent_workers=False)
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.prefetched = {}  # Полотна эпохи, собранные заранее EpochPrefetcher: {индекс: (пиксели, bbox)}
+        self.mosaic_creator.flush_cache()  # Подготовленные в прошлой эпохе исходники попадают в общий индекс кэша
+        if hasattr(self.augmentor, 'flush'):
+            self.augmentor.flush()  # Пул вариантов VariantPool: слияние индекса и вытеснение сверх max_bytes
+        layouts = list(self.mosaic_creator.plan_mosaics(self.image_bbox_pairs, seed=self.seed + epoch))
+        self.canvas_ids = shard_indices(len(layouts), self.rank, self.world_size)  # Номера полотен процесса в раскладке эпохи
+        self.layouts = [layouts[idx][0] for idx in self.canvas_ids]
+        self.fill_ratios = [layouts[idx][1] for idx in self.canvas_ids]
+        self.total_canvases = len(layouts)
+
+    # План мозаик текущей эпохи (доля процесса) для сохранения и повторного использования (см. MosaicPlan)
+    def get_plan(self):
+        return MosaicPlan.from_layouts(self.image_bbox_pairs, list(zip(self.layouts, self.fill_ratios)), self.mosaic_creator.canvas_size,
+                                       canvas_ids=self.canvas_ids, large_ids=self.large_ids, seed=self.seed + self.epoch)
+
+    # Замена раскладки текущей эпохи готовым планом (например, сохраненным ранее): полотна собираются в __getitem__
+    # по плану без повторной упаковки. Действует до следующего set_epoch
+    def set_plan(self, plan):
+        if len(plan.sources) != len(self.image_bbox_pairs) or any(str(source) != record.path for source, record in zip(plan.sources, self.image_bbox_pairs)):
+            raise ValueError("План мозаик построен по другому списку записей")
+        if not np.array_equal(plan.large_ids, self.large_ids):
+            raise ValueError("План мозаик построен для другой доли больших картинок")
+        self.prefetched = {}
+        self.canvas_ids = plan.canvas_ids
+        self.layouts = [placements for placements, _ in plan.layouts()]
+        self.fill_ratios = plan.fill_ratios.tolist()
+
+    def __len__(self):
+        return len(self.layouts) + len(self.large_images)
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise IndexError(idx)
+        if idx in self.prefetched:
+            pixels, bboxes = self.prefetched[idx]
+            return (pixels if self.as_array else Image.fromarray(pixels)), bboxes
+        if self.augmentor:
+            # Аугментации полотна воспроизводимы и не зависят от того, какой процесс его собирает
+            self.augmentor.reseed(derive_seed(self.seed, self.epoch, self._global_index(idx)))
+        if idx >= len(self.layouts):
+            record = self.large_images[idx - len(self.layouts)]
+            if self.augmentor and self.mosaic_creator.process_large_images:
+                return self.augmentor._augment_single_image(record, as_array=self.as_array)
+            image = record.load()
+            return (np.asarray(image) if self.as_array else image), record.bboxes
+        return self.mosaic_creator.compose_mosaic(self.image_bbox_pairs, self.layouts[idx], augmentor=self.augmentor, as_array=self.as_array)
+
+    # Номер элемента во всем наборе эпохи (полотна, затем большие картинки) по номеру в доле процесса
+    def _global_index(self, idx):
+        if idx < len(self.layouts):
+            return int(self.canvas_ids[idx])
+        return self.total_canvases + int(self.large_ids[idx - len(self.layouts)])
@@ -0,0 +1,64 @@
+# Бенчмарк масштабирования аугментации по числу ядер для backend='thread' и backend='process'
+#
+# Пример запуска:
+#     python benchmarks/bench_augmentation.py --images 512 --size 640 --workers 1 2 4 8 16 32
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MosaicDataset import ImageAugmentor
+
+# Синтетические пары картинка-аннотации в памяти
+def make_pairs(count, size, boxes_per_image, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(count):
+        image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        bboxes = np.column_stack([
+            rng.integers(0, 3, boxes_per_image),
+            rng.uniform(0.3, 0.7, (boxes_per_image, 2)),
+            rng.uniform(0.05, 0.3, (boxes_per_image, 2)),
+        ]).astype(np.float32)
+        pairs.append((image, bboxes))
+    return pairs
+
+def main():
+    parser = argparse.ArgumentParser(description="Масштабирование ImageAugmentor по числу процессов/потоков")
+    parser.add_argument('--images', type=int, default=256)
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--boxes', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument('--backends', nargs='+', default=['thread', 'process'])
+    parser.add_argument('--chunk-size', type=int, default=16)
+    parser.add_argument('--output', help="Путь к JSON-файлу с результатами")
+    args = parser.parse_args()
+
+    # Набор аугментаций по умолчанию использует параметры старых версий albumentations: скрываются только эти
+    # предупреждения, остальные (устаревание, ошибки декодирования) остаются видны
+    warnings.filterwarnings('ignore', message=r'ShiftScaleRotate is a special case of Affine', category=UserWarning)
+    warnings.filterwarnings('ignore', message=r"Argument\(s\) '.*' are not valid for transform", category=UserWarning)
+    pairs = make_pairs(args.images, args.size, args.boxes)
+    results = []
+    for backend in args.backends:
+        for workers in sorted(set(args.workers)):
+            with ImageAugmentor(backend=backend, num_workers=workers, chunk_size=args.chunk_size) as augmentor:
+                # Прогрев пула: запуск процессов не входит в замер
+                list(augmentor.augment_iter(pairs[:workers]))
+                start = time.perf_counter()
+                count = sum(1 for _ in augmentor.augment_iter(pairs))
+                elapsed = time.perf_counter() - start
+            results.append({'backend': backend, 'workers': workers, 'images': count,
+                            'seconds': round(elapsed, 4), 'images_per_sec': round(count / elapsed, 2)})
+            print(f"{backend:>8} workers={workers:<3} {count / elapsed:9.1f} images/sec")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'params': vars(args), 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Бенчмарк режимов декодирования ImageRecord.load(): скорость, пиковая память и качество относительно 'exact'
+#
+# Каждый режим замеряется в отдельном процессе, чтобы пиковый RSS не зависел от предыдущих замеров (Linux).
+# Пример запуска:
+#     python benchmarks/bench_decode.py --images 64 --width 3840 --height 2160 --canvas-size 640
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MosaicDataset.image_record import ImageRecord, DECODE_MODES, fit_size
+
+# Синтетические JPEG-кадры: плавный градиент с шумом, чтобы размер файла был похож на фото
+def make_jpegs(directory, count, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    paths = []
+    for idx in range(count):
+        noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+        pixels = np.clip(gradient * rng.uniform(0.3, 1.0, 3) + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f'frame_{idx}.jpg')
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+# Текущий RSS процесса в байтах
+def current_rss():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+# Фоновый поток, отслеживающий пиковый RSS во время замера
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.001):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+
+# Замер одного режима в текущем процессе
+def run_mode(paths, canvas_size, mode, reference_dir=None):
+    records = []
+    for path in paths:
+        with Image.open(path) as img:
+            width, height = fit_size(*img.size, canvas_size)
+        records.append(ImageRecord(path, width, height, np.empty((0, 5), dtype=np.float32), decode_mode=mode))
+
+    # Прирост RSS за время декодирования относительно RSS до замера (пик импортов в замер не входит)
+    rss_before = current_rss()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    images = [np.asarray(record.load()) for record in records]
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = {'mode': mode, 'images': len(records), 'seconds': round(elapsed, 4),
+              'images_per_sec': round(len(records) / elapsed, 2),
+              'peak_rss_mb': round(peak_after / 1024, 1),
+              'decode_peak_rss_increase_mb': round((sampler.peak - rss_before) / 2**20, 1)}
+    if reference_dir:
+        # PSNR относительно полного декодирования
+        mse = []
+        for idx, image in enumerate(images):
+            reference = np.load(os.path.join(reference_dir, f'{idx}.npy'))
+            mse.append(np.mean((image.astype(np.float32) - reference.astype(np.float32)) ** 2))
+        mean_mse = float(np.mean(mse))
+        result['psnr_vs_exact_db'] = round(10 * np.log10(255 ** 2 / mean_mse), 2) if mean_mse else float('inf')
+    else:
+        for idx, image in enumerate(images):
+            np.save(os.path.join(os.path.dirname(paths[0]), f'{idx}.npy'), image)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение режимов декодирования ImageRecord")
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--canvas-size', type=int, default=640)
+    parser.add_argument('--output', help="Путь к JSON-файлу с результатами")
+    parser.add_argument('--run-mode', help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        paths = [os.path.join(args.data_dir, f'frame_{idx}.jpg') for idx in range(len([f for f in os.listdir(args.data_dir) if f.endswith('.jpg')]))]
+        reference_dir = None if args.run_mode == 'exact' else args.data_dir
+        print(json.dumps(run_mode(paths, args.canvas_size, args.run_mode, reference_dir)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_jpegs(data_dir, args.images, args.width, args.height)
+        # 'exact' идет первым: его результат служит эталоном качества
+        for mode in ['exact'] + [mode for mode in DECODE_MODES if mode != 'exact']:
+            output = subprocess.run([sys.executable, __file__, '--run-mode', mode, '--data-dir', data_dir,
+                                     '--canvas-size', str(args.canvas_size)], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{mode:>9} {result['images_per_sec']:8.1f} images/sec  peak RSS +{result['decode_peak_rss_increase_mb']:7.1f} MB"
+                  + (f"  PSNR {result['psnr_vs_exact_db']} dB" if 'psnr_vs_exact_db' in result else ''))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'params': vars(args), 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
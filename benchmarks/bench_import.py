@@ -0,0 +1,66 @@
+# Бенчмарк времени импорта и RSS пакета в свежем процессе: короткоживущие CLI и процессы пулов платят эту цену при каждом запуске.
+# Каждый сценарий замеряется в отдельном процессе (--repeats раз, берется медиана), в отчете - загружены ли torch,
+# albumentations и OpenCV. Сценарий 'eager' загружает все модули пакета сразу (как до ленивого __init__).
+# Пример запуска:
+#     python benchmarks/bench_import.py --repeats 5
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Сценарии: что выполняется после старта интерпретатора
+SCENARIOS = {
+    'package': "import MosaicDataset",
+    'split_save': "from MosaicDataset import MosaicCreator, SplitSubset, create_mosaics, save_mosaics",
+    'augmentor': "from MosaicDataset import ImageAugmentor; ImageAugmentor()",
+    'dataloaders': "from MosaicDataset import MosaicYoloDataset, YoloCollate, initialize_dataloaders",
+    'eager': "import MosaicDataset; [getattr(MosaicDataset, name) for name in MosaicDataset.__all__]",
+}
+HEAVY_MODULES = ('torch', 'albumentations', 'cv2')
+
+# Замер одного сценария в текущем процессе
+def run_scenario(name):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    exec(SCENARIOS[name], {})
+    elapsed = time.perf_counter() - start
+    return {'scenario': name, 'seconds': round(elapsed, 4),
+            'rss_increase_mb': round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+            'loaded': [module for module in HEAVY_MODULES if module in sys.modules]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта пакета MosaicDataset")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--output', help="Путь к JSON-файлу с результатами")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        sys.path.insert(0, ROOT)
+        print(json.dumps(run_scenario(args.run_scenario)))
+        return
+
+    results = []
+    for name in args.scenarios:
+        runs = []
+        for _ in range(args.repeats):
+            output = subprocess.run([sys.executable, __file__, '--run-scenario', name], capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        result = {'scenario': name, 'seconds': statistics.median(run['seconds'] for run in runs),
+                  'rss_increase_mb': statistics.median(run['rss_increase_mb'] for run in runs), 'loaded': runs[0]['loaded']}
+        results.append(result)
+        print(f"{name:>12} {result['seconds']:8.3f} s  RSS +{result['rss_increase_mb']:7.1f} MB  loaded: {', '.join(result['loaded']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'params': vars(args), 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Бенчмарк загрузки разметки: чтение и разбор каждого файла отдельно (LabelStore.load_file) против LabelStore.load
+# без кэша, с построением кэша и с готовым бинарным кэшем разметки.
+# Пример запуска:
+#     python benchmarks/bench_labels.py --files 100000 --boxes 8
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MosaicDataset.bbox_array import format_bboxes
+from MosaicDataset.label_store import LabelStore
+
+# Синтетические файлы разметки YOLO со случайным числом рамок (в среднем boxes)
+def make_labels(directory, count, boxes, classes, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for idx in range(count):
+        n = rng.poisson(boxes)
+        bboxes = np.column_stack([rng.integers(0, classes, n), rng.uniform(0.2, 0.8, (n, 2)), rng.uniform(0.01, 0.4, (n, 2))])
+        path = os.path.join(directory, f'{idx // 1000:04d}', f'{idx}.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(format_bboxes(bboxes))
+        paths.append(path)
+    return paths
+
+def measure(name, fn, files):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>14} {elapsed:8.3f} s {files / elapsed:12.1f} files/sec")
+    return {'method': name, 'seconds': round(elapsed, 4), 'files_per_sec': round(files / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение способов загрузки разметки")
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--boxes', type=float, default=5, help="Среднее число рамок в файле")
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--num-threads', type=int)
+    parser.add_argument('--output', help="Путь к JSON-файлу с результатами")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        paths = make_labels(os.path.join(data_dir, 'labels'), args.files, args.boxes, args.classes)
+        cache_path = os.path.join(data_dir, 'labels.npz')
+        store = LabelStore(num_classes=args.classes, num_threads=args.num_threads)
+        cached_store = LabelStore(cache_path, num_classes=args.classes, num_threads=args.num_threads)
+        results = [
+            measure('per_file', lambda: [store.load_file(path) for path in paths], args.files),
+            measure('bulk', lambda: store.load(paths), args.files),
+            measure('bulk_build', lambda: cached_store.load(paths), args.files),
+            measure('bulk_cached', lambda: cached_store.load(paths), args.files),
+        ]
+        print(f"Размер кэша разметки: {os.path.getsize(cache_path) / 2**20:.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'params': vars(args), 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Бенчмарк этапов конвейера на синтетическом датасете: время, скорость и прирост памяти каждого этапа отдельно
+#
+# Этапы: find_image_label_pairs, process_image_label_pairs, SplitSubset.split, ImageAugmentor.augment_images,
+# create_mosaic (с долей заполнения полотен) и save_mosaics. Результаты с хэшем коммита пишутся в JSON,
+# при заданном --baseline печатается изменение скорости относительно прошлого замера.
+# Пример запуска:
+#     python benchmarks/bench_pipeline.py --images 2000 --canvas-size 640 --output pipeline.json --baseline old.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+from MosaicDataset import MosaicCreator, ImageAugmentor, SplitSubset, save_mosaics
+from bench_decode import RssSampler, current_rss
+from synthetic_dataset import make_dataset, add_dataset_arguments, dataset_kwargs
+
+# Хэш текущего коммита для сопоставления замеров
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Замер одного этапа: fn возвращает (результат, число обработанных элементов, дополнительные метрики)
+def measure(stage, fn):
+    rss_before = current_rss()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    result, items, extra = fn()
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+    metrics = {'stage': stage, 'items': items, 'seconds': round(elapsed, 4),
+               'items_per_sec': round(items / elapsed, 2) if elapsed else None,
+               'peak_rss_increase_mb': round((sampler.peak - rss_before) / 2**20, 1), **extra}
+    print(f"{stage:>28} {items:8d} items {elapsed:9.3f} s {metrics['items_per_sec'] or 0:10.1f} items/sec  RSS +{metrics['peak_rss_increase_mb']:.1f} MB")
+    return result, metrics
+
+# Сравнение с прошлым замером по скорости каждого этапа
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = {item['stage']: item for item in json.load(file)['results']}
+    for item in results:
+        old = baseline.get(item['stage'])
+        if old and old.get('items_per_sec') and item.get('items_per_sec'):
+            print(f"{item['stage']:>28} {item['items_per_sec'] / old['items_per_sec'] - 1:+8.1%} items/sec относительно {baseline_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк этапов построения мозаичного датасета")
+    add_dataset_arguments(parser)
+    parser.add_argument('--data-dir', help="Готовый датасет (по умолчанию генерируется во временной папке)")
+    parser.add_argument('--canvas-size', type=int, default=640)
+    parser.add_argument('--large-image-threshold', type=int, default=1280)
+    parser.add_argument('--packer', default='skyline')
+    parser.add_argument('--packing-window', type=int)
+    parser.add_argument('--augment-backend', default='thread')
+    parser.add_argument('--augment-images', type=int, default=200, help="Сколько записей аугментировать отдельно (0 - пропустить этап)")
+    parser.add_argument('--image-format', default='jpg')
+    parser.add_argument('--output', help="Путь к JSON-файлу с результатами")
+    parser.add_argument('--baseline', help="JSON прошлого замера для сравнения")
+    args = parser.parse_args()
+
+    # Набор аугментаций по умолчанию использует параметры старых версий albumentations: скрываются только эти
+    # предупреждения, остальные (устаревание, ошибки декодирования) остаются видны
+    warnings.filterwarnings('ignore', message=r'ShiftScaleRotate is a special case of Affine', category=UserWarning)
+    warnings.filterwarnings('ignore', message=r"Argument\(s\) '.*' are not valid for transform", category=UserWarning)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(work_dir, 'source')
+            start = time.perf_counter()
+            make_dataset(data_dir, **dataset_kwargs(args))
+            print(f"Синтетический датасет: {args.images} картинок за {time.perf_counter() - start:.1f} s")
+
+        creator = MosaicCreator(canvas_size=args.canvas_size, large_image_threshold=args.large_image_threshold,
+                                packer=args.packer, packing_window=args.packing_window)
+
+        def find_stage():
+            pairs = creator.find_image_label_pairs(data_dir)
+            return pairs, len(pairs), {}
+
+        def process_stage():
+            records, large_images = creator.process_image_label_pairs(pairs)
+            return (records, large_images), len(pairs), {'records': len(records), 'large_images': len(large_images)}
+
+        def split_stage():
+            subsets = SplitSubset(records + large_images, (0.7, 0.2, 0.1), seed=args.seed).split()
+            return subsets, len(records) + len(large_images), {'subset_sizes': [len(subset) for subset in subsets]}
+
+        def augment_stage():
+            with ImageAugmentor(backend=args.augment_backend) as augmentor:
+                augmented = augmentor.augment_images(records[:args.augment_images])
+            return None, len(augmented), {'backend': args.augment_backend}
+
+        def mosaic_stage():
+            mosaics, rendered = creator.create_mosaic(records, large_images)
+            fill_ratios = creator.fill_ratios or [np.nan]
+            return mosaics + rendered, len(records) + len(large_images), {
+                'canvases': len(mosaics), 'large_images': len(rendered),
+                'mean_fill_ratio': round(float(np.mean(fill_ratios)), 4), 'min_fill_ratio': round(float(np.min(fill_ratios)), 4)}
+
+        def save_stage():
+            count = save_mosaics(all_images, os.path.join(work_dir, 'yolo'), None, image_format=args.image_format, preview=0)
+            return None, count, {'image_format': args.image_format}
+
+        pairs, metrics = measure('find_image_label_pairs', find_stage)
+        results.append(metrics)
+        (records, large_images), metrics = measure('process_image_label_pairs', process_stage)
+        results.append(metrics)
+        _, metrics = measure('split', split_stage)
+        results.append(metrics)
+        if args.augment_images:
+            _, metrics = measure('augment_images', augment_stage)
+            results.append(metrics)
+        all_images, metrics = measure('create_mosaic', mosaic_stage)
+        results.append(metrics)
+        _, metrics = measure('save_mosaics', save_stage)
+        results.append(metrics)
+
+    if args.baseline:
+        compare(results, args.baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'revision': git_revision(), 'params': vars(args), 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# Генератор синтетического YOLO-датасета для бенчмарков: картинки со случайными прямоугольниками и файлы разметки
+#
+# Картинки раскладываются по подпапкам (как в реальных выгрузках), рядом пишется classes.txt.
+# Пример запуска:
+#     python benchmarks/synthetic_dataset.py /tmp/synthetic --images 2000 --min-size 64 --max-size 1920 --classes 10 --boxes 6
+import argparse
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Создание датасета в directory. Размеры картинок равномерны в [min_size, max_size], доля large_fraction
+# картинок имеет размер large_size; число рамок на картинке распределено по Пуассону со средним boxes
+def make_dataset(directory, images=1000, min_size=64, max_size=1280, classes=10, boxes=5, large_fraction=0.0, large_size=2560,
+                 subdirs=4, image_format='jpg', seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'classes.txt'), 'w', encoding='utf-8') as file:
+        file.write(''.join(f'class_{idx}\n' for idx in range(classes)))
+
+    for idx in range(images):
+        if rng.random() < large_fraction:
+            width = height = large_size
+        else:
+            width, height = rng.integers(min_size, max_size + 1, 2)
+        subdir = os.path.join(directory, f'part_{idx % subdirs}')
+        os.makedirs(subdir, exist_ok=True)
+
+        # Фон - шум с градиентом, чтобы размер сжатых файлов был похож на фото
+        background = rng.integers(0, 64, (3,), dtype=np.uint8) + np.linspace(0, 128, int(width), dtype=np.uint8)[None, :, None]
+        image = Image.fromarray(np.broadcast_to(background, (int(height), int(width), 3)).astype(np.uint8))
+        draw = ImageDraw.Draw(image)
+        count = max(int(rng.poisson(boxes)), 1)
+        centers = rng.uniform(0.1, 0.9, (count, 2))
+        sizes = rng.uniform(0.02, 0.2, (count, 2))
+        labels = rng.integers(0, classes, count)
+        for label, (x, y), (w, h) in zip(labels, centers, sizes):
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            draw.rectangle([(x - w / 2) * width, (y - h / 2) * height, (x + w / 2) * width, (y + h / 2) * height], fill=color)
+        image.save(os.path.join(subdir, f'sample_{idx}.{image_format}'))
+        with open(os.path.join(subdir, f'sample_{idx}.txt'), 'w') as file:
+            file.write(''.join(f'{label} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n' for label, (x, y), (w, h) in zip(labels, centers, sizes)))
+    return directory
+
+# Параметры генератора для командной строки (общие с bench_pipeline.py)
+def add_dataset_arguments(parser):
+    parser.add_argument('--images', type=int, default=500)
+    parser.add_argument('--min-size', type=int, default=64)
+    parser.add_argument('--max-size', type=int, default=1280)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--boxes', type=float, default=5, help="Среднее число рамок на картинке")
+    parser.add_argument('--large-fraction', type=float, default=0.0, help="Доля картинок размера --large-size")
+    parser.add_argument('--large-size', type=int, default=2560)
+    parser.add_argument('--seed', type=int, default=0)
+
+def dataset_kwargs(args):
+    return {'images': args.images, 'min_size': args.min_size, 'max_size': args.max_size, 'classes': args.classes,
+            'boxes': args.boxes, 'large_fraction': args.large_fraction, 'large_size': args.large_size, 'seed': args.seed}
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетического YOLO-датасета")
+    parser.add_argument('directory')
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+    make_dataset(args.directory, **dataset_kwargs(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from MosaicDataset.source_cache import SourceCache
+
+# Пиксели записи однозначно определяются ее номером
+def make_pixels(idx):
+    return np.full((16 + idx % 7, 24, 3), idx % 251, dtype=np.uint8)
+
+# Одновременные put/get из многих потоков при частой смене шардов: каждая запись читается со своими пикселями
+def test_concurrent_put_get(tmp_path):
+    cache = SourceCache(str(tmp_path), shard_bytes=64 * 1024)
+
+    def put_and_get(idx):
+        pixels = make_pixels(idx)
+        cache.put(f'key{idx}', pixels, [[0, 0.5, 0.5, 0.1, 0.1]])
+        return np.array_equal(cache.get(f'key{idx}'), pixels)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        assert all(executor.map(put_and_get, range(2000)))
+    assert all(np.array_equal(cache.get(f'key{idx}'), make_pixels(idx)) for idx in range(2000))
+
+    cache.flush()
+    reopened = SourceCache(str(tmp_path))
+    assert all(np.array_equal(reopened.get(f'key{idx}'), make_pixels(idx)) for idx in range(2000))
+
+# Процесс пишет свою долю записей и несколько раз сливает индекс
+def put_and_flush(directory, rank):
+    cache = SourceCache(directory, shard_bytes=64 * 1024)
+    for idx in range(rank, 400, 4):
+        cache.put(f'key{idx}', make_pixels(idx), [])
+        if idx % 20 == rank:
+            cache.flush()
+    cache.flush()
+
+# Одновременное слияние индекса несколькими процессами в общей директории (как ранги DDP)
+def test_concurrent_flush(tmp_path):
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=put_and_flush, args=(str(tmp_path), rank)) for rank in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    cache = SourceCache(str(tmp_path))
+    assert all(np.array_equal(cache.get(f'key{idx}'), make_pixels(idx)) for idx in range(400))
+
+# Процесс пишет записи и продолжает работать, пока родитель сливает индекс
+def put_and_wait(directory, ready, done):
+    cache = SourceCache(directory, shard_bytes=64 * 1024)
+    for idx in range(400):
+        cache.put(f'key{idx}', make_pixels(idx), [])
+    ready.set()
+    done.wait(60)
+
+# max_bytes ограничивает место на диске, а вытесненные записи из журнала работающего процесса не возвращаются
+def test_flush_bounds_disk(tmp_path):
+    context = multiprocessing.get_context('spawn')
+    ready, done = context.Event(), context.Event()
+    process = context.Process(target=put_and_wait, args=(str(tmp_path), ready, done))
+    process.start()
+    try:
+        assert ready.wait(60)
+        cache = SourceCache(str(tmp_path), max_bytes=100 * 1024, shard_bytes=64 * 1024)
+        for _ in range(2):
+            cache.flush()
+            assert cache.stats()['bytes'] <= 100 * 1024
+            shard_bytes = sum(os.path.getsize(path) for path in tmp_path.glob('shard_*'))
+            assert shard_bytes <= 100 * 1024 * 4 / 3 + 2 * 64 * 1024
+        kept = {key for key in cache.entries}
+        assert {key for key in SourceCache(str(tmp_path)).entries} == kept
+        assert all(np.array_equal(cache.get(key), make_pixels(int(key[3:]))) for key in kept)
+    finally:
+        done.set()
+        process.join()
@@ -0,0 +1,29 @@
+import os
+from MosaicDataset.source_index import SourceIndex
+
+# Создание пустых файлов по относительным путям
+def touch(root, *paths):
+    for path in paths:
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        open(full_path, 'w').close()
+
+def relative_pairs(root, pairs):
+    return sorted((os.path.relpath(image, root), os.path.relpath(label, root)) for image, label in pairs)
+
+# Стандартная раскладка YOLO: images/<набор>/x.jpg <-> labels/<набор>/x.txt
+def test_images_split_layout(tmp_path):
+    touch(tmp_path, 'images/train/a.jpg', 'images/val/b.jpg', 'labels/train/a.txt', 'labels/val/b.txt')
+    assert relative_pairs(tmp_path, SourceIndex().scan(str(tmp_path))) == [
+        (os.path.join('images', 'train', 'a.jpg'), os.path.join('labels', 'train', 'a.txt')),
+        (os.path.join('images', 'val', 'b.jpg'), os.path.join('labels', 'val', 'b.txt'))]
+
+# Заменяется самый глубокий компонент images, соседние папки labels и разметка рядом с картинкой тоже находятся
+def test_nested_and_same_folder_layouts(tmp_path):
+    touch(tmp_path, 'images/set/images/a.jpg', 'images/set/labels/a.txt', 'data/images/b.jpg', 'data/labels/b.txt',
+          'flat/c.jpg', 'flat/c.txt', 'images/train/d.jpg', 'images/train/d.txt', 'images/train/e.jpg')
+    assert relative_pairs(tmp_path, SourceIndex().scan(str(tmp_path))) == [
+        (os.path.join('data', 'images', 'b.jpg'), os.path.join('data', 'labels', 'b.txt')),
+        (os.path.join('flat', 'c.jpg'), os.path.join('flat', 'c.txt')),
+        (os.path.join('images', 'set', 'images', 'a.jpg'), os.path.join('images', 'set', 'labels', 'a.txt')),
+        (os.path.join('images', 'train', 'd.jpg'), os.path.join('images', 'train', 'd.txt'))]